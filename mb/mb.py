@@ -789,12 +789,16 @@ class MirrorDoctor(cmdln.Cmdln):
     @cmdln.option('-a', '--all', action='store_true',
                   help='Scan all enabled mirrors.')
     @cmdln.option('-j', '--jobs', metavar='N',
-                  help='Run up to N scanner queries in parallel.')
+                  help='Scan up to N mirrors in parallel.')
     @cmdln.option('-S', '--scanner', metavar='PATH',
-                  help='Specify path to scanner.')
+                  help='Run the external scanner at PATH (like /usr/bin/scanner) '
+                       'instead of scanning in-process.')
     @cmdln.option('-d', '--directory', metavar='DIR',
                   help='Scan only in dir under mirror\'s baseurl. '
                        'Default: start at baseurl. Does not delete files, only add.')
+    @cmdln.option('--full', action='store_true',
+                  help='List all directories and apply all files found, even '
+                       'where a snapshot of the last scan says they didn\'t change.')
     def do_scan(self, subcmd, opts, *args):
         """${cmd_name}: scan mirrors
 
@@ -803,6 +807,7 @@ class MirrorDoctor(cmdln.Cmdln):
         ${cmd_option_list}
         """
         from sqlobject.sqlbuilder import AND
+        import time
         import mb.util
         import textwrap
         import mb.testmirror
@@ -810,37 +815,6 @@ class MirrorDoctor(cmdln.Cmdln):
 
         mb.util.timer_start()
 
-        cmd = []
-        cmd.append(opts.scanner or '/usr/bin/scanner')
-
-        if self.options.configpath:
-            cmd.append('--config %s' % self.options.configpath)
-        if self.options.brain_instance:
-            cmd.append('-b %s' % self.options.brain_instance)
-
-        if opts.sql_debug:
-            cmd.append('-S')
-        for i in range(opts.verbosity):
-            cmd.append('-v')
-        for i in range(opts.quietness):
-            cmd.append('-q')
-
-        if opts.enable:
-            cmd.append('-e')
-        if opts.directory:
-            cmd.append('-d %s' % opts.directory)
-        if opts.jobs:
-            cmd += [ '-j', opts.jobs ]
-        if opts.enable or args:
-            cmd.append('-f')
-
-        cmd += [ '-I %s' % i for i in 
-                 self.config.dbconfig.get('scan_top_include', '').split() ]
-        cmd += [ '--exclude %s' % i for i in 
-                 self.config.dbconfig.get('scan_exclude', '').split() ]
-        cmd += [ '--exclude-rsync %s' % i for i in 
-                 self.config.dbconfig.get('scan_exclude_rsync', '').split() ]
-
         if not opts.all and not args:
             sys.exit('No mirrors specified for scanning. Either give identifiers, or use -a [-j N].')
 
@@ -883,27 +857,103 @@ class MirrorDoctor(cmdln.Cmdln):
             print 'No mirror to scan. Exiting.'
             sys.exit(0)
 
-        cmd += [ mirror.identifier for mirror in mirrors_to_scan ]
-
-        cmd = ' '.join(cmd)
-        if self.options.debug:
-            print cmd
-        
         if opts.directory and len(mirrors) != 1:
             print 'Completed in', mb.util.timer_elapsed()
             mb.util.timer_start()
 
         sys.stdout.flush()
 
-        import os
-        rc = os.system(cmd)
+        top_include = self.config.dbconfig.get('scan_top_include', '').split()
+        exclude = self.config.dbconfig.get('scan_exclude', '').split()
+        exclude_rsync = self.config.dbconfig.get('scan_exclude_rsync', '').split()
+
+        if opts.scanner:
+            # the external (Perl) scanner
+            cmd = []
+            cmd.append(opts.scanner)
+
+            if self.options.configpath:
+                cmd.append('--config %s' % self.options.configpath)
+            if self.options.brain_instance:
+                cmd.append('-b %s' % self.options.brain_instance)
+
+            if opts.sql_debug:
+                cmd.append('-S')
+            for i in range(opts.verbosity):
+                cmd.append('-v')
+            for i in range(opts.quietness):
+                cmd.append('-q')
+
+            if opts.enable:
+                cmd.append('-e')
+            if opts.directory:
+                cmd.append('-d %s' % opts.directory)
+            if opts.jobs:
+                cmd += [ '-j', opts.jobs ]
+            if opts.enable or args:
+                cmd.append('-f')
+
+            cmd += [ '-I %s' % i for i in top_include ]
+            cmd += [ '--exclude %s' % i for i in exclude ]
+            cmd += [ '--exclude-rsync %s' % i for i in exclude_rsync ]
+
+            cmd += [ mirror.identifier for mirror in mirrors_to_scan ]
+
+            cmd = ' '.join(cmd)
+            if self.options.debug:
+                print cmd
+
+            import os
+            rc = os.system(cmd)
+            mirrors_scanned = rc == 0 and mirrors_to_scan or []
+
+        else:
+            import mb.scanner
+            f = mb.scanner.Filter(top_include=top_include, 
+                                  exclude=exclude, 
+                                  exclude_rsync=exclude_rsync)
+            mirrors_scanned = []
+            total_files = total_bytes = total_dirs = total_pruned = 0
+            for r in mb.scanner.scan_mirrors(self.conn, mirrors_to_scan, f, 
+                                             directory=opts.directory,
+                                             jobs=int(opts.jobs or 1),
+                                             verbose=opts.verbosity,
+                                             snapshot_dir=self.config.dbconfig.get('scan_snapshot_dir'),
+                                             full=opts.full):
+                if r.error:
+                    print >>sys.stderr, '%s %s: scan failed: %s' \
+                            % (time.ctime(), r.mirror.identifier, r.error)
+                    continue
+                mirrors_scanned.append(r.mirror)
+                total_files += r.files
+                total_bytes += r.bytes
+                total_dirs += r.dirs
+                total_pruned += r.pruned
+                if opts.quietness < 2:
+                    pruned = ''
+                    if r.dirs:
+                        pruned = ', %d of %d dirs unchanged' % (r.pruned, r.dirs)
+                    print '%s %s: %d files (%.1f MB) in %ds (%d/s) via %s, %d added, %d removed%s' \
+                            % (time.ctime(), r.mirror.identifier, r.files, 
+                               r.bytes / 1024.0 / 1024, r.duration, 
+                               r.files / max(r.duration, 1), 
+                               r.url.split(':', 1)[0], r.added, r.removed, pruned)
+                sys.stdout.flush()
+
+            if opts.quietness < 1:
+                print 'Scanned %d of %d mirrors: %d files (%.1f MB)' \
+                        % (len(mirrors_scanned), len(mirrors_to_scan), 
+                           total_files, total_bytes / 1024.0 / 1024),
+                if total_dirs:
+                    print '- %d of %d directories unchanged, not listed' \
+                            % (total_pruned, total_dirs)
+                else:
+                    print
 
-        if opts.enable and rc == 0:
-            import time
-            import mb.testmirror
+        if opts.enable:
             tt = time.ctime()
             comment = ('*** scanned and enabled at %s.' % tt)
-            for mirror in mirrors_to_scan:
+            for mirror in mirrors_scanned:
                 mirror.comment = ' '.join([mirror.comment or '', '\n\n' + comment])
 
                 print '%s %s: testing status of base URL...' % (tt, mirror.identifier)
@@ -948,6 +998,32 @@ class MirrorDoctor(cmdln.Cmdln):
                              'subdirectory -- see examples)')
     @cmdln.option('-t', '--target-dir', metavar='PATH',
                         help='set the target directory (required)')
+    @cmdln.option('--verify', action='store_true',
+                        help='instead of updating hashes, read a sample of the files '
+                             'and compare them with their hashes in the database')
+    @cmdln.option('--verify-fraction', type='float', metavar='F',
+                        help='with --verify, read this fraction of the files '
+                             '(default: 1/30, unless --verify-bytes is given)')
+    @cmdln.option('--verify-bytes', metavar='SIZE',
+                        help='with --verify, read at most this much per run '
+                             '(e.g. 50G)')
+    @cmdln.option('--bwlimit', metavar='RATE',
+                        help='limit reading to RATE bytes per second (e.g. 20M)')
+    @cmdln.option('--rechunk', action='store_true',
+                        help='recompute the piece hashes of files whose pieces '
+                             'have another size than the configured one '
+                             '(chunk_size, max_pieces)')
+    @cmdln.option('--changes', metavar='FILE',
+                        help='visit only the directories of the paths listed in FILE '
+                             '(- for stdin), instead of walking the whole tree. '
+                             'FILE can be rsync --itemize-changes output, an rsync '
+                             'log file, or a list of paths')
+    @cmdln.option('-C', '--cache-file', metavar='PATH',
+                        help='keep computed hashes in a local cache file, keyed by '
+                             'inode, size and mtime, so that renamed, moved or '
+                             'hardlinked files are not read again')
+    @cmdln.option('-j', '--jobs', metavar='N', type='int', default=1,
+                        help='compute hashes in N parallel processes')
     @cmdln.option('-v', '--verbose', action='store_true',
                         help='show more information')
     def do_makehashes(self, subcmd, opts, startdir):
@@ -967,6 +1043,29 @@ class MirrorDoctor(cmdln.Cmdln):
         Hash only the subdirectory extended/iso/de:
             mb makehashes -t /srv/metalink-hashes/srv/ooo -b /srv/ooo /srv/ooo/extended/iso/de
         
+        Hash with 8 processes in parallel (the directory traversal and
+        database updates are still done by a single process):
+            mb makehashes -j 8 -t /srv/metalink-hashes/srv/ooo /srv/ooo
+
+        Update only what rsync changed (new subdirectories are descended
+        into, and hashes of deleted files and directories are removed):
+            rsync -a --delete --itemize-changes SRC /srv/ooo/ > changes.txt
+            mb makehashes -t /srv/metalink-hashes/srv/ooo /srv/ooo --changes changes.txt
+
+        After changing chunk_size or max_pieces in mirrorbrain.conf, recompute
+        the piece hashes of files which have pieces of another size (the
+        other hashes are not computed again):
+            mb makehashes -t /srv/metalink-hashes/srv/ooo /srv/ooo --rechunk
+
+        Verify one 30th of the files (those not verified for the longest
+        time), reading at most 20 MB/s; run daily to verify all files in a
+        month. Files whose content doesn't match the hashes are reported:
+            mb makehashes -b /srv/ooo /srv/ooo --verify --bwlimit 20M
+
+        Or read at most 2 GB per run, which makes 48 GB a day when run
+        hourly:
+            mb makehashes -b /srv/ooo /srv/ooo --verify --verify-bytes 2G
+
         Further examples:
             mb makehashes \\
             -t /srv/metalink-hashes/srv/ftp/pub/opensuse/repositories/home:/poeml \\
@@ -991,6 +1090,11 @@ class MirrorDoctor(cmdln.Cmdln):
         import mb.hashes
         import mb.files
 
+        if opts.verify:
+            if not opts.base_dir:
+                opts.base_dir = startdir
+            return self.verify_hashes(opts, startdir)
+
         if not opts.target_dir:
             sys.exit('You must specify the target directory (-t)')
         if not opts.base_dir:
@@ -1014,205 +1118,391 @@ class MirrorDoctor(cmdln.Cmdln):
         if not os.path.exists(startdir):
             sys.exit('STARTDIR %r does not exist' % startdir) 
 
-        directories_todo = [startdir]
+        if opts.changes:
+            # incremental mode: look only at directories with changes
+            if opts.changes == '-':
+                changes = sys.stdin
+            else:
+                changes = open(opts.changes)
+            directories_todo = mb.hashes.dirs_from_changelist(changes, startdir)
+            if changes is not sys.stdin:
+                changes.close()
+            if opts.verbose:
+                print '%s directories with changes' % len(directories_todo)
+        else:
+            directories_todo = [startdir]
+        directories_done = set()
 
         if opts.ignore_mask: 
             opts.ignore_mask = re.compile(opts.ignore_mask)
         if opts.file_mask: 
             opts.file_mask = re.compile(opts.file_mask)
 
+        if opts.jobs < 1:
+            sys.exit('The number of jobs (-j) must be at least 1')
+        pool = None
+        if opts.jobs > 1 and not opts.dry_run:
+            import multiprocessing
+            pool = multiprocessing.Pool(opts.jobs, mb.hashes.init_worker)
+
+        cache = None
+        if opts.cache_file and not opts.dry_run:
+            import mb.hashcache
+            cache = mb.hashcache.HashCache(opts.cache_file)
+        # don't remove the cache if it is in the target tree
+        protected_files = []
+        if opts.cache_file:
+            protected_files = [ os.path.realpath(opts.cache_file), 
+                                os.path.realpath('%s-journal' % opts.cache_file) ]
+
+        # files that exist, for evicting the stale cache entries afterwards;
+        # not in incremental mode, which doesn't look at all files
+        seen_files = skipped_dirs = None
+        if cache and not opts.changes:
+            seen_files = set()
+            skipped_dirs = []
+
+        # database writes are collected and done once per directory
+        db_batch = mb.hashes.DbBatch(self.conn)
+
         unlinked_files = unlinked_dirs = 0
 
-        while len(directories_todo) > 0:
-            src_dir = directories_todo.pop(0)
+        # With -j, the files that need hashing are handed to the worker pool
+        # through a single imap() over the whole tree. While they are hashed,
+        # the next directories are looked at, until lookahead files (or
+        # directories) are waiting. imap() returns the results in order, and
+        # the directories are finished in the order they were looked at, so
+        # the output is the same as when hashing serially. Database and hash
+        # file writes are all done here.
+        lookahead = opts.jobs * 4
+        # directories that were looked at, with the state to finish them
+        pending = []
+        queued = 0
+        if pool:
+            import Queue
+            feed = Queue.Queue()
+            results = pool.imap(mb.hashes.fill_worker, iter(feed.get, None))
 
-            try:
-                src_dir_mode = os.stat(src_dir).st_mode
-            except OSError, e:
-                if e.errno == errno.ENOENT:
-                    sys.stderr.write('Directory vanished: %r\n' % src_dir)
-                    continue
+        try:
+            while directories_todo or pending:
+                if directories_todo \
+                   and (not pending 
+                        or pool and queued < lookahead and len(pending) < lookahead):
+                    src_dir = directories_todo.pop(0)
+
+                    if opts.changes:
+                        if src_dir in directories_done:
+                            continue
+                        directories_done.add(src_dir)
 
-            dst_dir = os.path.join(opts.target_dir, src_dir[len(opts.base_dir):].lstrip('/'))
-            dst_dir_db = src_dir[len(opts.base_dir):].lstrip('/')
-            #print dst_dir_db
+                    try:
+                        src_dir_mode = os.stat(src_dir).st_mode
+                    except OSError, e:
+                        if e.errno == errno.ENOENT:
+                            sys.stderr.write('Directory vanished: %r\n' % src_dir)
+                            continue
 
-            if not opts.dry_run:
-                if not os.path.isdir(dst_dir):
-                    os.makedirs(dst_dir, mode = 0755)
-                if opts.copy_permissions:
-                    os.chmod(dst_dir, src_dir_mode)
-                else:
-                    os.chmod(dst_dir, 0755)
+                    dst_dir = os.path.join(opts.target_dir, src_dir[len(opts.base_dir):].lstrip('/'))
+                    dst_dir_db = src_dir[len(opts.base_dir):].lstrip('/')
+                    #print dst_dir_db
 
-            try:
-                dst_names = os.listdir(dst_dir)
-                dst_names.sort()
-                dst_names_db = [ (os.path.basename(i), j) 
-                                 for i, j in mb.files.dir_filelist(self.conn, dst_dir_db)]
-                dst_names_db_dict = dict(dst_names_db)
-                dst_names_db_keys = dst_names_db_dict.keys()
-                #print dst_names_db_keys
-            except OSError, e:
-                if e.errno == errno.ENOENT:
-                    sys.exit('\nSorry, cannot really continue in dry-run mode, because directory %r does not exist.\n'
-                             'You might want to create it:\n'
-                             '  mkdir %s' % (dst_dir, dst_dir))
-
-
-            # a set offers the fastest access for "foo in ..." lookups
-            try:
-                src_basenames = set(os.listdir(src_dir))
-            except os.error:
-                sys.stderr.write('Cannot access directory: %r\n' % src_dir)
-                src_basenames = []
+                    if not opts.dry_run:
+                        if not os.path.isdir(dst_dir):
+                            os.makedirs(dst_dir, mode = 0755)
+                        if opts.copy_permissions:
+                            os.chmod(dst_dir, src_dir_mode)
+                        else:
+                            os.chmod(dst_dir, 0755)
 
-            if opts.verbose:
-                print 'Examining directory', src_dir
+                    try:
+                        dst_names = os.listdir(dst_dir)
+                        dst_names.sort()
+                        # one query per directory, to learn which files have
+                        # (up to date) hashes in the database
+                        dst_db_info = {}
+                        dst_names_db = []
+                        for path, file_id, hash_id, mtime, size, piecesize in mb.files.dir_hashes(self.conn, dst_dir_db):
+                            dst_db_info[os.path.basename(path)] = (file_id, mtime, size, piecesize)
+                            dst_names_db.append((os.path.basename(path), hash_id))
+                        dst_names_db_dict = dict(dst_names_db)
+                        dst_names_db_keys = dst_names_db_dict.keys()
+                        #print dst_names_db_keys
+                    except OSError, e:
+                        if e.errno == errno.ENOENT:
+                            sys.exit('\nSorry, cannot really continue in dry-run mode, because directory %r does not exist.\n'
+                                     'You might want to create it:\n'
+                                     '  mkdir %s' % (dst_dir, dst_dir))
 
-            dst_keep_db = set()
-            dst_keep = set()
-            dst_keep.add('LOCK')
 
-            # FIXME: given that we don't need -t parameter anymore... can we create a lock hierarchy in /tmp instead??
-            lockfile = os.path.join(dst_dir, 'LOCK')
-            try:
-                if not opts.dry_run:
-                    lock = open(lockfile, 'w')
-                    fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    # a set offers the fastest access for "foo in ..." lookups
                     try:
-                        os.stat(lockfile)
-                    except OSError, e: 
-                        if e.errno == errno.ENOENT:
-                            if opts.verbose:
-                                print '====== skipping %s, which we were about to lock' % lockfile
+                        src_basenames = set(os.listdir(src_dir))
+                    except os.error:
+                        sys.stderr.write('Cannot access directory: %r\n' % src_dir)
+                        src_basenames = []
+
+                    if opts.verbose:
+                        print 'Examining directory', src_dir
+
+                    dst_keep_db = set()
+                    dst_keep = set()
+                    dst_keep.add('LOCK')
+
+                    # FIXME: given that we don't need -t parameter anymore... can we create a lock hierarchy in /tmp instead??
+                    lockfile = os.path.join(dst_dir, 'LOCK')
+                    lock = None
+                    try:
+                        if not opts.dry_run:
+                            lock = open(lockfile, 'w')
+                            fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            try:
+                                os.stat(lockfile)
+                            except OSError, e: 
+                                if e.errno == errno.ENOENT:
+                                    if opts.verbose:
+                                        print '====== skipping %s, which we were about to lock' % lockfile
+                                    if skipped_dirs is not None:
+                                        skipped_dirs.append(src_dir)
+                                    continue
+
+                        if opts.verbose:
+                            print 'locked %s' % lockfile
+                    except IOError, e:
+                        if e.errno in [ errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK ]:
+                            print 'Skipping %r, which is locked' % src_dir
+                            if skipped_dirs is not None:
+                                skipped_dirs.append(src_dir)
                             continue
+                        else:
+                            raise
 
-                if opts.verbose:
-                    print 'locked %s' % lockfile
-            except IOError, e:
-                if e.errno in [ errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK ]:
-                    print 'Skipping %r, which is locked' % src_dir
-                    continue
-                else:
-                    raise
 
+                    hasheables = []
+                    for src_basename in sorted(src_basenames):
+                        src = os.path.join(src_dir, src_basename)
 
-            for src_basename in sorted(src_basenames):
-                src = os.path.join(src_dir, src_basename)
+                        if opts.ignore_mask and re.match(opts.ignore_mask, src):
+                            continue
 
-                if opts.ignore_mask and re.match(opts.ignore_mask, src):
-                    continue
+                        # stat only once
+                        try:
+                            hasheable = mb.hashes.Hasheable(src_basename, 
+                                                            src_dir=src_dir, 
+                                                            dst_dir=dst_dir,
+                                                            base_dir=opts.base_dir,
+                                                            do_zsync_hashes=self.config.dbconfig.get('zsync_hashes'),
+                                                            do_chunked_hashes=self.config.dbconfig.get('chunked_hashes'),
+                                                            chunk_size=self.config.dbconfig.get('chunk_size'),
+                                                            max_pieces=self.config.dbconfig.get('max_pieces'),
+                                                            write_hash_file=self.config.dbconfig.get('hash_files'),
+                                                            readahead=self.config.dbconfig.get('hash_readahead'),
+                                                            dropbehind=self.config.dbconfig.get('hash_dropbehind'))
+                        except OSError, e:
+                            if e.errno == errno.ENOENT:
+                                sys.stderr.write('File vanished: %r\n' % src)
+                                continue
 
-                # stat only once
-                try:
-                    hasheable = mb.hashes.Hasheable(src_basename, 
-                                                    src_dir=src_dir, 
-                                                    dst_dir=dst_dir,
-                                                    base_dir=opts.base_dir,
-                                                    do_zsync_hashes=self.config.dbconfig.get('zsync_hashes'),
-                                                    do_chunked_hashes=self.config.dbconfig.get('chunked_hashes'),
-                                                    chunk_size=self.config.dbconfig.get('chunk_size'))
-                except OSError, e:
-                    if e.errno == errno.ENOENT:
-                        sys.stderr.write('File vanished: %r\n' % src)
-                        continue
+                        hasheable.dbinfo = dst_db_info.get(src_basename, (None, None, None, None))
 
-                if hasheable.islink():
-                    if opts.verbose:
-                        print 'ignoring link', src
-                    continue
+                        if hasheable.islink():
+                            if opts.verbose:
+                                print 'ignoring link', src
+                            continue
 
-                elif hasheable.isreg():
-                    if not opts.file_mask or re.match(opts.file_mask, src_basename):
-                        #if opts.verbose:
-                        #    print 'dst:', dst
-                        hasheable.check_file(verbose=opts.verbose, 
-                                            dry_run=opts.dry_run, 
-                                            force=opts.force, 
-                                            copy_permissions=opts.copy_permissions)
-                        hasheable.check_db(conn=self.conn,
-                                           verbose=opts.verbose, 
-                                           dry_run=opts.dry_run,
-                                           force=opts.force)
-                        dst_keep.add(hasheable.dst_basename)
-                        dst_keep_db.add(hasheable.basename)
-
-                elif hasheable.isdir():
-                    directories_todo.append(src)  # It's a directory, store it.
-                    dst_keep.add(hasheable.basename)
-                    dst_keep_db.add(hasheable.basename)
-
-
-            dst_remove = set(dst_names) - dst_keep
-            #print 'old', dst_remove
-            dst_remove_db = set(dst_names_db_keys) - dst_keep_db
-            #print 'new', dst_remove_db
-
-            # print 'files to keep:'
-            # print dst_keep
-            # print
-            # print 'files to remove:'
-            # print dst_remove
-            # print
-
-            for i in sorted(dst_remove):
-                i_path = os.path.join(dst_dir, i)
-                #print i_path
-
-                if (opts.ignore_mask and re.match(opts.ignore_mask, i_path)):
-                    print 'ignoring, not removing %s', i_path
+                        elif hasheable.isreg():
+                            if seen_files is not None:
+                                seen_files.add((hasheable.dev, hasheable.inode,
+                                                hasheable.size, int(hasheable.mtime)))
+                            if not opts.file_mask or re.match(opts.file_mask, src_basename):
+                                hasheables.append(hasheable)
+                                dst_keep.add(hasheable.dst_basename)
+                                dst_keep_db.add(hasheable.basename)
+
+                        elif hasheable.isdir():
+                            # in incremental mode, descend only into directories
+                            # which haven't been seen before
+                            if not opts.changes \
+                               or not os.path.isdir(os.path.join(dst_dir, src_basename)):
+                                directories_todo.append(src)  # It's a directory, store it.
+                            dst_keep.add(hasheable.basename)
+                            dst_keep_db.add(hasheable.basename)
+
+
+                    # find the files that need hashing. With a cache, look there first.
+                    to_be_hashed = set()
+                    if (pool or cache) and not opts.dry_run:
+                        for hasheable in hasheables:
+                            if not hasheable.needs_update(self.conn, force=opts.force):
+                                continue
+                            if cache and not opts.force and cache.restore(hasheable):
+                                if opts.verbose:
+                                    print 'Hashes taken from cache: %r' % hasheable.src
+                                continue
+                            to_be_hashed.add(hasheable)
+
+                    pending.append((src_dir, dst_dir, dst_dir_db, dst_names, 
+                                    dst_names_db_dict, dst_names_db_keys,
+                                    dst_keep, dst_keep_db, lockfile, lock,
+                                    hasheables, to_be_hashed))
+                    if pool:
+                        for hasheable in hasheables:
+                            if hasheable in to_be_hashed:
+                                feed.put(hasheable.hb)
+                                queued += 1
                     continue
 
-                if os.path.isdir(i_path):
-                    print 'Recursively removing obsolete directory %r' % i_path
-                    if not opts.dry_run: 
-                        try:
-                            shutil.rmtree(i_path)
-                        except OSError, e:
-                            if e.errno == errno.EACCES:
-                                sys.stderr.write('Recursive removing failed for %r (%s). Ignoring.\n' \
-                                                    % (i_path, os.strerror(e.errno)))
-                            else:
-                                sys.exit('Recursive removing failed for %r: %s\n' \
-                                                    % (i_path, os.strerror(e.errno)))
+                (src_dir, dst_dir, dst_dir_db, dst_names, 
+                 dst_names_db_dict, dst_names_db_keys,
+                 dst_keep, dst_keep_db, lockfile, lock,
+                 hasheables, to_be_hashed) = pending.pop(0)
+
+                for hasheable in hasheables:
+                    if opts.rechunk and not opts.force \
+                       and hasheable not in to_be_hashed \
+                       and hasheable.needs_rechunk(self.conn):
+                        if hasheable.write_hash_file:
+                            # the hash file contains all hashes, so they are all
+                            # computed again to rewrite it
+                            hasheable.check_file(verbose=opts.verbose, 
+                                                 dry_run=opts.dry_run, 
+                                                 force=True, 
+                                                 copy_permissions=opts.copy_permissions)
+                            hasheable.check_db(conn=self.conn,
+                                               verbose=opts.verbose, 
+                                               dry_run=opts.dry_run,
+                                               force=True,
+                                               batch=db_batch)
+                        else:
+                            hasheable.rechunk(self.conn, 
+                                              verbose=opts.verbose, 
+                                              dry_run=opts.dry_run)
+                        continue
 
-                        relpath = os.path.join(dst_dir_db, i)
-                        print 'Recursively removing hashes in database: %s/*' % relpath
-                        mb.files.hashes_dir_delete(self.conn, relpath)
+                    if hasheable in to_be_hashed:
+                        if pool:
+                            sys.stdout.write('Hashing %r... ' % hasheable.src)
+                            sys.stdout.flush()
+                            # (waiting with a timeout lets a KeyboardInterrupt through)
+                            hasheable.hb = results.next(timeout=0x7fffffff)
+                            queued -= 1
+                            hasheable.hb.h = hasheable
+                            if hasheable.hb.empty:
+                                sys.stdout.write('failed.\n')
+                            else:
+                                sys.stdout.write('done.\n')
+                        else:
+                            hasheable.hb.fill(verbose=opts.verbose)
+                        if cache:
+                            cache.store(hasheable)
+
+                    #if opts.verbose:
+                    #    print 'dst:', dst
+                    hasheable.check_file(verbose=opts.verbose, 
+                                        dry_run=opts.dry_run, 
+                                        force=opts.force, 
+                                        copy_permissions=opts.copy_permissions)
+                    hasheable.check_db(conn=self.conn,
+                                       verbose=opts.verbose, 
+                                       dry_run=opts.dry_run,
+                                       force=opts.force,
+                                       batch=db_batch)
+                db_batch.flush()
+                if cache:
+                    cache.commit()
+
+
+                dst_remove = set(dst_names) - dst_keep
+                #print 'old', dst_remove
+                dst_remove_db = set(dst_names_db_keys) - dst_keep_db
+                #print 'new', dst_remove_db
+
+                # print 'files to keep:'
+                # print dst_keep
+                # print
+                # print 'files to remove:'
+                # print dst_remove
+                # print
+
+                for i in sorted(dst_remove):
+                    i_path = os.path.join(dst_dir, i)
+                    #print i_path
+
+                    if (opts.ignore_mask and re.match(opts.ignore_mask, i_path)):
+                        print 'ignoring, not removing %s', i_path
+                        continue
+                    if os.path.realpath(i_path) in protected_files:
+                        continue
 
-                    unlinked_dirs += 1
+                    if os.path.isdir(i_path):
+                        print 'Recursively removing obsolete directory %r' % i_path
+                        if not opts.dry_run: 
+                            try:
+                                shutil.rmtree(i_path)
+                            except OSError, e:
+                                if e.errno == errno.EACCES:
+                                    sys.stderr.write('Recursive removing failed for %r (%s). Ignoring.\n' \
+                                                        % (i_path, os.strerror(e.errno)))
+                                else:
+                                    sys.exit('Recursive removing failed for %r: %s\n' \
+                                                        % (i_path, os.strerror(e.errno)))
+
+                            relpath = os.path.join(dst_dir_db, i)
+                            print 'Recursively removing hashes in database: %s/*' % relpath
+                            mb.files.hashes_dir_delete(self.conn, relpath)
+
+                        unlinked_dirs += 1
                     
-                else:
-                    print 'Unlinking obsolete %r' % i_path
-                    if not opts.dry_run: 
-                        try:
-                            os.unlink(i_path)
-                        except OSError, e:
-                            if e.errno != errno.ENOENT:
-                                sys.stderr.write('Unlink failed for %r: %s\n' \
-                                                    % (i_path, os.strerror(e.errno)))
-                    unlinked_files += 1
-            ids_to_delete = []
-            for i in sorted(dst_remove_db):
-                relpath = os.path.join(dst_dir_db, i)
-                dbid = dst_names_db_dict.get(i)
-                if dbid:
-                    print 'Obsolete hash in db: %r (id %s)' % (relpath, dbid)
-                    ids_to_delete.append(dbid)
-                else:
-                    pass # not in the hash table
+                    else:
+                        print 'Unlinking obsolete %r' % i_path
+                        if not opts.dry_run: 
+                            try:
+                                os.unlink(i_path)
+                            except OSError, e:
+                                if e.errno != errno.ENOENT:
+                                    sys.stderr.write('Unlink failed for %r: %s\n' \
+                                                        % (i_path, os.strerror(e.errno)))
+                        unlinked_files += 1
+                ids_to_delete = []
+                for i in sorted(dst_remove_db):
+                    relpath = os.path.join(dst_dir_db, i)
+                    dbid = dst_names_db_dict.get(i)
+                    if dbid:
+                        print 'Obsolete hash in db: %r (id %s)' % (relpath, dbid)
+                        ids_to_delete.append(dbid)
+                    else:
+                        pass # not in the hash table
 
-            if len(ids_to_delete):
-                print 'Deleting %s obsolete hashes from hash table' % len(ids_to_delete)
-                if not opts.dry_run:
-                    mb.files.hashes_list_delete(self.conn, ids_to_delete)
+                if len(ids_to_delete):
+                    print 'Deleting %s obsolete hashes from hash table' % len(ids_to_delete)
+                    if not opts.dry_run:
+                        mb.files.hashes_list_delete(self.conn, ids_to_delete)
 
+                if opts.verbose:
+                    print 'unlocking', lockfile 
+                if not opts.dry_run:
+                    os.unlink(lockfile)
+                    lock.close()
+        except:
+            if pool:
+                # the imap() waits for more files first
+                feed.put(None)
+                pool.terminate()
+                pool.join()
+            raise
+
+        if pool:
+            feed.put(None)
+            pool.close()
+            pool.join()
+
+        if cache:
+            n = 0
+            if seen_files is not None:
+                n = cache.prune(startdir, seen_files, skipped_dirs)
             if opts.verbose:
-                print 'unlocking', lockfile 
-            if not opts.dry_run:
-                os.unlink(lockfile)
-                lock.close()
+                print 'Hash cache: %s hits, %s misses, %s stale entries evicted' \
+                        % (cache.hits, cache.misses, n)
+            cache.close()
 
         if  unlinked_files or unlinked_dirs:
             print 'Unlinked %s files, %d directories.' % (unlinked_files, unlinked_dirs)
@@ -1256,6 +1546,14 @@ class MirrorDoctor(cmdln.Cmdln):
     @cmdln.option('-q', '--quiet', dest='quietness', action='count', default=0,
                   help='Produce less output. '
                        'Can be given multiple times.')
+    @cmdln.option('--batch-size', type='int', default=10000, metavar='N',
+                  help='vacuum, mirrorbits: change N rows per transaction '
+                       '(default: 10000)')
+    @cmdln.option('--sleep', type='float', default=0, metavar='SECONDS',
+                  help='vacuum, mirrorbits: sleep between the transactions')
+    @cmdln.option('--state-file', metavar='FILE',
+                  help='vacuum: remember the progress in FILE, and resume '
+                       'from there when it exists')
     def do_db(self, subcmd, opts, *args):
         """${cmd_name}: perform database maintenance, or start a shell
         
@@ -1271,6 +1569,11 @@ class MirrorDoctor(cmdln.Cmdln):
           When called with the -n option, only the number of files to be
           cleaned up is printed. This is purely for information.
 
+          The files are deleted in batches (--batch-size), each in its own
+          transaction, optionally sleeping in between (--sleep), so that
+          concurrent scans don't need to wait. With --state-file, an
+          interrupted vacuum continues where it stopped.
+
         sizes
           Print the size of each database relation. This can provide insight
           for the most appropriate database tuning.
@@ -1278,11 +1581,23 @@ class MirrorDoctor(cmdln.Cmdln):
         shell
           Conveniently open a database shell.
 
+        reconcile
+          Recount the files of each mirror (which are counted as files are
+          added and removed, for mb list -N).
+
+        mirrorbits enable|disable
+          Start keeping the mirrors of each file as a bitmap in
+          filearr.mirrorbits as well, filling in the bitmaps of the existing
+          files in batches (--batch-size, --sleep), or stop it and clear them.
+          See the mirror_bitmaps option in the documentation.
+
 
         usage:
-            mb db vacuum [-q] [-n]
+            mb db vacuum [-q] [-n] [--batch-size N] [--sleep S] [--state-file FILE]
             mb db sizes
             mb db shell
+            mb db reconcile [-q]
+            mb db mirrorbits enable|disable [-q] [--batch-size N] [--sleep S]
         ${cmd_option_list}
         """
 
@@ -1292,7 +1607,10 @@ class MirrorDoctor(cmdln.Cmdln):
         # let's keep the old way working
         if subcmd == 'vacuum':
                 mb.dbmaint.stale(self.conn, opts.quietness)
-                mb.dbmaint.vacuum(self.conn, opts.quietness)
+                mb.dbmaint.vacuum(self.conn, opts.quietness, 
+                                  batch_size=opts.batch_size, 
+                                  sleep=opts.sleep,
+                                  state_file=opts.state_file)
                 sys.exit(0)
 
         if len(args) < 1:
@@ -1304,12 +1622,27 @@ class MirrorDoctor(cmdln.Cmdln):
         elif action == 'vacuum':
             if not opts.dry_run:
                 mb.dbmaint.stale(self.conn, opts.quietness)
-                mb.dbmaint.vacuum(self.conn, opts.quietness)
+                mb.dbmaint.vacuum(self.conn, opts.quietness, 
+                                  batch_size=opts.batch_size, 
+                                  sleep=opts.sleep,
+                                  state_file=opts.state_file)
             else:
                 mb.dbmaint.stale(self.conn, opts.quietness)
         elif action == 'shell':
             mb.dbmaint.shell(self.config.dbconfig)
-
+        elif action == 'reconcile':
+            mb.dbmaint.reconcile(self.conn, opts.quietness)
+        elif action == 'mirrorbits':
+            if len(args) < 2 or args[1] not in ['enable', 'disable']:
+                sys.exit('mb db mirrorbits needs "enable" or "disable".')
+            if args[1] == 'enable':
+                mb.dbmaint.mirrorbits_enable(self.conn, opts.quietness,
+                                             batch_size=opts.batch_size,
+                                             sleep=opts.sleep)
+            else:
+                mb.dbmaint.mirrorbits_disable(self.conn, opts.quietness,
+                                              batch_size=opts.batch_size,
+                                              sleep=opts.sleep)
         else:
             sys.exit('unknown action %r' % action)
 
@@ -1318,6 +1651,148 @@ class MirrorDoctor(cmdln.Cmdln):
 
 
 
+    def verify_hashes(self, opts, startdir):
+        """mb makehashes --verify"""
+        import mb.hashverify
+        import mb.util
+
+        if not mb.hashverify.has_table(self.conn):
+            sys.exit('The hashverify table does not exist. Please apply\n'
+                     'sql/migrations/schema-postgresql-upgrade-2.19-2.20.sql '
+                     'to the database.')
+
+        fraction = opts.verify_fraction
+        max_bytes = bwlimit = None
+        if opts.verify_bytes:
+            max_bytes = mb.util.parse_size(opts.verify_bytes)
+        elif fraction is None:
+            fraction = 1 / 30.0
+        if opts.bwlimit:
+            bwlimit = mb.util.parse_size(opts.bwlimit)
+
+        nfiles, nbytes, bad = mb.hashverify.verify(self.conn, 
+                                                   startdir.rstrip('/'), 
+                                                   opts.base_dir.rstrip('/'),
+                                                   fraction=fraction,
+                                                   max_bytes=max_bytes,
+                                                   bwlimit=bwlimit,
+                                                   dry_run=opts.dry_run,
+                                                   verbose=opts.verbose)
+        if not opts.dry_run:
+            print 'Verified %s files (%.1f MB), %s with mismatching hashes.' \
+                    % (nfiles, nbytes / 1e6, len(bad))
+        if bad:
+            sys.exit(1)
+
+
+
+    @cmdln.option('--sizes', default='16M,256M',
+                  help='comma separated sizes of the test files, '
+                       'with K, M or G suffix (default: 16M,256M)')
+    @cmdln.option('--tmpdir', metavar='DIR',
+                  help='directory to create the test files in')
+    @cmdln.option('--db', action='store_true',
+                  help='also time writing the hashes to the database '
+                       '(into a temporary table)')
+    @cmdln.option('-o', '--output', metavar='FILE',
+                  help='write the results to FILE instead of stdout')
+    @cmdln.option('-m', '--mirror', 
+                  help='mirror to use for the queries benchmark')
+    @cmdln.option('--rounds', type='int', default=1000,
+                  help='how often to run each query (default: 1000)')
+    @cmdln.option('--paths', type='int', default=10000000,
+                  help='number of synthetic paths for the dirs benchmark '
+                       '(default: 10000000)')
+    def do_bench(self, subcmd, opts, *args):
+        """${cmd_name}: run benchmarks
+
+        This command needs to be called with one of the following actions:
+
+        hashes
+          Create files of the given sizes with random content, and time
+          the hashing of them with each combination of chunked and zsync
+          hashes, as well as each hash function on its own, the computation
+          of the BitTorrent info hash, and (with --db) the database write
+          path. Peak memory usage is measured for each run.
+
+          The results are printed as JSON, to be compared between releases.
+          The files are in the page cache when they are hashed, so the
+          numbers show the cost of the hashing, not that of the disk.
+
+        queries PATH
+          Time the most often used database queries, as prepared
+          statements and as ad-hoc queries, for the file PATH (and its
+          directory) on the mirror given with -m.
+
+        dirs
+          Time directory listings and subtree matches on a temporary table
+          of synthetic paths (--paths), before and after creating the
+          indexes on mb_dirname(path) and path text_pattern_ops.
+
+        mirrorbits
+          Compare keeping the mirror sets of files as mirrors arrays alone
+          with keeping the bitmaps of "mb db mirrorbits enable" along with
+          them, on a temporary table: adding and removing a mirror for
+          single files (--rounds of each), as a scan does, the column size,
+          and counting the files of a mirror.
+
+        usage:
+            mb bench hashes [--sizes 16M,256M] [--db] [-o FILE]
+            mb bench queries -m MIRROR [--rounds N] [-o FILE] PATH
+            mb bench dirs [--paths N] [-o FILE]
+            mb bench mirrorbits [--rounds N] [-o FILE]
+        ${cmd_option_list}
+        """
+
+        import json
+        import mb.bench
+        import mb.util
+
+        if len(args) < 1:
+            sys.exit('Too few arguments.')
+        action = args[0]
+
+        if action == 'hashes':
+            sizes = [ mb.util.parse_size(i) for i in opts.sizes.split(',') ]
+            conn = None
+            if opts.db:
+                conn = self.conn
+            r = mb.bench.bench_hashes(sizes, 
+                                      chunk_size=self.config.dbconfig.get('chunk_size'),
+                                      tmpdir=opts.tmpdir, 
+                                      conn=conn, 
+                                      verbose=True)
+
+        elif action == 'queries':
+            if len(args) < 2 or not opts.mirror:
+                sys.exit('A path and a mirror (-m) are needed.')
+            mirror = lookup_mirror(self, opts.mirror)
+            r = mb.bench.bench_queries(self.conn, args[1], mirror.id, 
+                                       rounds=opts.rounds)
+
+        elif action == 'dirs':
+            r = mb.bench.bench_dirs(self.conn, 
+                                    npaths=opts.paths,
+                                    verbose=True)
+
+        elif action == 'mirrorbits':
+            r = mb.bench.bench_mirrorbits(self.conn, nops=opts.rounds, 
+                                          verbose=True)
+
+        else:
+            sys.exit('unknown action %r' % action)
+
+        if opts.output:
+            out = open(opts.output, 'w')
+        else:
+            out = sys.stdout
+        json.dump(r, out, indent=2, sort_keys=True)
+        out.write('\n')
+        if out is not sys.stdout:
+            out.close()
+
+
+
     @cmdln.option('-u', '--url', action='store_true',
                         help='show the URL on the mirror')
     @cmdln.option('-p', '--probe', action='store_true',
@@ -1327,13 +1802,16 @@ class MirrorDoctor(cmdln.Cmdln):
     @cmdln.option('-m', '--mirror', 
                   help='apply operation to this mirror')
     def do_file(self, subcmd, opts, action, path):
-        """${cmd_name}: operations on files: ls/rm/add
+        """${cmd_name}: operations on files: ls/rm/add/snapshot
 
         ACTION is one of the following:
 
           ls PATH             list file
           rm PATH             remove PATH entry from the database
           add PATH            create database entry for file PATH
+          snapshot LISTFILE   make the database reflect that the files
+                              listed in LISTFILE (one path per line, or - for
+                              stdin) are all the files on the mirror
 
         PATH can contain * as wildcard, or alternatively % (SQL syntax).
 
@@ -1343,13 +1821,14 @@ class MirrorDoctor(cmdln.Cmdln):
           mb file ls '*xorg-x11-libXfixes-7.4-1.14.i586.rpm'
           mb file add distribution/11.0/SHOULD_NOT_BE_VISIBLE -m cdn.novell.com
           mb file rm distribution/11.0/SHOULD_NOT_BE_VISIBLE -m MIRROR
+          find . -type f | cut -c3- | mb file snapshot -m MIRROR -
 
 
         ${cmd_usage}
         ${cmd_option_list}
         """
         
-        if path.startswith('/'):
+        if path.startswith('/') and action != 'snapshot':
             path = path[1:]
 
         import mb.files
@@ -1359,7 +1838,7 @@ class MirrorDoctor(cmdln.Cmdln):
         if opts.md5:
             opts.probe = True
 
-        if action in ['add', 'rm']:
+        if action in ['add', 'rm', 'snapshot']:
             if not opts.mirror:
                 sys.exit('this command needs to be used with -m')
 
@@ -1409,8 +1888,18 @@ class MirrorDoctor(cmdln.Cmdln):
         elif action == 'rm':
             mb.files.rm(self.conn, path, mirror)
 
+        elif action == 'snapshot':
+            if path == '-':
+                f = sys.stdin
+            else:
+                f = open(path)
+            paths = ( line.rstrip('\n') for line in f )
+            n, added, removed = mb.files.apply_snapshot(self.conn, mirror, paths)
+            print '%s: %d files, %d added, %d removed' \
+                    % (mirror.identifier, n, added, removed)
+
         else:
-            sys.exit('ACTION must be either ls, rm or add.')
+            sys.exit('ACTION must be either ls, rm, add or snapshot.')
 
 
     @cmdln.option('-s', dest='segments', metavar='N', default=2,
@@ -53,21 +53,16 @@ def iplookup(conn, s):
 
     if not a.ip:
         return a
-    query = """SELECT pfx, asn \
-                   FROM pfx2asn \
-                   WHERE pfx >>= ip4r('%s') \
-                   ORDER BY ip4r_size(pfx) \
-                   LIMIT 1""" % a.ip
-
-    try:
-        res = conn.Pfx2asn._connection.queryAll(query)
-    except AttributeError:
-        # we get this error if mod_asn isn't installed as well
+    if not hasattr(conn, 'Pfx2asn'):
+        # mod_asn isn't installed as well
         return a
 
-    if len(res) != 1:
+    import mb.dal
+    res = mb.dal.get_dal(conn).query_one('pfx2asn', a.ip)
+
+    if not res:
         return a
-    (a.prefix, a.asn) = res[0]
+    (a.prefix, a.asn) = res
     return a
 
 def asn_prefixes(conn, asn):
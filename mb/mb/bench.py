@@ -0,0 +1,564 @@
+#!/usr/bin/python
+
+"""
+Benchmarks for the hashing code in mb.hashes, and for database queries.
+
+Hash one or more (preferably large) files and report the throughput
+of HashBag.fill():
+
+    python -m mb.bench [--zsync] [--no-pieces] [--chunk-size N] FILE...
+
+Run it twice to have the file(s) in the page cache, in order to
+measure the hashing itself and not the disk.
+
+Run the whole suite on synthetic files, with JSON output:
+
+    python -m mb.bench hashes [--sizes 16M,256M] [--tmpdir DIR]
+
+which is the same as "mb bench hashes", except that the latter can also
+time the database write path (--db).
+
+"mb bench queries" compares the prepared statements of mb.dal with the same
+queries built by string interpolation, and "mb bench dirs" compares
+directory listings and subtree matches with and without the indexes on
+mb_dirname(path) and path text_pattern_ops, on a synthetic table.
+"mb bench mirrorbits" compares keeping the mirrors arrays alone with
+keeping the bitmaps of "mb db mirrorbits enable" along with them.
+"""
+
+import sys
+import os
+import time
+
+import mb.hashes
+import mb.util
+
+
+def time_fill(path, do_chunked_hashes=True, do_zsync_hashes=False,
+              chunk_size=mb.hashes.DEFAULT_PIECESIZE):
+    """hash a file and return a tuple of (size, seconds)"""
+
+    h = make_hasheable(path, do_chunked_hashes, do_zsync_hashes, chunk_size)
+
+    t_start = time.time()
+    h.hb.fill(quiet=True)
+    t_delta = time.time() - t_start
+
+    return h.size, t_delta
+
+
+def make_hasheable(path, do_chunked_hashes=True, do_zsync_hashes=False,
+                   chunk_size=mb.hashes.DEFAULT_PIECESIZE):
+    src_dir, basename = os.path.split(os.path.abspath(path))
+    return mb.hashes.Hasheable(basename, src_dir=src_dir, dst_dir='/nonexistent',
+                               base_dir=src_dir,
+                               do_zsync_hashes=do_zsync_hashes,
+                               do_chunked_hashes=do_chunked_hashes,
+                               chunk_size=chunk_size)
+
+
+def make_file(path, size):
+    """create a file of the given size with random content"""
+    block = os.urandom(1 << 20)
+    f = open(path, 'wb')
+    written = 0
+    while written < size:
+        n = min(len(block), size - written)
+        # vary the blocks a little, so they aren't all the same
+        f.write(str(written) + block[len(str(written)):n])
+        written += n
+    f.close()
+
+
+def peak_rss():
+    """return the peak resident set size of this process in KB"""
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def allocated_blocks():
+    """the number of memory blocks allocated by Python, or None where the
+    interpreter can't tell (Python 2)"""
+    f = getattr(sys, 'getallocatedblocks', None)
+    return f and f()
+
+
+def run_forked(func, *args):
+    """run func(*args) in a child process and return its (JSON serializable)
+    result, so that the peak memory usage of each run is measured
+    separately"""
+    import json
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 0
+        try:
+            try:
+                os.write(w, json.dumps(func(*args)))
+            except:
+                import traceback
+                traceback.print_exc()
+                status = 1
+        finally:
+            os._exit(status)
+
+    os.close(w)
+    data = []
+    while 1:
+        d = os.read(r, 65536)
+        if not d:
+            break
+        data.append(d)
+    os.close(r)
+    pid, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError('benchmark child process failed')
+    return json.loads(''.join(data))
+
+
+def bench_fill(path, do_chunked_hashes, do_zsync_hashes, chunk_size):
+    """time HashBag.fill() and measure its memory usage"""
+
+    h = make_hasheable(path, do_chunked_hashes, do_zsync_hashes, chunk_size)
+    rss_before = peak_rss()
+    blocks_before = allocated_blocks()
+
+    t_start = time.time()
+    h.hb.fill(quiet=True)
+    t_delta = time.time() - t_start
+
+    gb = h.size / float(1 << 30)
+    r = { 'size': h.size,
+          'chunked_hashes': do_chunked_hashes,
+          'zsync_hashes': do_zsync_hashes,
+          'seconds': t_delta,
+          'mb_per_s': h.size / 1e6 / (t_delta or 1e-9),
+          'peak_rss_kb': peak_rss(),
+          'rss_growth_kb': peak_rss() - rss_before,
+          'rss_growth_kb_per_gb': (peak_rss() - rss_before) / (gb or 1),
+          'allocated_blocks_per_gb': None }
+    if blocks_before is not None:
+        r['allocated_blocks_per_gb'] = (allocated_blocks() - blocks_before) / (gb or 1)
+    return r
+
+
+def bench_algorithms(path, chunk_size):
+    """time each part of HashBag.fill() on its own: reading the file, and
+    each hash function. Returns seconds and MB/s for each."""
+
+    size = os.path.getsize(path)
+    hb = make_hasheable(path, chunk_size=chunk_size,
+                        do_zsync_hashes=True).hb
+    hb.zs_guess_zsync_params()
+
+    def zsums(data, buf, n):
+        hb.zsums_len = 0
+        hb.zs_get_block_sums(buf, n)
+
+    import hashlib
+    algorithms = [ ('read', None),
+                   ('md5', lambda data, buf, n, h=hashlib.md5(): h.update(data)),
+                   ('sha1', lambda data, buf, n, h=hashlib.sha1(): h.update(data)),
+                   ('sha256', lambda data, buf, n, h=hashlib.sha256(): h.update(data)),
+                   ('sha1_pieces', lambda data, buf, n: hashlib.sha1(data).digest()),
+                   ('zsync', zsums) ]
+
+    # read once before, to have the file in the page cache
+    f = open(path, 'rb')
+    for buf, n in mb.hashes.read_chunks(f, chunk_size):
+        pass
+    f.close()
+
+    r = {}
+    for name, func in algorithms:
+        f = open(path, 'rb')
+        t_start = time.time()
+        for buf, n in mb.hashes.read_chunks(f, chunk_size):
+            if func:
+                func(buffer(buf, 0, n), buf, n)
+        t_delta = time.time() - t_start
+        f.close()
+        r[name] = { 'seconds': t_delta,
+                    'mb_per_s': size / 1e6 / (t_delta or 1e-9) }
+
+    # the time for reading is contained in the other numbers
+    for name, func in algorithms[1:]:
+        r[name]['seconds_without_read'] = max(0, r[name]['seconds'] - r['read']['seconds'])
+    return r
+
+
+def bench_btih(path, chunk_size, rounds=100):
+    """time calc_btih() on a filled HashBag"""
+    hb = make_hasheable(path, chunk_size=chunk_size).hb
+    hb.fill(quiet=True)
+    t_start = time.time()
+    for i in range(rounds):
+        hb.calc_btih()
+    t_delta = time.time() - t_start
+    return { 'pieces': len(hb.pieces) // mb.hashes.SHA1_DIGESTSIZE,
+             'seconds_per_call': t_delta / rounds }
+
+
+def bench_db(conn, path, chunk_size, nfiles=100):
+    """time the database write path for the hashes of nfiles files like
+    path: building the row values, the multi-row INSERT, and executing it
+    into a temporary copy of the hash table (in a transaction that is rolled
+    back)"""
+
+    h = make_hasheable(path, chunk_size=chunk_size, do_zsync_hashes=True)
+    h.hb.fill(quiet=True)
+
+    batch = mb.hashes.DbBatch(conn, max_rows=nfiles + 1, max_bytes=1 << 62)
+    t_start = time.time()
+    for i in range(nfiles):
+        batch.add(h.src_rel, i + 1, False, h.hash_values())
+    t_values = time.time() - t_start
+
+    c = mb.hashes.get_cursor(conn)
+    t_start = time.time()
+    statement = batch.insert_statement(c, table='hash_bench')
+    t_statement = time.time() - t_start
+
+    c.execute('BEGIN')
+    c.execute('CREATE TEMPORARY TABLE hash_bench (LIKE hash)')
+    t_start = time.time()
+    c.execute(statement)
+    t_execute = time.time() - t_start
+    c.execute('ROLLBACK')
+
+    return { 'files': nfiles,
+             'statement_bytes': len(statement),
+             'values_seconds': t_values,
+             'statement_seconds': t_statement,
+             'execute_seconds': t_execute }
+
+
+def bench_queries(conn, path, mirror_id, rounds=1000):
+    """time the lookups that mb runs most often, as ad-hoc queries with
+    interpolated values (as mb did before) and as prepared statements"""
+    import mb.dal
+
+    dal = mb.dal.get_dal(conn)
+    directory = os.path.dirname(path)
+    dir_regexp = '^' + mb.util.pgsql_regexp_esc(directory) + '/[^/]*$'
+
+    queries = [
+        ('has_file',
+         lambda: conn.Server._connection.queryAll(
+             "SELECT path FROM filearr WHERE path = '%s' AND %s = ANY(mirrors)" 
+             % (path, mirror_id)),
+         lambda: dal.query('has_file', path, mirror_id)),
+        ('filearr_id',
+         lambda: conn.Server._connection.queryAll(
+             "SELECT id FROM filearr WHERE path = '%s' LIMIT 1" % path),
+         lambda: dal.query('filearr_id', path)),
+        ('dir_filelist',
+         lambda: conn.Server._connection.queryAll(
+             """SELECT filearr.path, hash.file_id FROM filearr
+                LEFT JOIN hash ON hash.file_id = filearr.id
+                WHERE filearr.path ~ '%s'""" % dir_regexp),
+         lambda: dal.query('dir_filelist', directory)),
+    ]
+
+    results = {}
+    for name, adhoc, prepared in queries:
+        r = {}
+        for kind, func in (('adhoc', adhoc), ('prepared', prepared)):
+            func()
+            t_start = time.time()
+            for i in xrange(rounds):
+                func()
+            r[kind + '_ms'] = (time.time() - t_start) * 1000 / rounds
+        results[name] = r
+    dal.commit()
+
+    return { 'path': path, 'mirror_id': mirror_id, 'rounds': rounds,
+             'queries': results }
+
+
+def bench_dirs(conn, npaths=10000000, rounds=20, verbose=False):
+    """time listing a directory, and matching a subtree, on a temporary
+    table of npaths synthetic paths (100 top directories with 100
+    subdirectories each), once with only the unique index on path (the
+    regexp and LIKE queries that mb used before), and once with the indexes
+    on mb_dirname(path) and on path text_pattern_ops"""
+    import random
+
+    c = mb.hashes.get_cursor(conn)
+    ntop = 100
+    nsub = 100
+    per_dir = max(1, npaths // (ntop * nsub))
+
+    def timed(query, args, n):
+        c.execute('EXPLAIN ' + query, args)
+        plan = c.fetchall()[0][0].strip()
+        t_start = time.time()
+        for i in xrange(n):
+            c.execute(query, args)
+            c.fetchall()
+        return { 'ms': (time.time() - t_start) * 1000 / n, 'plan': plan }
+
+    r = random.Random(0)
+    dirs = [ 'd%d/s%d' % (r.randrange(ntop), r.randrange(nsub)) 
+             for i in range(rounds) ]
+    tops = [ d.split('/')[0] for d in dirs ]
+
+    def run():
+        res = {}
+        for name, query, args in [
+            ('dir_regexp', 
+             "SELECT path FROM filearr_bench WHERE path ~ %s",
+             lambda d, t: ['^' + mb.util.pgsql_regexp_esc(d) + '/[^/]*$']),
+            ('dir_dirname', 
+             "SELECT path FROM filearr_bench WHERE mb_dirname(path) = %s",
+             lambda d, t: [d]),
+            ('subtree_like', 
+             "SELECT count(*) FROM filearr_bench WHERE path LIKE %s",
+             lambda d, t: [t + '/%']),
+            ]:
+            times = [ timed(query, args(d, t), 1) for d, t in zip(dirs, tops) ]
+            res[name] = { 'ms': sum([ i['ms'] for i in times ]) / len(times),
+                          'plan': times[0]['plan'] }
+        return res
+
+    c.execute('BEGIN')
+    try:
+        if verbose:
+            print >>sys.stderr, 'creating %d paths' % (ntop * nsub * per_dir)
+        c.execute("""CREATE TEMPORARY TABLE filearr_bench 
+                     (path varchar(512) NOT NULL, mirrors smallint[])""")
+        t_start = time.time()
+        c.execute("""INSERT INTO filearr_bench (path, mirrors)
+                     SELECT 'd' || (i / %s) || '/s' || (i / %s %% %s) || '/f' || i, 
+                            ARRAY[1, 2, 3]::smallint[]
+                     FROM generate_series(0, %s) AS i""",
+                  [nsub * per_dir, per_dir, nsub, ntop * nsub * per_dir - 1])
+        c.execute('CREATE UNIQUE INDEX filearr_bench_path_key ON filearr_bench (path)')
+        c.execute('ANALYZE filearr_bench')
+        t_setup = time.time() - t_start
+
+        if verbose:
+            print >>sys.stderr, 'timing without the new indexes'
+        before = run()
+
+        t_start = time.time()
+        c.execute('CREATE INDEX filearr_bench_dirname_key ON filearr_bench (mb_dirname(path))')
+        t_dirname_index = time.time() - t_start
+        t_start = time.time()
+        c.execute('CREATE INDEX filearr_bench_path_pattern_key ON filearr_bench (path text_pattern_ops)')
+        t_pattern_index = time.time() - t_start
+        c.execute('ANALYZE filearr_bench')
+
+        if verbose:
+            print >>sys.stderr, 'timing with the new indexes'
+        after = run()
+    finally:
+        c.execute('ROLLBACK')
+
+    return { 'paths': ntop * nsub * per_dir,
+             'files_per_dir': per_dir,
+             'rounds': rounds,
+             'setup_seconds': t_setup,
+             'dirname_index_seconds': t_dirname_index,
+             'pattern_index_seconds': t_pattern_index,
+             'before': before,
+             'after': after }
+
+
+def bench_mirrorbits(conn, nfiles=100000, nmirrors=300, nops=1000, 
+                     verbose=False):
+    """compare the mirror sets of files kept as mirrors arrays alone with
+    keeping the bitmaps (filearr.mirrorbits) along with them, on a temporary
+    table of nfiles files that are each on a random half of nmirrors mirrors:
+    the throughput of adding and removing a mirror for single files (as
+    mirr_add_byid and mirr_del_byid do it, updating both columns when the
+    bitmaps are enabled), the size of the column, and counting the files of
+    a mirror. The functions of the mirrorbits column need to be installed."""
+    import random
+
+    c = mb.hashes.get_cursor(conn)
+    r = random.Random(0)
+    mirror_id = nmirrors // 2
+    ids = [ r.randrange(nfiles) + 1 for i in xrange(nops) ]
+
+    updates = {
+        'array': ("""UPDATE mirrors_bench SET mirrors = array_append(mirrors, %(mirror)s::smallint)
+                     WHERE id = %(id)s AND NOT %(mirror)s = ANY(mirrors)""",
+                  """UPDATE mirrors_bench SET mirrors = ARRAY(
+                         SELECT mirrors[i] 
+                         FROM generate_series(array_lower(mirrors, 1), array_upper(mirrors, 1)) AS i
+                         WHERE mirrors[i] <> %(mirror)s)
+                     WHERE id = %(id)s AND %(mirror)s = ANY(mirrors)"""),
+        'bitmap': ("""UPDATE mirrors_bench SET mirrors = array_append(mirrors, %(mirror)s::smallint),
+                             mirrorbits = mb_mirrorbits_set(mirrorbits, %(mirror)s, 1)
+                      WHERE id = %(id)s AND NOT %(mirror)s = ANY(mirrors)""",
+                   """UPDATE mirrors_bench SET mirrors = ARRAY(
+                             SELECT mirrors[i] 
+                             FROM generate_series(array_lower(mirrors, 1), array_upper(mirrors, 1)) AS i
+                             WHERE mirrors[i] <> %(mirror)s),
+                             mirrorbits = mb_mirrorbits_set(mirrorbits, %(mirror)s, 0)
+                      WHERE id = %(id)s AND %(mirror)s = ANY(mirrors)"""),
+    }
+    counts = {
+        'array': 'SELECT count(*) FROM mirrors_bench WHERE %(mirror)s = ANY(mirrors)',
+        'bitmap': 'SELECT count(*) FROM mirrors_bench WHERE mb_mirrorbits_has(mirrorbits, %(mirror)s)',
+    }
+    columns = { 'array': 'mirrors', 'bitmap': 'mirrorbits' }
+
+    c.execute('BEGIN')
+    try:
+        if verbose:
+            print >>sys.stderr, 'creating %d files on %d mirrors' % (nfiles, nmirrors)
+        # (the reference to f makes the subquery run again for each file)
+        c.execute("""CREATE TEMPORARY TABLE mirrors_bench AS
+                     SELECT f AS id, 
+                            ARRAY(SELECT m::smallint FROM generate_series(1, %s) AS m
+                                  WHERE random() < 0.5 AND f > 0) AS mirrors
+                     FROM generate_series(1, %s) AS f""", [nmirrors, nfiles])
+        c.execute('ALTER TABLE mirrors_bench ADD COLUMN mirrorbits varbit')
+        c.execute('UPDATE mirrors_bench SET mirrorbits = mb_mirrorbits(mirrors)')
+        c.execute('ALTER TABLE mirrors_bench ADD PRIMARY KEY (id)')
+        c.execute('ANALYZE mirrors_bench')
+
+        results = {}
+        for layout in ['array', 'bitmap']:
+            if verbose:
+                print >>sys.stderr, 'timing the %s layout' % layout
+            add, delete = updates[layout]
+            res = {}
+            c.execute('SELECT avg(pg_column_size(%s)) FROM mirrors_bench' % columns[layout])
+            res['avg_column_bytes'] = float(c.fetchone()[0])
+
+            for name, statement in [('del', delete), ('add', add)]:
+                t_start = time.time()
+                for i in ids:
+                    c.execute(statement, { 'mirror': mirror_id, 'id': i })
+                res[name + '_per_second'] = nops / (time.time() - t_start)
+
+            t_start = time.time()
+            c.execute(counts[layout], { 'mirror': mirror_id })
+            res['nfiles'] = c.fetchone()[0]
+            res['count_seconds'] = time.time() - t_start
+            results[layout] = res
+    finally:
+        c.execute('ROLLBACK')
+
+    return { 'files': nfiles, 'mirrors': nmirrors, 'operations': nops,
+             'layouts': results }
+
+
+def bench_hashes(sizes, chunk_size=mb.hashes.DEFAULT_PIECESIZE,
+                 tmpdir=None, conn=None, verbose=False):
+    """run the benchmark suite on synthetic files of the given sizes, and
+    return the results as a dictionary"""
+    import tempfile
+    import shutil
+    import platform
+
+    results = { 'python': platform.python_version(),
+                'chunk_size': chunk_size,
+                'fill': [],
+                'algorithms': [],
+                'calc_btih': [],
+                'db': [] }
+
+    workdir = tempfile.mkdtemp(prefix='mb-bench-', dir=tmpdir)
+    try:
+        for size in sizes:
+            path = os.path.join(workdir, 'file-%s' % size)
+            if verbose:
+                sys.stderr.write('creating %s byte file\n' % size)
+            make_file(path, size)
+
+            for do_chunked_hashes in (False, True):
+                for do_zsync_hashes in (False, True):
+                    if verbose:
+                        sys.stderr.write('fill(): size %s, chunked %s, zsync %s\n'
+                                         % (size, do_chunked_hashes, do_zsync_hashes))
+                    results['fill'].append(run_forked(bench_fill, path,
+                                                      do_chunked_hashes,
+                                                      do_zsync_hashes,
+                                                      chunk_size))
+
+            if verbose:
+                sys.stderr.write('hash functions: size %s\n' % size)
+            r = bench_algorithms(path, chunk_size)
+            r['size'] = size
+            results['algorithms'].append(r)
+
+            r = bench_btih(path, chunk_size)
+            r['size'] = size
+            results['calc_btih'].append(r)
+
+            if conn:
+                if verbose:
+                    sys.stderr.write('database: size %s\n' % size)
+                r = bench_db(conn, path, chunk_size)
+                r['size'] = size
+                results['db'].append(r)
+
+            os.unlink(path)
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+
+def main(argv):
+    import optparse
+
+    if argv and argv[0] == 'hashes':
+        import json
+        parser = optparse.OptionParser(usage='%prog hashes [options]')
+        parser.add_option('--sizes', default='16M,256M',
+                          help='comma separated sizes of the test files (default: %default)')
+        parser.add_option('--chunk-size', type='int', metavar='N',
+                          default=mb.hashes.DEFAULT_PIECESIZE,
+                          help='chunk size in bytes (default: %default)')
+        parser.add_option('--tmpdir',
+                          help='directory to create the test files in')
+        opts, args = parser.parse_args(argv[1:])
+        r = bench_hashes([ mb.util.parse_size(i) for i in opts.sizes.split(',') ],
+                         chunk_size=opts.chunk_size, tmpdir=opts.tmpdir,
+                         verbose=True)
+        print json.dumps(r, indent=2, sort_keys=True)
+        return
+
+    parser = optparse.OptionParser(usage='%prog [options] FILE...')
+    parser.add_option('--zsync', action='store_true',
+                      help='also compute zsync checksums')
+    parser.add_option('--no-pieces', action='store_true',
+                      help='don\'t compute chunked (piece-wise) hashes')
+    parser.add_option('--chunk-size', type='int', metavar='N',
+                      default=mb.hashes.DEFAULT_PIECESIZE,
+                      help='chunk size in bytes (default: %default)')
+    opts, args = parser.parse_args(argv)
+    if not args:
+        parser.error('no files given')
+
+    total_size = total_time = 0
+    for path in args:
+        size, t = time_fill(path, do_chunked_hashes=not opts.no_pieces,
+                            do_zsync_hashes=opts.zsync,
+                            chunk_size=opts.chunk_size)
+        total_size += size
+        total_time += t
+        print '%-50s %8.1f MB  %6.2f s  %6.3f GB/s' \
+                % (path, size / 1e6, t, size / 1e9 / (t or 1e-9))
+
+    if len(args) > 1:
+        print '%-50s %8.1f MB  %6.2f s  %6.3f GB/s' \
+                % ('total', total_size / 1e6, total_time,
+                   total_size / 1e9 / (total_time or 1e-9))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -6,11 +6,18 @@ import re
 import mb.mberr
 
 
-boolean_opts = [ 'zsync_hashes', 'chunked_hashes' ]
+boolean_opts = [ 'zsync_hashes', 'chunked_hashes', 'hash_files', 
+                 'hash_dropbehind', 'mirror_bitmaps' ]
 
 DEFAULTS = { 'zsync_hashes': False,
              'chunked_hashes': True,
              'chunk_size': 262144,
+             'max_pieces': 0,
+             'hash_files': False,
+             'hash_readahead': 0,
+             'hash_dropbehind': False,
+             'mirror_bitmaps': False,
+             'scan_snapshot_dir': None,
              'apache_documentroot': None}
 
 class Config:
@@ -81,6 +88,8 @@ class Config:
                     self.general[i][d] = DEFAULTS[d]
 
             self.general[i]['chunk_size'] = int(self.general[i]['chunk_size'])
+            self.general[i]['hash_readahead'] = int(self.general[i]['hash_readahead'])
+            self.general[i]['max_pieces'] = int(self.general[i]['max_pieces'])
             if self.general[i]['zsync_hashes']:
                 # must be a multiple of 2048 and 4096 for zsync checksumming
                 assert self.general[i]['chunk_size'] % 4096 == 0
@@ -326,6 +326,9 @@ class Conn:
                     idName = 'file_id'
             self.Hash = Hash
 
+        # whether lookups use filearr.mirrorbits instead of filearr.mirrors
+        self.mirror_bitmaps = config.get('mirror_bitmaps', False)
+
         if debug:
             self.Server._connection.debug = True
 
@@ -25,6 +25,6 @@ def delete_mirror(conn, mirror):
 
 
 def mirror_get_nfiles(conn, mirror):
-    query = """SELECT mirr_get_nfiles(%d)""" % (mirror.id)
-    return conn.Server._connection.queryAll(query)[0]
+    import mb.files
+    return mb.files.mirror_get_nfiles(conn, mirror.id)
 
@@ -1 +1,79 @@
 __all__ = ['http', 'rsync', 'ftp']
+
+from collections import namedtuple
+
+# a file found on a mirror: path relative to the base URL, size in bytes,
+# modification time (seconds since the epoch). size and mtime are None
+# where the listing doesn't tell.
+Entry = namedtuple('Entry', 'path size mtime')
+
+
+class Fingerprints:
+    """fingerprints of the directories of a mirror, to skip listing the ones
+    that didn't change since the last scan
+
+    A fingerprint is a tuple of (mtime, number of entries, hash of the entry
+    names, time of the listing), keyed by the path of the directory relative
+    to the base URL of the mirror, with a trailing slash ('' being the base
+    URL itself). old are the fingerprints of the last scan; new collects
+    those of this scan, and keeps the old ones of the directories that
+    weren't listed.
+
+    A crawler that sees the mtimes of subdirectories in a listing asks
+    skip() whether a subdirectory needs to be listed, and reports each
+    listing to record(). A directory is skipped (pruned) only if it had no
+    subdirectories when it was listed last, and its mtime is the same and
+    more than a day older than that listing (the listings give mtimes to the
+    minute, or in local time). Its files are then the same as in the last
+    scan.
+
+    If a directory is listed again with the same mtime, but other entries,
+    its mtime doesn't follow its changes (as on some servers). Its time of
+    listing is then stored as unknown, and it isn't skipped anymore.
+
+    prefix is the directory that the crawled URL points to, if it isn't the
+    base URL of the mirror."""
+
+    def __init__(self, old=None, prefix=''):
+        import time
+        self.started = int(time.time())
+        self.old = old or {}
+        self.prefix = prefix
+        self.new = dict([ (p, f) for p, f in self.old.iteritems()
+                          if not p.startswith(prefix) ])
+        self.pruned = set()
+        self.listed = 0
+        self.mtimes = {}
+        parents = set([ p[:-1].rsplit('/', 1)[0] + '/' for p in self.old if '/' in p[:-1] ])
+        parents.add('')
+        self.leaves = set([ p for p in self.old if p not in parents ])
+
+    def skip(self, path, mtime):
+        """return True if the subdirectory at path (relative to the crawled
+        URL, with a trailing slash) with the given mtime can be skipped"""
+        path = self.prefix + path
+        self.mtimes[path] = mtime
+        f = self.old.get(path)
+        if f is None or mtime is None or f[0] != mtime \
+                or path not in self.leaves \
+                or f[3] is None or mtime > f[3] - 86400:
+            return False
+        self.pruned.add(path)
+        self.new[path] = f
+        return True
+
+    def record(self, path, names):
+        """record the names of the entries (subdirectories with a trailing
+        slash) listed in the directory at path"""
+        import hashlib
+        path = self.prefix + path
+        mtime = self.mtimes.pop(path, None)
+        h = hashlib.md5('\n'.join(sorted(names))).hexdigest()
+        taken = self.started
+        f = self.old.get(path)
+        if f is not None and (f[3] is None
+                              or (mtime is not None and f[0] == mtime
+                                  and (f[1], f[2]) != (len(names), h))):
+            taken = None
+        self.new[path] = (mtime, len(names), h, taken)
+        self.listed += 1
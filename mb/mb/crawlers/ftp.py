@@ -1,113 +1,379 @@
 #!/usr/bin/python
 
-import os
+"""
+List the files on a mirror via FTP.
+
+Several control connections to the host list directories in parallel, and
+the files are returned as a stream of mb.crawlers.Entry tuples, like the
+other crawlers do:
+
+    for entry in mb.crawlers.ftp.gen_filelist('ftp://host/pub/', connections=4):
+        print entry.path, entry.size, entry.mtime
+
+Servers that advertise MLST in their FEAT reply are listed with MLSD, which
+gives exact sizes and modification times. Otherwise, the output of LIST is
+parsed, in the Unix ls -l format or the DOS format of IIS.
+
+Symbolic links are ignored. Some servers don't tell them apart from
+directories in MLSD; those directories are entered only once (by their
+"unique" fact), so that links can't make the crawler loop. Of the paths
+that lead to the same directory, the one closest to the top is listed, and
+of those at the same depth the (byte-wise) smallest.
+"""
+
+import re
 import sys
+import time
 import socket
+import ftplib
+import urllib
 import urlparse
-from ftplib import FTP
+import calendar
+import threading
+import Queue
 
+import mb.mberr
 from mb.util import Afile
-from mb.mberr import *
+from mb.crawlers import Entry
 
 
 DEBUG = 0
 socket.setdefaulttimeout(120)
 
+_months = dict([ (m, i + 1) for i, m in
+                 enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                            'jul', 'aug', 'sep', 'oct', 'nov', 'dec']) ])
 
-def line2File(line):
-    """parse line from FTP LIST reply and return the filename
-    
-    Most FTP servers send lines with 9 parts, where the last is the filename
-    (and the name could have spaces...)
-    
-    Some servers return one part less"""
-    parts = line.split()
-    if len(parts) == 9:
-        name = parts[8]
-        size = parts[4]
-    elif len(parts) == 8:
-        name = parts[7]
-        size = parts[3]
-    else:
-        raise Exception('haeh? could not parse line from FTP listing')
-    return Afile(name, size)
+# -rw-r--r--   1 ftp  ftp  4405843968 Sep 27 17:50 name with spaces
+# -rw-r--r--   1 ftp       4405843968 Sep 27  2007 name (no group)
+_unix = re.compile(r"""
+    ^(?P<mode>[-dlbcps][-rwxsStTlL]{9})\S*\s+
+    \d+\s+
+    (?:\S+\s+){1,2}?
+    (?P<size>\d+)\s+
+    (?P<mon>[A-Za-z]{3})\s+(?P<day>\d{1,2})\s+
+    (?:(?P<hour>\d{1,2}):(?P<min>\d\d)|(?P<year>\d{4}))\s
+    (?P<name>.+)$
+    """, re.X)
 
+# 09-27-07  05:50PM       <DIR>          name
+# 09-27-07  05:50PM           4405843968 name
+_dos = re.compile(r"""
+    ^(?P<mon>\d\d)-(?P<day>\d\d)-(?P<year>\d\d(?:\d\d)?)\s+
+    (?P<hour>\d\d):(?P<min>\d\d)(?P<ampm>[AP]M)?\s+
+    (?:(?P<dir><DIR>)|(?P<size>\d+))\s+
+    (?P<name>.+)$
+    """, re.X)
 
-def gen_ftp(url):
-    """connect to FTP server and return an iterator of found files
-    below the given url"""
 
-    (scheme, host, start_dir, params, query, fragment) = urlparse.urlparse(url)
-    if ':' in host:
-        host, port = host.split(':')
-    else:
-        port = 21
+def parse_list_line(line, now=None):
+    """parse a line of LIST output and return a tuple of (type, name, size,
+    mtime, unique), where type is 'file', 'dir' or 'other', or None if the
+    line can't be parsed (like the 'total' line). unique identifies a
+    directory entry on the server; LIST doesn't tell it, so it is None."""
+
+    m = _unix.match(line)
+    if m:
+        mode = m.group('mode')[0]
+        name = m.group('name')
+        if mode == '-':
+            t = 'file'
+        elif mode == 'd':
+            t = 'dir'
+        else:
+            t = 'other'
+        mon = _months.get(m.group('mon').lower())
+        mtime = None
+        if mon:
+            day = int(m.group('day'))
+            if m.group('year'):
+                mtime = calendar.timegm((int(m.group('year')), mon, day, 0, 0, 0, 0, 0, 0))
+            else:
+                # within the last 6 months, so it's this year or the last
+                now = now or time.time()
+                year = time.gmtime(now).tm_year
+                mtime = calendar.timegm((year, mon, day,
+                                         int(m.group('hour')), int(m.group('min')), 0,
+                                         0, 0, 0))
+                if mtime > now + 86400:
+                    mtime = calendar.timegm((year - 1, mon, day,
+                                             int(m.group('hour')), int(m.group('min')), 0,
+                                             0, 0, 0))
+        return t, name, int(m.group('size')), mtime, None
+
+    m = _dos.match(line)
+    if m:
+        year = int(m.group('year'))
+        if year < 100:
+            year += year < 70 and 2000 or 1900
+        hour = int(m.group('hour'))
+        if m.group('ampm'):
+            hour = hour % 12 + (m.group('ampm') == 'PM' and 12 or 0)
+        mtime = calendar.timegm((year, int(m.group('mon')), int(m.group('day')),
+                                 hour, int(m.group('min')), 0, 0, 0, 0))
+        if m.group('dir'):
+            return 'dir', m.group('name'), None, mtime, None
+        return 'file', m.group('name'), int(m.group('size')), mtime, None
 
-    ftp = FTP()
+    return None
+
+
+def parse_mlsd_line(line):
+    """parse a line of MLSD output and return a tuple like
+    parse_list_line() does"""
 
     try:
-        ftp.connect(host, port)
+        facts, name = line.split(' ', 1)
+    except ValueError:
+        return None
+    f = {}
+    for fact in facts.split(';'):
+        if '=' in fact:
+            k, v = fact.split('=', 1)
+            f[k.lower()] = v
+    t = f.get('type', '').lower()
+    if t in ('cdir', 'pdir'):
+        return None
+    if t not in ('file', 'dir') or 'slink' in f.get('unix.mode', '') \
+            or f.get('os.unix', '').startswith('slink'):
+        t = 'other'
+    size = f.get('size')
+    if size is not None:
+        size = int(size)
+    mtime = None
+    modify = f.get('modify')
+    if modify and len(modify) >= 14:
+        mtime = calendar.timegm((int(modify[0:4]), int(modify[4:6]), int(modify[6:8]),
+                                 int(modify[8:10]), int(modify[10:12]), int(modify[12:14]),
+                                 0, 0, 0))
+    return t, name, size, mtime, f.get('unique')
+
+
+class _Refused(Exception):
+    pass
+
 
-        ftp.login()
+class _Lister(threading.Thread):
+    """list directories from a queue over one FTP control connection, and
+    put the results into another queue"""
+
+    def __init__(self, host, port, user, passwd, base, todo, results, timeout):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.host, self.port = host, port
+        self.user, self.passwd = user, passwd
+        self.base = base
+        self.todo = todo
+        self.results = results
+        self.timeout = timeout
+        self.ftp = None
+        self.mlsd = False
+
+    def connect(self):
+        ftp = ftplib.FTP(timeout=self.timeout)
         if DEBUG:
             ftp.set_debuglevel(2)
-        welcome = ftp.getwelcome()
-        if DEBUG:
-            print '--- welcome:'
-            print welcome
-
-        # queue of directories to look into
-        queue = [start_dir]
-        directory = start_dir
-        #print '--> changing to', directory
-        #ftp.cwd(directory)
-
-
-        # walk directories non-recursively
-        # http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/435875
-        while len(queue) > 0:
-            if DEBUG:
-                print 'still %s directories to do' % len(queue)
-
-            directory = queue.pop(0)
-
-            listing = []
-            ftp.dir(directory, listing.append)
-
-            if DEBUG:
-                print 'entering directory', directory
-
-            if DEBUG:
-                print '--- listing:'
-                print '\n'.join(listing)
-                print '---'
-
-            if DEBUG:
-                print 'files: ', len(listing)
-            for line in listing:
-                
-                if line.startswith('-'):
-                    f = line2File(line)
-                    f.path = os.path.join(directory[len(start_dir):], f.name)
-                    yield f
-
-                elif line.startswith('d'):
-                    dirname = line2File(line).name
-                    if dirname in ['.', '..']:
-                        continue
-                    dirname2 = os.path.join(start_dir, directory, dirname)
-                    if DEBUG:
-                        print 'directory name:', dirname2
-                    queue.append(dirname2)
+        try:
+            ftp.connect(self.host, self.port)
+            ftp.login(self.user, self.passwd)
+        except ftplib.all_errors, e:
+            # servers with too many connections answer 421, or just hang up
+            ftp.close()
+            raise _Refused(str(e) or 'connection closed')
+        self.ftp = ftp
+        try:
+            feat = self.ftp.sendcmd('FEAT')
+            self.mlsd = 'MLST' in feat.upper()
+        except ftplib.error_perm:
+            self.mlsd = False
 
-                elif line.startswith('l'):
+    def list(self, path):
+        """list a directory, reconnecting once if the connection broke"""
+        for attempt in (1, 2):
+            if self.ftp is None:
+                self.connect()
+            try:
+                self.ftp.cwd(path)
+                lines = []
+                if self.mlsd:
+                    self.ftp.retrlines('MLSD', lines.append)
+                    return [ parse_mlsd_line(l) for l in lines ]
+                else:
+                    self.ftp.retrlines('LIST', lines.append)
+                    return [ parse_list_line(l) for l in lines ]
+            except ftplib.error_perm:
+                raise
+            except ftplib.all_errors:
+                self.close()
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        if self.ftp:
+            try:
+                self.ftp.quit()
+            except ftplib.all_errors:
+                self.ftp.close()
+        self.ftp = None
+
+    def run(self):
+        while True:
+            d = self.todo.get()
+            if d is None:
+                break
+            try:
+                items = self.list(self.base + d)
+                files = []
+                dirs = []
+                for item in items:
+                    if item is None:
+                        continue
+                    t, name, size, mtime, unique = item
+                    if name in ('.', '..') or '/' in name:
+                        continue
+                    if t == 'file':
+                        files.append((name, size, mtime))
+                    elif t == 'dir':
+                        dirs.append((name, unique, mtime))
                     # we ignore links
-                    pass
+                self.results.put((d, (files, dirs), None, False))
+            except (_Refused, ftplib.error_temp), e:
+                if isinstance(e, ftplib.error_temp) and str(e)[:3] not in ('421', '425'):
+                    self.results.put((d, None, str(e), False))
+                    continue
+                # too many connections; leave the directory to the others
+                self.results.put((d, None, str(e), True))
+                break
+            except ftplib.all_errors, e:
+                self.results.put((d, None, str(e) or 'connection closed', False))
+        self.close()
+
+
+def gen_filelist(url, connections=4, timeout=120, verbose=False, exclude=None,
+                 fingerprints=None):
+    """list the directories below url over several control connections, and
+    return an iterator of the files found (as Entry tuples)
+
+    Raises mb.mberr.CrawlError if a directory can't be listed, since a
+    listing with a subtree missing would make its files look deleted. When
+    the server has too many connections (it refuses one, or answers 421 or
+    425), the directory is listed over the remaining connections instead,
+    or, if it was the last one, over a new one after a pause.
+
+    exclude can be a function that is called with the path of each
+    subdirectory (relative to url, with a trailing slash); directories for
+    which it returns True are not listed.
+
+    With fingerprints (a mb.crawlers.Fingerprints), directories that didn't
+    change since the last scan are not listed either, and the fingerprints
+    of the others are recorded."""
 
-        ftp.quit()
+    u = urlparse.urlparse(url)
+    host = u.hostname
+    port = u.port or 21
+    user = u.username and urllib.unquote(u.username) or 'anonymous'
+    passwd = u.password and urllib.unquote(u.password) or 'anonymous@'
+    base = urllib.unquote(u.path) or '/'
+    if not base.endswith('/'):
+        base += '/'
 
-    except socket.error, e:
-        raise SocketError(url, e.__str__())
+    # Queue.Queue keeps its items in a deque
+    todo = Queue.Queue()
+    results = Queue.Queue()
+    threads = [ _Lister(host, port, user, passwd, base, todo, results, timeout)
+                for i in range(connections) ]
+    for t in threads:
+        t.start()
 
+    alive = len(threads)
+    retries = 0
+    listed = 0
+    # number of directories being listed, by depth
+    pending = {}
+    # subdirectories with a "unique" fact, by depth: unique -> (path, mtime).
+    # They are queued only when all directories above them have been listed,
+    # so that it doesn't depend on the order of the listings which of the
+    # paths to a directory is taken.
+    held = {}
+    seen = set()
 
+    def queue(d):
+        depth = d.count('/')
+        pending[depth] = pending.get(depth, 0) + 1
+        todo.put(d)
+
+    def done(d):
+        depth = d.count('/')
+        pending[depth] -= 1
+        if not pending[depth]:
+            del pending[depth]
+
+    try:
+        queue('')
+        while pending:
+            d, r, err, refused = results.get()
+            done(d)
+            if err:
+                if not refused:
+                    raise mb.mberr.CrawlError(url, '%s: %s' % (base + d, err))
+                alive -= 1
+                if not alive:
+                    retries += 1
+                    if not listed or retries > 3:
+                        raise mb.mberr.CrawlError(url, '%s: %s' % (base + d, err))
+                    time.sleep(retries * 10)
+                    t = _Lister(host, port, user, passwd, base, todo, results, timeout)
+                    threads.append(t)
+                    t.start()
+                    alive += 1
+                if verbose:
+                    print >>sys.stderr, '%s: %s, %d connection(s) left' % (url, err, alive)
+                queue(d)
+                continue
+            listed += 1
+            files, subdirs = r
+            if fingerprints:
+                fingerprints.record(d, [ name for name, size, mtime in files ] + 
+                                       [ name + '/' for name, unique, mtime in subdirs ])
+            for name, unique, mtime in subdirs:
+                path = d + name + '/'
+                if exclude and exclude(path):
+                    continue
+                if unique:
+                    h = held.setdefault(path.count('/'), {})
+                    if unique not in h or path < h[unique][0]:
+                        h[unique] = (path, mtime)
+                    continue
+                if fingerprints and fingerprints.skip(path, mtime):
+                    continue
+                queue(path)
+            for depth in sorted(held):
+                if [ i for i in pending if i < depth ]:
+                    break
+                for unique, (path, mtime) in sorted(held.pop(depth).items()):
+                    if unique in seen:
+                        continue
+                    seen.add(unique)
+                    if fingerprints and fingerprints.skip(path, mtime):
+                        continue
+                    queue(path)
+            for name, size, mtime in files:
+                yield Entry(d + name, size, mtime)
+    finally:
+        try:
+            while True:
+                todo.get_nowait()
+        except Queue.Empty:
+            pass
+        for t in threads:
+            todo.put(None)
+
+
+def gen_ftp(url):
+    """connect to FTP server and return an iterator of found files
+    below the given url (as mb.util.Afile objects)"""
 
+    for entry in gen_filelist(url):
+        f = Afile(entry.path.rsplit('/', 1)[-1], entry.size or 0,
+                  mtime=entry.mtime or 0, path=entry.path)
+        yield f
@@ -1,106 +1,257 @@
+"""
+List the files on a mirror by crawling its HTTP directory indexes.
+
+Several threads fetch the directory indexes in parallel, each over its own
+keep-alive connection to the host, and the files are returned as a stream
+of mb.crawlers.Entry tuples, like the other crawlers do:
+
+    for entry in mb.crawlers.http.gen_filelist('http://host/pub/', concurrency=8):
+        print entry.path, entry.size, entry.mtime
+
+The index pages of Apache (mod_autoindex, plain or fancy), nginx and
+lighttpd (mod_dirlisting) are understood. Size and modification time are
+taken from them where they are given; sizes that are rounded (like 4.1G)
+are not exact and reported as None.
+"""
+
 import re
-from mechanize import Browser
-import mb.core 
+import socket
+import urllib
+import httplib
+import urlparse
+import calendar
+import threading
+import Queue
 
-_match_dir = re.compile(r"""
-            ^(?!(http|mailto|\?|/))     # doesn't start with http, mailto, 
-                                        # or slash (because that's the link to the 
-                                        # parent dir)
-            .*
-            /$                          # ends in a slash
-            """, re.X)
+import mb.core
+import mb.mberr
+from mb.crawlers import Entry
 
-_match_file = re.compile(r"""
-            ^(?!(http|mailto|\?|/))     # same as above
-            .*
-            [^/]$                       # ends not in a slash
-            """, re.X)
 
+_link = re.compile(r'<a\s[^>]*?href\s*=\s*["\']?([^"\' >]+)["\']?[^>]*>', re.I)
+_tag = re.compile(r'<[^>]*>')
 
-def get_filelist(start_url):
+_months = dict([ (m, i + 1) for i, m in
+                 enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                            'jul', 'aug', 'sep', 'oct', 'nov', 'dec']) ])
 
-    if not start_url.endswith('/'):
-        start_url += '/'
-    start_url_len = len(start_url)
+# Apache, nginx: 27-Sep-2007 17:50
+# Apache (newer): 2007-09-27 17:50
+# lighttpd: 2007-Sep-27 17:50:25
+_date = re.compile(r"""
+    (?:(?P<d1>\d\d)-(?P<m1>[A-Za-z]{3})-(?P<y1>\d{4})
+      |(?P<y2>\d{4})-(?P<m2>\d\d)-(?P<d2>\d\d)
+      |(?P<y3>\d{4})-(?P<m3>[A-Za-z]{3})-(?P<d3>\d\d))
+    \s+(?P<H>\d\d):(?P<M>\d\d)(?::(?P<S>\d\d))?
+    """, re.X)
+_size = re.compile(r'\s*(\d+(?:\.\d+)?)([KMGT]?)(?:i?B)?(?:\s|$)', re.I)
+_scheme = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]*:')
 
-    dirCollection = {}
+_entities = [ ('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'),
+              ('&#39;', "'"), ('&amp;', '&') ]
+
+
+def _unescape(s):
+    for e, c in _entities:
+        s = s.replace(e, c)
+    return s
+
+
+def _mtime(m):
+    if m.group('y1'):
+        y, mon, d = m.group('y1'), _months.get(m.group('m1').lower()), m.group('d1')
+    elif m.group('y2'):
+        y, mon, d = m.group('y2'), int(m.group('m2')), m.group('d2')
+    else:
+        y, mon, d = m.group('y3'), _months.get(m.group('m3').lower()), m.group('d3')
+    if not mon:
+        return None
+    # the listings don't say which time zone they are in; take it as UTC
+    return calendar.timegm((int(y), mon, int(d),
+                            int(m.group('H')), int(m.group('M')), int(m.group('S') or 0),
+                            0, 0, 0))
+
+
+def parse_index(html):
+    """parse a directory index page and return a tuple of (list of files,
+    list of subdirectories), where the files are tuples of (name, size,
+    mtime) and the subdirectories tuples of (name, mtime)"""
+
+    files = []
+    dirs = []
+    seen = set()
+    links = list(_link.finditer(html))
+    for n, link in enumerate(links):
+        href = _unescape(link.group(1))
+        # skip links to elsewhere, sorting links and anchors
+        if _scheme.match(href) or href[0] in '?/#':
+            continue
+        if href.startswith('./'):
+            href = href[2:]
+        if href in ('..', '../'):
+            continue
+        is_dir = href.endswith('/')
+        name = urllib.unquote(href.rstrip('/'))
+        if not name or '/' in name or name in seen:
+            continue
+        seen.add(name)
+
+        # what follows the link up to the next one has date and size
+        end = n + 1 < len(links) and links[n + 1].start() or len(html)
+        rest = _tag.sub(' ', html[link.end():end])
+        mtime = size = None
+        m = _date.search(rest)
+        if m:
+            mtime = _mtime(m)
+        if is_dir:
+            dirs.append((name, mtime))
+            continue
+        if m:
+            sm = _size.match(rest[m.end():])
+            if sm and not sm.group(2) and '.' not in sm.group(1):
+                size = int(sm.group(1))
+        files.append((name, size, mtime))
+
+    return files, dirs
+
+
+class _Fetcher(threading.Thread):
+    """fetch directory indexes from a queue over one keep-alive connection,
+    and put the results into another queue"""
 
-    directories_todo = [start_url]
-
-    # walk directories non-recursively
-    # http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/435875
-    while len(directories_todo) > 0:
-        print '+', len(dirCollection.keys())
-        print '-', len(directories_todo)
-        #if len(directories_todo) == 175:
-        #    return dirCollection, 'foo'
-
-
-        directory = directories_todo.pop()
-        #if '/drpmsync/' in directory or '/repositories' in directory:
-        #    print '>>>>>> skipping', directory
-        #    continue
-        print '>'
-        print directory
-
-        name = directory[start_url_len:].rstrip('/') or '.'
-        dirCollection[name] = mb.core.Directory(name)
-
-        br = Browser()
-        br.open(directory)
-
-        # found files
-        for i in br.links(url_regex = _match_file):
-            #if i.url.startswith('./'):
-            #    i.url = i.url[2:]
-            #print 'appending file', i.url
-            dirCollection[name].files.append(i.url)
-
-        found_dirs  = [ link.base_url + link.url.lstrip('./') for link in br.links(url_regex = _match_dir) ]
-        found_dirs = []
-        for link in br.links(url_regex = _match_dir):
-            if link.url.startswith('./'):
-                link.url = link.url[2:]
-            found_dirs.append(link.base_url + link.url)
-
-        print 'found_dirs:', found_dirs
-        #found_files = [ link.base_url + link.url for link in br.links(url_regex = _match_file) ]
-        #print 'found_files:', found_files
-        br.close()
-        
-        # found directories
-        for found_dir in found_dirs:
-            br = Browser()
-            br.open(found_dir)
-
-            name = found_dir[start_url_len:].rstrip('/')
-            print 'name:', name
-            dirCollection[name] = mb.core.Directory(name)
-
-            for i in br.links(url_regex = _match_file):
-                dirCollection[name].files.append(i.url)
-
-            for i in br.links(url_regex = _match_dir):
-                if i.url.startswith('./'):
-                    i.url = i.url[2:]
-                print 'neues todo:', i.base_url + i.url
-                directories_todo.append(i.base_url + i.url)
-
-            br.close()
-
-
-    del br
-
-    return dirCollection, 'foo'
-
-    #print 'directories:'
-    #for link in br.links(url_regex = _match_dir):
-    #    #print link
-    #    print link.base_url[start_url_len:] + link.url
-
-    #print
-    #print 'files:'
-    #for link in br.links(url_regex = _match_file):
-    #    #print link
-    #    print link.base_url[start_url_len:] + link.url
+    def __init__(self, scheme, host, port, base, todo, results, timeout):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.scheme, self.host, self.port = scheme, host, port
+        self.base = base
+        self.todo = todo
+        self.results = results
+        self.timeout = timeout
+        self.conn = None
+
+    def connect(self):
+        if self.scheme == 'https':
+            self.conn = httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        else:
+            self.conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def get(self, path):
+        """GET path, reconnecting once if the server closed the connection"""
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.connect()
+            try:
+                self.conn.request('GET', path, headers={ 'Accept-Encoding': 'identity',
+                                                         'User-Agent': 'mb' })
+                r = self.conn.getresponse()
+                body = r.read()
+                if r.getheader('connection', '').lower() == 'close':
+                    self.conn.close()
+                    self.conn = None
+                return r.status, body
+            except (httplib.HTTPException, socket.error):
+                self.conn.close()
+                self.conn = None
+                if attempt == 2:
+                    raise
+
+    def run(self):
+        while True:
+            d = self.todo.get()
+            if d is None:
+                break
+            path = urllib.quote(self.base + d)
+            try:
+                status, body = self.get(path)
+                if status != 200:
+                    self.results.put((d, None, 'HTTP status %s' % status))
+                else:
+                    self.results.put((d, parse_index(body), None))
+            except (httplib.HTTPException, socket.error), e:
+                self.results.put((d, None, str(e)))
+        if self.conn:
+            self.conn.close()
+
+
+def gen_filelist(url, concurrency=8, timeout=60, exclude=None, fingerprints=None):
+    """crawl the directory indexes below url and return an iterator of the
+    files found (as Entry tuples)
+
+    Raises mb.mberr.CrawlError if any index can't be fetched, since a
+    listing with a subtree missing would make its files look deleted.
+
+    exclude can be a function that is called with the path of each
+    subdirectory (relative to url, with a trailing slash); directories for
+    which it returns True are not listed.
+
+    With fingerprints (a mb.crawlers.Fingerprints), directories that didn't
+    change since the last scan are not listed either, and the fingerprints
+    of the others are recorded."""
+
+    scheme, netloc, base = urlparse.urlparse(url)[:3]
+    if ':' in netloc:
+        host, port = netloc.split(':', 1)
+        port = int(port)
+    else:
+        host, port = netloc, None
+    base = urllib.unquote(base)
+    if not base.endswith('/'):
+        base += '/'
+
+    todo = Queue.Queue()
+    results = Queue.Queue()
+    threads = [ _Fetcher(scheme, host, port, base, todo, results, timeout)
+                for i in range(concurrency) ]
+    for t in threads:
+        t.start()
+
+    try:
+        todo.put('')
+        pending = 1
+        while pending:
+            d, r, err = results.get()
+            pending -= 1
+            if err:
+                raise mb.mberr.CrawlError(url, '%s: %s' % (base + d, err))
+            files, subdirs = r
+            if fingerprints:
+                fingerprints.record(d, [ name for name, size, mtime in files ] + 
+                                       [ name + '/' for name, mtime in subdirs ])
+            for name, mtime in subdirs:
+                if exclude and exclude(d + name + '/'):
+                    continue
+                if fingerprints and fingerprints.skip(d + name + '/', mtime):
+                    continue
+                todo.put(d + name + '/')
+                pending += 1
+            for name, size, mtime in files:
+                yield Entry(d + name, size, mtime)
+    finally:
+        # drop what is left to do (if the consumer stopped early), and let
+        # the threads finish
+        try:
+            while True:
+                todo.get_nowait()
+        except Queue.Empty:
+            pass
+        for t in threads:
+            todo.put(None)
+
+
+def get_filelist(url):
+    """return a dictionary of mb.core.Directory objects with the files in
+    each directory, and an (empty) error string
+
+    This keeps the whole listing in memory; use gen_filelist() instead."""
+    import os
+
+    dirCollection = {}
+    for entry in gen_filelist(url):
+        d, p = os.path.split(entry.path)
+        if not d:
+            d = '.'
+        if d not in dirCollection:
+            dirCollection[d] = mb.core.Directory(d)
+        dirCollection[d].files.append(p)
 
+    return dirCollection, ''
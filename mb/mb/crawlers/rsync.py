@@ -1,69 +1,135 @@
+"""
+List the files on a mirror via rsync.
+
+The listing of "rsync -r" is read line by line as rsync produces it, and
+the files are returned as a stream of mb.crawlers.Entry tuples, so that
+memory usage doesn't grow with the size of the mirror:
+
+    for entry in mb.crawlers.rsync.gen_filelist('rsync://host/module/'):
+        print entry.path, entry.size, entry.mtime
+
+The paths can go straight into mb.files.apply_snapshot().
+"""
 
 import os
+import sys
+import time
+import tempfile
+import subprocess
+import urlparse
+
 import mb.core
+import mb.mberr
+from mb.crawlers import Entry
 
-# split lines, but take into account that filenames could contain spaces
-#
-# >>> a = '-rw-r--r--      4405843968 2007/09/27 17:50:25 distribution/10.3/iso/dvd/openSUSE-10.3-GM- DVD-i386.iso'
-# >>> a.split(None, 4)
-# ['-rw-r--r--', '4405843968', '2007/09/27', '17:50:25', 'distribution/10.3/iso/dvd/openSUSE-10.3-GM- DVD-i386.iso']
 
-def get_filelist(url):
-    import urlparse
-    import subprocess
+def parse_line(line):
+    """parse a line of the listing of rsync -r, and return a tuple of
+    (mode, size, mtime, name), or None if it isn't a listing line (like the
+    motd).
 
-    print url
+    Filenames can contain spaces, thus the line is split only 4 times:
+
+    >>> a = '-rw-r--r--      4405843968 2007/09/27 17:50:25 distribution/10.3/iso/dvd/openSUSE-10.3-GM- DVD-i386.iso'
+    >>> a.split(None, 4)
+    ['-rw-r--r--', '4405843968', '2007/09/27', '17:50:25', 'distribution/10.3/iso/dvd/openSUSE-10.3-GM- DVD-i386.iso']
+
+    Newer rsync versions group the digits of the size with commas.
+    """
+    try:
+        mode, size, date, clock, name = line.split(None, 4)
+        size = int(size.replace(',', ''))
+        # the time is local time of the client
+        mtime = int(time.mktime((int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                                 int(clock[0:2]), int(clock[3:5]), int(clock[6:8]),
+                                 0, 0, -1)))
+    except ValueError:
+        return None
+    if len(mode) != 10:
+        return None
+    return mode, size, mtime, name.rstrip('\r\n')
+
+
+def rsync_url(url):
+    """add the default port to an rsync:// URL without one"""
     url = list(urlparse.urlparse(url))
-    if not ':' in url[1]: url[1] += ':873'
-    url = urlparse.urlunparse(url)
-    print url
-    # old
-    ###  child_stdin, child_stdout, child_stderr = os.popen3(['rsync', '-r', url])
-    ###  #child_stdin, child_stdout, child_stderr = os.popen3(['cat', 'buildservice-repos.txt'])
-    ###  child_stdin.close()
-
-    ###  # new
-    ###  p = subprocess.Popen(cmd, shell=True, bufsize=bufsize, stdin=None, stdout=PIPE, stderr=PIPE, close_fds=True)
-    ###  (child_stdin, child_stdout, child_stderr) = (p.stdin, p.stdout, p.stderr)
-
-    # newer
-    o = subprocess.Popen(['rsync', '-r', url], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True).stdout
-    print 'done'
-    #import time
-    #time.sleep(100)
+    if url[0] == 'rsync' and not ':' in url[1]:
+        url[1] += ':873'
+    return urlparse.urlunparse(url)
 
-    dirCollection = {}
-    ###  for line in child_stdout:
-    for line in o.readlines():
-        print 'a line'
-        try:
-            mode, size, date, time, name = line.split(None, 4)
-        except:
-            # may be the stupid motd
-            import sys
-            print 'could not parse this line: %s' % repr(line)
-            #sys.exit('could not parse this line:\n%s' % repr(line))
-            continue
-        name = name.rstrip()
-
-        if mode.startswith('d'):
-            dirCollection[name] = mb.core.Directory(name)
-
-        elif mode.startswith('-'):
-            d, p = os.path.split(name)
-            if not d: 
-                d = '.'
-            dirCollection[d].files.append(p)
-
-        elif mode.startswith('l'):
-            # we ignore symbolic links
-            continue
-        else:
-            # something unknown...
-            print 'skipping', line
-            
-    err = child_stderr.read()
-
-    return dirCollection, err
 
+def gen_filelist(url, rsync='rsync', dirs=False, args=()):
+    """run rsync -r on url and return an iterator of the files found (as
+    Entry tuples). Symbolic links are ignored, and directories too unless
+    dirs is True. args are further arguments to rsync, like --exclude=PATTERN.
+
+    Raises mb.mberr.CrawlError if rsync fails, after the listing. If only
+    some files vanished while they were listed (exit code 24, as happens on
+    a mirror that is being synced), a warning is printed instead."""
+
+    if url.startswith('rsync://'):
+        url = rsync_url(url)
+    if not url.endswith('/'):
+        # list the contents, not the directory itself
+        url += '/'
+
+    # stderr goes to a file rather than a pipe, which could fill up and
+    # block rsync while we are reading stdout
+    err = tempfile.TemporaryFile()
+    try:
+        p = subprocess.Popen([rsync, '-r', '--no-motd'] + list(args) + [url], 
+                             stdout=subprocess.PIPE, stderr=err, 
+                             close_fds=True)
+    except OSError, e:
+        err.close()
+        raise mb.mberr.CrawlError(url, 'could not run %s: %s' % (rsync, e))
+    try:
+        for line in iter(p.stdout.readline, ''):
+            r = parse_line(line)
+            if r is None:
+                continue
+            mode, size, mtime, name = r
+            if mode.startswith('-'):
+                yield Entry(name, size, mtime)
+            elif mode.startswith('d'):
+                if dirs and name != '.':
+                    yield Entry(name, size, mtime)
+            # we ignore symbolic links and whatever else
+
+        p.stdout.close()
+        if p.wait() == 24:
+            err.seek(0)
+            print >>sys.stderr, 'warning: %s: %s' \
+                    % (url, err.read().strip() or 'some files vanished')
+        elif p.returncode != 0:
+            err.seek(0)
+            raise mb.mberr.CrawlError(url, 'rsync exited with %s: %s' 
+                                      % (p.returncode, err.read().strip()))
+    finally:
+        if p.poll() is None:
+            # the consumer stopped early
+            try:
+                os.kill(p.pid, 15)
+            except OSError:
+                pass
+            p.wait()
+        err.close()
+
+
+def get_filelist(url):
+    """return a dictionary of mb.core.Directory objects with the files in
+    each directory, and the error output of rsync (errors are raised as
+    CrawlError by now, so it is empty)
+
+    This keeps the whole listing in memory; use gen_filelist() instead."""
+
+    dirCollection = {}
+    for entry in gen_filelist(url):
+        d, p = os.path.split(entry.path)
+        if not d: 
+            d = '.'
+        if d not in dirCollection:
+            dirCollection[d] = mb.core.Directory(d)
+        dirCollection[d].files.append(p)
 
+    return dirCollection, ''
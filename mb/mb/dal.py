@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+"""
+A small data access layer for the queries that mb runs often.
+
+The queries are named prepared statements on one raw psycopg2 connection,
+which is kept for the lifetime of the mb process. PostgreSQL parses and
+plans each of them once per session, and the arguments are always passed
+as parameters, never interpolated into the SQL.
+
+    rows = mb.dal.get_dal(conn).query('has_file', path, mirror_id)
+
+A statement is prepared when it is used for the first time, so that
+statements for optional tables (like pfx2asn from mod_asn) don't fail
+where those don't exist.
+"""
+
+
+# name: (parameter types, statement)
+STATEMENTS = {
+    'has_file':
+        ('text, integer',
+         """SELECT path FROM filearr WHERE path = $1 AND $2 = ANY(mirrors)"""),
+    'has_file_like':
+        ('text, integer',
+         """SELECT path FROM filearr WHERE path LIKE $1 AND $2 = ANY(mirrors)"""),
+    'has_file_bits':
+        ('text, integer',
+         """SELECT path FROM filearr WHERE path = $1 AND mb_mirrorbits_has(mirrorbits, $2)"""),
+    'has_file_like_bits':
+        ('text, integer',
+         """SELECT path FROM filearr WHERE path LIKE $1 AND mb_mirrorbits_has(mirrorbits, $2)"""),
+
+    # all mirrors of a list of paths ($1) and LIKE patterns ($2), as
+    # (path or pattern, mirror id) rows, one per mirror
+    'marker_files':
+        ('text[], text[]',
+         """SELECT DISTINCT path, unnest(mirrors)
+            FROM filearr WHERE path = ANY($1)
+            UNION ALL
+            SELECT DISTINCT p.pattern, unnest(filearr.mirrors)
+            FROM unnest($2) AS p(pattern)
+            JOIN filearr ON filearr.path LIKE p.pattern"""),
+
+    'ls':
+        ('text',
+         """SELECT server.identifier, server.country, server.region,
+                   server.score, server.baseurl, server.enabled,
+                   server.status_baseurl, filearr.path
+            FROM filearr
+            LEFT JOIN server
+            ON server.id = ANY(filearr.mirrors)
+            WHERE filearr.path = $1
+            ORDER BY server.region, server.country, server.score DESC"""),
+    'ls_like':
+        ('text',
+         """SELECT server.identifier, server.country, server.region,
+                   server.score, server.baseurl, server.enabled,
+                   server.status_baseurl, filearr.path
+            FROM filearr
+            LEFT JOIN server
+            ON server.id = ANY(filearr.mirrors)
+            WHERE filearr.path LIKE $1
+            ORDER BY server.region, server.country, server.score DESC"""),
+    'ls_bits':
+        ('text',
+         """SELECT server.identifier, server.country, server.region,
+                   server.score, server.baseurl, server.enabled,
+                   server.status_baseurl, filearr.path
+            FROM filearr
+            LEFT JOIN server
+            ON mb_mirrorbits_has(filearr.mirrorbits, server.id)
+            WHERE filearr.path = $1
+            ORDER BY server.region, server.country, server.score DESC"""),
+    'ls_like_bits':
+        ('text',
+         """SELECT server.identifier, server.country, server.region,
+                   server.score, server.baseurl, server.enabled,
+                   server.status_baseurl, filearr.path
+            FROM filearr
+            LEFT JOIN server
+            ON mb_mirrorbits_has(filearr.mirrorbits, server.id)
+            WHERE filearr.path LIKE $1
+            ORDER BY server.region, server.country, server.score DESC"""),
+
+    # files in a directory ($1), via the index on mb_dirname(path)
+    'dir_filelist':
+        ('text',
+         """SELECT filearr.path, hash.file_id
+            FROM filearr
+            LEFT JOIN hash
+                ON hash.file_id = filearr.id
+            WHERE mb_dirname(filearr.path) = $1"""),
+    'dir_hashes':
+        ('text',
+         """SELECT filearr.path, filearr.id, hash.file_id, hash.mtime, hash.size,
+                   hash.sha1piecesize
+            FROM filearr
+            LEFT JOIN hash
+                ON hash.file_id = filearr.id
+            WHERE mb_dirname(filearr.path) = $1"""),
+
+    # subtrees: $1 is a LIKE prefix pattern, using the text_pattern_ops index
+    'subtree_mirrors':
+        ('text',
+         """SELECT identifier FROM server
+            WHERE enabled
+            AND id IN (SELECT unnest(mirrors) FROM filearr WHERE path LIKE $1)"""),
+    # (none if no file of the subtree is on any mirror)
+    'subtree_mirrors_missing':
+        ('text',
+         """SELECT identifier FROM server
+            WHERE enabled
+            AND NOT EXISTS (SELECT 1 FROM filearr 
+                            WHERE path LIKE $1 AND server.id = ANY(mirrors))
+            AND EXISTS (SELECT 1 FROM filearr 
+                        WHERE path LIKE $1 AND mirrors <> '{}')"""),
+    # the same with the bitmaps, which are ORed over the subtree first
+    # (padded to the same length, that bit_or() needs)
+    'subtree_mirrors_bits':
+        ('text',
+         """SELECT identifier FROM server,
+                (SELECT bit_or(substring(f.mirrorbits || repeat('0', s.n)::varbit 
+                                         FROM 1 FOR s.n)) AS bits
+                 FROM filearr f, (SELECT max(id) + 1 AS n FROM server) AS s
+                 WHERE f.path LIKE $1) AS subtree
+            WHERE enabled
+            AND mb_mirrorbits_has(subtree.bits, server.id)"""),
+    'subtree_mirrors_missing_bits':
+        ('text',
+         """SELECT identifier FROM server,
+                (SELECT bit_or(substring(f.mirrorbits || repeat('0', s.n)::varbit 
+                                         FROM 1 FOR s.n)) AS bits
+                 FROM filearr f, (SELECT max(id) + 1 AS n FROM server) AS s
+                 WHERE f.path LIKE $1) AS subtree
+            WHERE enabled
+            AND NOT mb_mirrorbits_has(subtree.bits, server.id)
+            AND position(B'1' IN subtree.bits) > 0"""),
+    'subtree_hashes_delete':
+        ('text',
+         """DELETE FROM hash
+            WHERE file_id IN (SELECT id FROM filearr WHERE path LIKE $1)"""),
+
+    # from the mirrorfilecount table
+    'mirror_nfiles':
+        ('integer',
+         """SELECT mirr_get_nfiles($1)"""),
+    # counted in the bitmaps
+    'mirror_nfiles_bits':
+        ('integer',
+         """SELECT count(*) FROM filearr WHERE mb_mirrorbits_has(mirrorbits, $1)"""),
+
+    'mirr_add_bypath':
+        ('integer, text',
+         """SELECT mirr_add_bypath($1, $2)"""),
+    'mirr_del_bypath':
+        ('integer, text',
+         """SELECT mirr_del_byid($1, (SELECT id FROM filearr WHERE path = $2))"""),
+
+    # the lookups of Hasheable.db_lookup()
+    'filearr_id':
+        ('text',
+         """SELECT id FROM filearr WHERE path = $1 LIMIT 1"""),
+    'hash_info':
+        ('integer',
+         """SELECT file_id, mtime, size, sha1piecesize FROM hash WHERE file_id = $1 LIMIT 1"""),
+
+    'pfx2asn':
+        ('text',
+         """SELECT pfx, asn FROM pfx2asn
+            WHERE pfx >>= ip4r($1)
+            ORDER BY ip4r_size(pfx)
+            LIMIT 1"""),
+}
+
+
+def get_cursor(conn):
+    """get a database cursor, but make it persistent which is faster"""
+    try:
+        return conn.mycursor
+    except AttributeError:
+        conn.mycursor = conn.Hash._connection.getConnection().cursor()
+        return conn.mycursor
+
+
+def get_dal(conn):
+    """return the Dal for a connection (mb.conn.Conn), creating it once"""
+    try:
+        return conn.dal
+    except AttributeError:
+        conn.dal = Dal(get_cursor(conn))
+        return conn.dal
+
+
+def like_esc(s):
+    """escape the wildcards of a LIKE pattern"""
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class Dal:
+    """run the prepared statements on a psycopg2 cursor"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.prepared = set()
+
+    def execute(self, name, *args):
+        # the connection is in autocommit mode, so a failed statement
+        # doesn't leave it aborted; callers that issue a BEGIN need to
+        # ROLLBACK themselves
+        c = self.cursor
+        if name not in self.prepared:
+            types, statement = STATEMENTS[name]
+            c.execute('PREPARE %s (%s) AS %s' % (name, types, statement))
+            self.prepared.add(name)
+        c.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(args))),
+                  args)
+        return c
+
+    def query(self, name, *args):
+        """run a statement and return all rows"""
+        return self.execute(name, *args).fetchall()
+
+    def query_one(self, name, *args):
+        """run a statement and return the first row, or None"""
+        return self.execute(name, *args).fetchone()
+
+    def commit(self):
+        self.cursor.execute('commit')
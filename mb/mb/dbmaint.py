@@ -1,12 +1,20 @@
 
+import os
+import time
+
+
+# files which are not on any mirror, and have no hashes. The first part
+# matches the partial index filearr_stale_key.
+STALE = """filearr.mirrors = '{}'
+           AND NOT EXISTS (SELECT 1 FROM hash WHERE hash.file_id = filearr.id)"""
+
+
 def stale(conn, quietness):
     """show statistics about stale files in the database"""
 
     n_file_total = conn.Filearr.select().count()
 
-    query = """SELECT count(*) FROM filearr 
-                   LEFT OUTER JOIN hash ON filearr.id = hash.file_id 
-               WHERE mirrors = '{}' AND hash.file_id IS NULL"""
+    query = """SELECT count(*) FROM filearr WHERE """ + STALE
     n_file_stale = conn.Filearr._connection.queryAll(query)[0]
 
 
@@ -15,23 +23,162 @@ def stale(conn, quietness):
         print 'Stale files (not on any mirror): %10d' % n_file_stale
 
 
-def vacuum(conn, quietness):
-    """delete stale file entries from the database"""
+def vacuum(conn, quietness, batch_size=10000, sleep=0, state_file=None):
+    """delete stale file entries from the database.
+
+    They are deleted in batches of batch_size rows, in order of their id and
+    each batch in its own transaction, sleeping for sleep seconds in between,
+    so that concurrent scans aren't blocked for long. With state_file, the
+    last id is saved after each batch, and a vacuum that was interrupted
+    continues from there."""
+
+    import mb.dal
+    c = mb.dal.get_cursor(conn)
+
+    last_id = 0
+    if state_file and os.path.exists(state_file):
+        last_id = int(open(state_file).read().strip() or 0)
+        if quietness < 1:
+            print 'Resuming after file id %d.' % last_id
 
     if quietness < 1:
         print 'Deleting stale files...'
-    query = """DELETE FROM filearr 
-               WHERE id IN (
-                   SELECT filearr.id FROM filearr 
-                   LEFT OUTER JOIN hash ON filearr.id = hash.file_id 
-                   WHERE mirrors = '{}' AND hash.file_id IS NULL
-               )"""
-    conn.Filearr._connection.query(query)
+    total = 0
+    while True:
+        c.execute("""SELECT id FROM filearr 
+                     WHERE id > %s AND """ + STALE + """
+                     ORDER BY id LIMIT %s""", [last_id, batch_size])
+        ids = [ row[0] for row in c.fetchall() ]
+        if not ids:
+            break
+
+        # files that a scan found meanwhile stay
+        c.execute("""DELETE FROM filearr 
+                     WHERE id = ANY(%s) AND """ + STALE, [ids])
+        total += c.rowcount
+        c.execute('commit')
+        last_id = ids[-1]
+        if state_file:
+            f = open(state_file + '.new', 'w')
+            f.write('%d\n' % last_id)
+            f.close()
+            os.rename(state_file + '.new', state_file)
+        if quietness < 1:
+            print 'Deleted %d files (up to id %d)' % (total, last_id)
+        if sleep:
+            time.sleep(sleep)
+
+    if state_file and os.path.exists(state_file):
+        os.unlink(state_file)
+
+    if quietness < 1:
+        print 'Done.'
+
+
+def reconcile(conn, quietness):
+    """recompute the number of files of each mirror in the mirrorfilecount
+    table, with one pass over filearr.
+
+    The table is locked meanwhile, so that the counting can't miss changes
+    of concurrent scans; they wait until it is done."""
+
+    import mb.dal
+    c = mb.dal.get_cursor(conn)
+
+    c.execute('BEGIN')
+    try:
+        c.execute('LOCK TABLE mirrorfilecount IN SHARE ROW EXCLUSIVE MODE')
+        c.execute('SELECT server_id, nfiles FROM mirrorfilecount')
+        old = dict(c.fetchall())
+        c.execute("""SELECT m, count(*) 
+                     FROM (SELECT unnest(mirrors) AS m FROM filearr) AS f
+                     WHERE m IN (SELECT id FROM server)
+                     GROUP BY m""")
+        new = dict(c.fetchall())
+        c.execute('DELETE FROM mirrorfilecount')
+        for server_id, nfiles in new.iteritems():
+            c.execute("""INSERT INTO mirrorfilecount (server_id, nfiles) 
+                         VALUES (%s, %s)""", [server_id, nfiles])
+    except:
+        c.execute('ROLLBACK')
+        raise
+    c.execute('COMMIT')
 
     if quietness < 1:
+        for server_id in sorted(set(old) | set(new)):
+            if old.get(server_id, 0) != new.get(server_id, 0):
+                print 'mirror %d: %d -> %d files' \
+                        % (server_id, old.get(server_id, 0), new.get(server_id, 0))
         print 'Done.'
 
 
+def _mirrorbits_batches(c, statement, quietness, batch_size, sleep):
+    """run statement (an UPDATE of filearr with placeholders for a range of
+    ids) in batches of batch_size ids, each in its own transaction"""
+    c.execute('SELECT min(id), max(id) FROM filearr')
+    first, last = c.fetchone()
+    if first is None:
+        return 0
+    total = 0
+    for start in xrange(first, last + 1, batch_size):
+        c.execute(statement, [start, start + batch_size])
+        total += c.rowcount
+        if quietness < 1:
+            print '%d/%d' % (min(start + batch_size - 1, last), last)
+        if sleep:
+            time.sleep(sleep)
+    return total
+
+
+def mirrorbits_enable(conn, quietness, batch_size=10000, sleep=0):
+    """install the trigger that computes filearr.mirrorbits for new files,
+    and fill in the bitmaps of the existing files, in batches of ids.
+
+    Creating the trigger waits for the transactions that write to filearr;
+    from then on, the functions that add or remove a mirror keep the bitmaps
+    that are filled in up to date, so the batches can run while mirrors are
+    scanned. Files that have a bitmap already are skipped, so an
+    interrupted run can simply be started again."""
+
+    import mb.dal
+    c = mb.dal.get_cursor(conn)
+
+    c.execute("""SELECT 1 FROM pg_trigger WHERE tgname = 'filearr_mirrorbits'""")
+    if not c.fetchone():
+        c.execute("""CREATE TRIGGER filearr_mirrorbits 
+                     BEFORE INSERT ON filearr
+                     FOR EACH ROW EXECUTE PROCEDURE mb_mirrorbits_insert()""")
+
+    if quietness < 1:
+        print 'Filling in the mirror bitmaps...'
+    n = _mirrorbits_batches(c, """UPDATE filearr SET mirrorbits = mb_mirrorbits(mirrors)
+                                  WHERE id >= %s AND id < %s 
+                                  AND mirrorbits IS NULL""",
+                            quietness, batch_size, sleep)
+    if quietness < 1:
+        print 'Done (%d files). mirror_bitmaps can be switched on now.' % n
+
+
+def mirrorbits_disable(conn, quietness, batch_size=10000, sleep=0):
+    """remove the trigger that computes filearr.mirrorbits, and clear the
+    bitmaps in batches of ids; cleared bitmaps aren't maintained anymore.
+    mirror_bitmaps needs to be switched off before."""
+
+    import mb.dal
+    c = mb.dal.get_cursor(conn)
+
+    c.execute('DROP TRIGGER IF EXISTS filearr_mirrorbits ON filearr')
+
+    if quietness < 1:
+        print 'Clearing the mirror bitmaps...'
+    n = _mirrorbits_batches(c, """UPDATE filearr SET mirrorbits = NULL
+                                  WHERE id >= %s AND id < %s 
+                                  AND mirrorbits IS NOT NULL""",
+                            quietness, batch_size, sleep)
+    if quietness < 1:
+        print 'Done (%d files).' % n
+
+
 def stats(conn):
     """show statistics about stale files in the database"""
 
@@ -20,3 +20,22 @@ def get_filelist(url):
         sys.exit('unknown error... url is \'%s\'' % url)
 
 
+def gen_filelist(url):
+    """return an iterator of the files found below url, as
+    mb.crawlers.Entry tuples of (path, size, mtime)"""
+
+    if url.startswith('rsync') or '::' in url:
+        import mb.crawlers.rsync
+        return mb.crawlers.rsync.gen_filelist(url)
+
+    elif url.startswith('http'):
+        import mb.crawlers.http
+        return mb.crawlers.http.gen_filelist(url)
+
+    elif url.startswith('ftp'):
+        import mb.crawlers.ftp
+        return mb.crawlers.ftp.gen_filelist(url)
+
+    else:
+        import sys
+        sys.exit('unknown error... url is \'%s\'' % url)
@@ -1,6 +1,15 @@
 from sqlobject.sqlbuilder import AND
 
-from mb import util
+import mb.dal
+
+
+def mirrors_statement(conn, name):
+    """return the name of the statement for the layout of the mirror sets in
+    use: the mirrors arrays, or with mirror_bitmaps = 1 the mirrorbits bitmaps"""
+    if getattr(conn, 'mirror_bitmaps', False):
+        return name + '_bits'
+    return name
+
 
 def has_file(conn, path, mirror_id):
     """check if file 'path' exists on mirror 'mirror_id'
@@ -9,16 +18,11 @@ def has_file(conn, path, mirror_id):
     path can contain wildcards, which will result in a LIKE match.
     """
     if path.find('*') >= 0 or path.find('%') >= 0:
-        oprtr = 'like'
-        path = path.replace('*', '%')
+        return mb.dal.get_dal(conn).query(mirrors_statement(conn, 'has_file_like'), 
+                                          path.replace('*', '%'), mirror_id)
     else:
-        oprtr = '='
-
-    query = "SELECT path FROM filearr WHERE path %s '%s' AND %s = ANY(mirrors)" \
-                  % (oprtr, path, mirror_id)
-    result = conn.Server._connection.queryAll(query)
-
-    return result
+        return mb.dal.get_dal(conn).query(mirrors_statement(conn, 'has_file'), 
+                                          path, mirror_id)
 
 
 def check_for_marker_files(conn, markers, mirror_id):
@@ -40,6 +44,49 @@ def check_for_marker_files(conn, markers, mirror_id):
     return found_all
 
 
+def marker_matrix(conn, markers, mirrors):
+    """
+    Evaluate all markers for all mirrors at once, like
+    check_for_marker_files() does for one of each, but with a single query.
+
+    Returns a dictionary that maps the markers string of each marker to the
+    set of ids of those mirrors that pass the check:
+
+        matrix = marker_matrix(conn, markers, mirrors)
+        if mirror.id in matrix[marker.markers]: ...
+    """
+    paths, patterns = set(), set()
+    for marker in markers:
+        for m in marker.markers.split():
+            m = m.lstrip('!')
+            if m.find('*') >= 0 or m.find('%') >= 0:
+                patterns.add(m.replace('*', '%'))
+            else:
+                paths.add(m)
+
+    found = {}
+    if paths or patterns:
+        rows = mb.dal.get_dal(conn).query('marker_files', 
+                                          list(paths), list(patterns))
+        for path, mirror_id in rows:
+            found.setdefault(path, set()).add(mirror_id)
+
+    all_ids = set([ mirror.id for mirror in mirrors ])
+    matrix = {}
+    for marker in markers:
+        ids = set(all_ids)
+        for m in marker.markers.split():
+            path = m.lstrip('!')
+            if path.find('*') >= 0 or path.find('%') >= 0:
+                path = path.replace('*', '%')
+            if m.startswith('!'):
+                ids -= found.get(path, set())
+            else:
+                ids &= found.get(path, set())
+        matrix[marker.markers] = ids
+    return matrix
+
+
 def ls(conn, path):
     """If path contains a wildcard (* or %): 
     
@@ -52,22 +99,11 @@ def ls(conn, path):
 
     if path.find('*') >= 0 or path.find('%') >= 0:
         pattern = True
-        oprtr = 'like'
         path = path.replace('*', '%')
+        rows = mb.dal.get_dal(conn).query(mirrors_statement(conn, 'ls_like'), path)
     else:
         pattern = False
-        oprtr = '='
-
-    query = 'SELECT server.identifier, server.country, server.region, \
-                       server.score, server.baseurl, server.enabled, \
-                       server.status_baseurl, filearr.path \
-                FROM filearr \
-                LEFT JOIN server \
-                ON server.id = ANY(filearr.mirrors) \
-                WHERE filearr.path %s \'%s\' \
-                ORDER BY server.region, server.country, server.score DESC' \
-                  % (oprtr, path)
-    rows = conn.Server._connection.queryAll(query)
+        rows = mb.dal.get_dal(conn).query(mirrors_statement(conn, 'ls'), path)
 
     files = []
     # ugly. Really need to let an ORM do this.
@@ -90,16 +126,183 @@ def ls(conn, path):
 
 
 def add(conn, path, mirror):
-
-    query = """SELECT mirr_add_bypath(%d, '%s')""" \
-               % (mirror.id, path)
-    conn.Server._connection.queryAll(query)
+    dal = mb.dal.get_dal(conn)
+    dal.query('mirr_add_bypath', mirror.id, path)
+    dal.commit()
 
 
 def rm(conn, path, mirror):
-    query = """SELECT mirr_del_byid(%d, (SELECT id FROM filearr WHERE path='%s'))""" \
-                   % (mirror.id, path)
-    conn.Server._connection.queryAll(query)
+    dal = mb.dal.get_dal(conn)
+    dal.query('mirr_del_bypath', mirror.id, path)
+    dal.commit()
+
+
+class CopyReader:
+    """a file-like object that feeds paths to COPY ... FROM STDIN (in text
+    format), reading them from an iterable as COPY asks for more"""
+
+    def __init__(self, paths):
+        self.paths = iter(paths)
+        self.buf = ''
+        self.count = 0
+
+    def _line(self):
+        for path in self.paths:
+            path = path.lstrip('/')
+            if not path:
+                continue
+            self.count += 1
+            return path.replace('\\', '\\\\').replace('\t', '\\t') \
+                       .replace('\n', '\\n').replace('\r', '\\r') + '\n'
+        return ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            line = self._line()
+            if not line:
+                break
+            self.buf += line
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def readline(self, size=-1):
+        if self.buf:
+            line, self.buf = self.buf, ''
+            return line
+        return self._line()
+
+
+def _add_mirror_to(c, table, mirror_id):
+    """add a mirror to the files whose paths are in table, creating the
+    files that don't exist yet; return the number of files changed
+
+    Must be called within a transaction. If another scan (or mb makehashes)
+    creates one of the files meanwhile, the insert is retried, like
+    mirr_add_bypath() does on a unique_violation."""
+    import psycopg2
+
+    while True:
+        c.execute('SAVEPOINT add_files')
+        try:
+            c.execute("""INSERT INTO filearr (path, mirrors)
+                         SELECT s.path, ARRAY[%%s]::smallint[] FROM %s s
+                         LEFT JOIN filearr f ON f.path = s.path
+                         WHERE f.id IS NULL""" % table, [mirror_id])
+        except psycopg2.IntegrityError:
+            # the files inserted by the other transaction are seen now
+            c.execute('ROLLBACK TO SAVEPOINT add_files')
+            continue
+        n = c.rowcount
+        c.execute('RELEASE SAVEPOINT add_files')
+        break
+    c.execute("""UPDATE filearr 
+                 SET mirrors = array_append(mirrors, %%s::smallint),
+                     mirrorbits = mb_mirrorbits_set(mirrorbits, %%s, 1)
+                 FROM %s s
+                 WHERE filearr.path = s.path 
+                 AND NOT %%s = ANY(coalesce(filearr.mirrors, '{}'))""" % table, 
+              [mirror_id, mirror_id, mirror_id])
+    return n + c.rowcount
+
+
+def apply_snapshot(conn, mirror, paths, subtree=None, cursor=None):
+    """Make the database reflect that the files in paths (an iterable of
+    paths relative to the mirror's base URL) are all the files on a mirror:
+    create missing files, add the mirror to those that don't have it yet, and
+    remove it from all other files.
+
+    Instead of a stored procedure call per file, the paths are streamed into
+    a temporary table with COPY, and the differences are applied with a few
+    set-based statements, in one transaction. The number of files of the
+    mirror in the mirrorfilecount table is updated accordingly.
+
+    With subtree, the paths are the files below that directory only, and the
+    mirror is only removed from files there.
+
+    A cursor can be passed to work on another database connection than the
+    one of conn, like the scanner threads do.
+
+    Returns a tuple of (number of paths, files added, files removed)."""
+
+    c = cursor or mb.dal.get_cursor(conn)
+    mirror_id = mirror.id
+    # the connection is in autocommit mode; without a transaction, the
+    # temporary tables would be dropped right away
+    c.execute('BEGIN')
+    try:
+        c.execute("""CREATE TEMPORARY TABLE snapshot (path varchar(512)) 
+                     ON COMMIT DROP""")
+        reader = CopyReader(paths)
+        c.copy_from(reader, 'snapshot', columns=('path',))
+        c.execute("""CREATE TEMPORARY TABLE snapshot_paths ON COMMIT DROP AS
+                     SELECT DISTINCT path FROM snapshot""")
+        c.execute('CREATE UNIQUE INDEX snapshot_paths_key ON snapshot_paths (path)')
+        c.execute('ANALYZE snapshot_paths')
+
+        added = _add_mirror_to(c, 'snapshot_paths', mirror_id)
+
+        query = """UPDATE filearr 
+                   SET mirrors = ARRAY(SELECT m FROM unnest(mirrors) AS m 
+                                       WHERE m <> %s),
+                       mirrorbits = mb_mirrorbits_set(mirrorbits, %s, 0)
+                   WHERE %s = ANY(mirrors)
+                   AND NOT EXISTS (SELECT 1 FROM snapshot_paths s 
+                                   WHERE s.path = filearr.path)"""
+        args = [mirror_id, mirror_id, mirror_id]
+        if subtree:
+            query += " AND filearr.path LIKE %s"
+            args.append(mb.dal.like_esc(subtree.strip('/')) + '/%')
+        c.execute(query, args)
+        removed = c.rowcount
+
+        c.execute('SELECT mirr_count_add(%s, %s)', [mirror_id, added - removed])
+    except:
+        c.execute('ROLLBACK')
+        raise
+    c.execute('COMMIT')
+
+    return reader.count, added, removed
+
+
+def apply_diff(conn, mirror, added, removed, cursor=None):
+    """Add a mirror to the files in added, and remove it from the files in
+    removed (both iterables of paths), as the difference between two scans.
+
+    This works like apply_snapshot(), but only the changed paths go to the
+    database. The cursor argument is the same as there.
+
+    Returns a tuple of (files added, files removed)."""
+
+    c = cursor or mb.dal.get_cursor(conn)
+    mirror_id = mirror.id
+    c.execute('BEGIN')
+    try:
+        for table, paths in [('snapshot_added', added), ('snapshot_removed', removed)]:
+            c.execute("""CREATE TEMPORARY TABLE %s (path varchar(512)) 
+                         ON COMMIT DROP""" % table)
+            c.copy_from(CopyReader(paths), table, columns=('path',))
+            c.execute('ANALYZE %s' % table)
+
+        nadded = _add_mirror_to(c, 'snapshot_added', mirror_id)
+
+        c.execute("""UPDATE filearr 
+                     SET mirrors = ARRAY(SELECT m FROM unnest(mirrors) AS m 
+                                         WHERE m <> %s),
+                         mirrorbits = mb_mirrorbits_set(mirrorbits, %s, 0)
+                     FROM snapshot_removed s
+                     WHERE filearr.path = s.path 
+                     AND %s = ANY(filearr.mirrors)""", [mirror_id, mirror_id, mirror_id])
+        nremoved = c.rowcount
+
+        c.execute('SELECT mirr_count_add(%s, %s)', [mirror_id, nadded - nremoved])
+    except:
+        c.execute('ROLLBACK')
+        raise
+    c.execute('COMMIT')
+
+    return nadded, nremoved
 
 
 def dir_ls(conn, segments = 1, mirror=None):
@@ -126,26 +329,19 @@ def dir_show_mirrors(conn, path, missing=False):
     written for.
     """
 
-    query = """select distinct(mirrors) from filearr where path like '%s%%'""" % path
-    result = conn.Server._connection.queryAll(query)
-
-    mirror_ids = []
-    for i in result:
-        i = i[0]
-        for mirror_id in i:
-            mirror_id = str(mirror_id)
-            if mirror_id not in mirror_ids:
-                mirror_ids.append(mirror_id)
-
-    if not mirror_ids:
-        return []
+    pattern = mb.dal.like_esc(path) + '%'
     if not missing:
-        query = """select identifier from server where enabled and id in (%s)""" % ','.join(mirror_ids)
+        name = 'subtree_mirrors'
     else:
-        query = """select identifier from server where enabled and id not in (%s)""" % ','.join(mirror_ids)
-    result = conn.Server._connection.queryAll(query)
+        name = 'subtree_mirrors_missing'
+    return mb.dal.get_dal(conn).query(mirrors_statement(conn, name), pattern)
 
-    return result
+
+def mirror_get_nfiles(conn, mirror_id):
+    """return the number of files on a mirror, as counted in the
+    mirrorfilecount table, or with mirror_bitmaps = 1 in the bitmaps"""
+    return mb.dal.get_dal(conn).query_one(mirrors_statement(conn, 'mirror_nfiles'), 
+                                          mirror_id)[0]
 
 
 def dir_filelist(conn, path):
@@ -153,14 +349,17 @@ def dir_filelist(conn, path):
     
     The returned filenames include their path."""
 
-    query = """SELECT filearr.path, hash.file_id
-                   FROM filearr 
-               LEFT JOIN hash 
-                   ON hash.file_id = filearr.id 
-               WHERE filearr.path ~ '^""" + util.pgsql_regexp_esc(path) +"""/[^/]*$'""" 
+    return mb.dal.get_dal(conn).query('dir_filelist', path.strip('/'))
 
-    result = conn.Server._connection.queryAll(query)
-    return result
+
+def dir_hashes(conn, path):
+    """Returns tuples of (path, file id, hash file id, hash mtime, hash size,
+    hash piece size) for all files that reside in a directory, in one query. The hash columns
+    are None for files that don't have a hash yet.
+
+    The returned filenames include their path."""
+
+    return mb.dal.get_dal(conn).query('dir_hashes', path.strip('/'))
 
 
 def hashes_list_delete(conn, idlist):
@@ -192,9 +391,6 @@ def hashes_dir_delete(conn, base):
     filearr table starting with 'base'.
     This means we recursively delete hashes below a given directory."""
 
-    query = """DELETE FROM hash 
-               WHERE file_id IN (
-                   SELECT filearr.id FROM filearr 
-                   WHERE path LIKE '%s/%%'
-               )""" % base
-    conn.Filearr._connection.query(query)
+    dal = mb.dal.get_dal(conn)
+    dal.execute('subtree_hashes_delete', mb.dal.like_esc(base) + '/%')
+    dal.commit()
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+"""
+A local, persistent cache of computed hashes, used by mb makehashes.
+
+Entries are keyed by device, inode, size and mtime of a file (and the
+chunk size that was used). A file that is renamed, moved within the file
+system, or published under several paths via hard links is thus found in the
+cache and doesn't need to be read again.
+
+The cache is an SQLite database.
+"""
+
+import os
+import sqlite3
+
+import mb.hashes
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime INTEGER NOT NULL,
+        chunk_size INTEGER NOT NULL,
+        path BLOB NOT NULL,
+        md5 BLOB NOT NULL,
+        sha1 BLOB NOT NULL,
+        sha256 BLOB,
+        pieces BLOB,
+        zsums BLOB,
+        PRIMARY KEY (dev, ino, size, mtime, chunk_size)
+);
+"""
+
+
+class HashCache:
+    """represent the cache file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, hasheable):
+        return (hasheable.dev, hasheable.inode, hasheable.size,
+                int(hasheable.mtime), hasheable.hb.chunk_size)
+
+    def restore(self, hasheable):
+        """fill the HashBag of a Hasheable from the cache.
+
+        Returns True if it was found with all the needed hashes, else False."""
+        hb = hasheable.hb
+        row = self.db.execute("""SELECT md5, sha1, sha256, pieces, zsums
+                                 FROM hashes
+                                 WHERE dev = ? AND ino = ? AND size = ?
+                                       AND mtime = ? AND chunk_size = ?""",
+                              self.key(hasheable)).fetchone()
+        if not row \
+           or (hb.do_chunked_hashes and row[3] is None) \
+           or (hb.do_zsync_hashes and row[4] is None):
+            self.misses += 1
+            return False
+
+        md5, sha1, sha256, pieces, zsums = row
+
+        hb.md5 = str(md5)
+        hb.md5hex = hb.md5.encode('hex')
+        hb.sha1 = str(sha1)
+        hb.sha1hex = hb.sha1.encode('hex')
+        if sha256 is not None:
+            hb.sha256 = str(sha256)
+            hb.sha256hex = hb.sha256.encode('hex')
+
+        if hb.do_chunked_hashes:
+            hb.pieces = bytearray(pieces)
+            hb.npieces = len(hb.pieces) // mb.hashes.SHA1_DIGESTSIZE
+            # the name of the file is part of the info hash, so it is
+            # calculated again, in case that the file was renamed
+            hb.calc_btih()
+
+        if hb.do_zsync_hashes:
+            hb.zs_guess_zsync_params()
+            hb.zsums = bytearray(zsums)
+            hb.zsums_len = len(hb.zsums)
+
+        hb.read_pgp()
+        hb.empty = False
+
+        # remember where the file was seen last
+        self.db.execute("UPDATE hashes SET path = ? WHERE dev = ? AND ino = ? AND size = ? "
+                        "AND mtime = ? AND chunk_size = ?",
+                        (sqlite3.Binary(hasheable.src),) + self.key(hasheable))
+        self.hits += 1
+        return True
+
+    def store(self, hasheable):
+        """save the hashes of a (filled) HashBag"""
+        hb = hasheable.hb
+        if hb.empty:
+            return
+
+        pieces = zsums = None
+        if hb.do_chunked_hashes:
+            pieces = sqlite3.Binary(hb.pieces)
+        if hb.do_zsync_hashes:
+            zsums = sqlite3.Binary(hb.zsums)
+        sha256 = None
+        if hb.sha256:
+            sha256 = sqlite3.Binary(hb.sha256)
+
+        self.db.execute("""INSERT OR REPLACE INTO hashes
+                               (dev, ino, size, mtime, chunk_size, path,
+                                md5, sha1, sha256, pieces, zsums)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        self.key(hasheable)
+                        + (sqlite3.Binary(hasheable.src),
+                           sqlite3.Binary(hb.md5), sqlite3.Binary(hb.sha1),
+                           sha256, pieces, zsums))
+
+    def prune(self, startdir, seen, skipped=()):
+        """evict entries for files below startdir whose inode doesn't exist
+        anymore (or was reused by another file).
+
+        seen is the set of (dev, ino, size, mtime) of the files that exist
+        below startdir, which mb makehashes collects while it walks the tree.
+        An inode that lives on under another name (a hard link) is thus kept.
+        Entries for files below the directories in skipped (that weren't
+        looked at) are kept as well.
+
+        Returns the number of evicted entries."""
+        prefix = startdir.rstrip('/') + '/'
+        skipped = tuple([ d.rstrip('/') + '/' for d in skipped ])
+        stale = []
+        for dev, ino, size, mtime, chunk_size, path in \
+                self.db.execute("""SELECT dev, ino, size, mtime, chunk_size, path
+                                   FROM hashes"""):
+            path = str(path)
+            if not path.startswith(prefix) or path.startswith(skipped):
+                continue
+            if (dev, ino, size, mtime) not in seen:
+                stale.append((dev, ino, size, mtime, chunk_size))
+
+        self.db.executemany("""DELETE FROM hashes
+                               WHERE dev = ? AND ino = ? AND size = ?
+                                     AND mtime = ? AND chunk_size = ?""", stale)
+        self.commit()
+        return len(stale)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
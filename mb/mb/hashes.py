@@ -6,6 +6,14 @@ import os.path
 import stat
 import zsync
 import binascii
+import re
+import threading
+import Queue
+import time
+
+import mb.dal
+import mb.hashfile
+import mb.util
 
 try:
     import hashlib
@@ -22,17 +30,44 @@ except ImportError:
     sha256 = None
 
 DEFAULT_PIECESIZE = 262144
+# the largest piece size that chunk_size_for() picks
+MAX_PIECESIZE     = 16777216
 MD5_DIGESTSIZE    = 16
 SHA1_DIGESTSIZE   = 20
 SHA256_DIGESTSIZE = 32
 
 
 
+# the values of a row in the hash table, except file_id, as placeholders
+# (the binary values are passed as buffers, which psycopg2 sends as bytea)
+HASH_VALUES = "%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s"
+
+
+# (moved to mb.dal)
+get_cursor = mb.dal.get_cursor
+
+
+
+def chunk_size_for(size, chunk_size=DEFAULT_PIECESIZE, max_pieces=0):
+    """Return the piece size to use for a file of the given size.
+
+    With max_pieces, the piece size is doubled, starting from chunk_size, 
+    until the file has at most max_pieces pieces (or MAX_PIECESIZE is
+    reached). Small files thus keep small pieces, and large files don't get
+    tens of thousands of them."""
+    if max_pieces:
+        while size > chunk_size * max_pieces and chunk_size < MAX_PIECESIZE:
+            chunk_size *= 2
+    return chunk_size
+
+
 class Hasheable:
     """represent a file and its metadata"""
     def __init__(self, basename, src_dir=None, dst_dir=None,
                  base_dir=None, do_zsync_hashes=False,
-                 do_chunked_hashes=True, chunk_size=DEFAULT_PIECESIZE):
+                 do_chunked_hashes=True, chunk_size=DEFAULT_PIECESIZE,
+                 write_hash_file=False, readahead=0, dropbehind=False,
+                 max_pieces=0):
         self.basename = basename
         if src_dir:
             self.src_dir = src_dir
@@ -48,17 +83,23 @@ class Hasheable:
         self.mtime = self.finfo.st_mtime
         self.size  = self.finfo.st_size
         self.inode = self.finfo.st_ino
+        self.dev   = self.finfo.st_dev
         self.mode  = self.finfo.st_mode
 
         self.dst_dir = dst_dir
 
         self.dst_basename = '%s.size_%s' % (self.basename, self.size)
         self.dst = os.path.join(self.dst_dir, self.dst_basename)
+        # write the hashes into the hash file (see mb.hashfile), instead of
+        # leaving it empty
+        self.write_hash_file = write_hash_file
 
         self.hb = HashBag(src=self.src, parent=self)
         self.hb.do_zsync_hashes = do_zsync_hashes
         self.hb.do_chunked_hashes = do_chunked_hashes
-        self.hb.chunk_size = chunk_size
+        self.hb.chunk_size = chunk_size_for(self.size, chunk_size, max_pieces)
+        self.hb.readahead = readahead
+        self.hb.dropbehind = dropbehind
 
     def islink(self):
         return stat.S_ISLNK(self.mode)
@@ -68,15 +109,67 @@ class Hasheable:
         return stat.S_ISDIR(self.mode)
 
 
-    def check_file(self, verbose=False, dry_run=False, force=False, copy_permissions=True):
-        """check whether the hashes stored on disk are up to date"""
+    def file_uptodate(self):
+        """check whether the hash file on disk has the mtime of the file"""
         try:
             dst_statinfo = os.stat(self.dst)
             dst_mtime = dst_statinfo.st_mtime
         except OSError:
             dst_mtime = 0 # file missing
+        else:
+            if self.write_hash_file and dst_statinfo.st_size == 0:
+                return False # only an empty marker yet
+
+        return int(dst_mtime) == int(self.mtime)
+
+
+    def db_lookup(self, conn):
+        """look up the file in the filearr and hash tables
+
+        Returns a tuple (file_id, mtime, size, piecesize), where file_id is
+        None if the file isn't in the database, and the others are None if
+        there's no hash for it yet. The result is remembered, so that check_db() doesn't
+        need to ask again."""
+        try:
+            return self.dbinfo
+        except AttributeError:
+            pass
+
+        dal = mb.dal.get_dal(conn)
 
-        if int(dst_mtime) == int(self.mtime) and not force:
+        res_filearr = dal.query_one('filearr_id', self.src_rel)
+        if res_filearr:
+            # file already present in the file array table. Is it also known in the hash table?
+            file_id = res_filearr[0]
+            res_hash = dal.query_one('hash_info', file_id)
+            if res_hash:
+                self.dbinfo = (file_id, res_hash[1], res_hash[2], res_hash[3])
+            else:
+                self.dbinfo = (file_id, None, None, None)
+        else:
+            self.dbinfo = (None, None, None, None)
+
+        return self.dbinfo
+
+
+    def db_uptodate(self, conn):
+        """check whether the hash in the database matches mtime and size of the file"""
+        file_id, mtime, size, piecesize = self.db_lookup(conn)
+        return int(self.mtime) == mtime and self.size == size
+
+
+    def needs_update(self, conn, force=False):
+        """check whether check_file() or check_db() are going to compute
+        hashes for this file. Used to decide which files are handed out to
+        worker processes."""
+        if force:
+            return True
+        return not self.file_uptodate() or not self.db_uptodate(conn)
+
+
+    def check_file(self, verbose=False, dry_run=False, force=False, copy_permissions=True):
+        """check whether the hashes stored on disk are up to date"""
+        if self.file_uptodate() and not force:
             if verbose:
                 print 'Up to date hash file: %r' % self.dst
             return 
@@ -91,7 +184,10 @@ class Hasheable:
             sys.stderr.write('skipping hash (file) generation\n')
             return
 
-        open(self.dst, 'w').close()
+        if self.write_hash_file:
+            mb.hashfile.write(self.dst, self.hb)
+        else:
+            open(self.dst, 'w').close()
 
         if verbose:
             print 'Hash file updated: %r' % self.dst
@@ -104,46 +200,48 @@ class Hasheable:
             os.chmod(self.dst, 0644)
 
 
-    def check_db(self, conn, verbose=False, dry_run=False, force=False):
+    def check_db(self, conn, verbose=False, dry_run=False, force=False, batch=None):
         """check if the hashes that are stored in the database are up to date
         
-        for performance, this function talks very low level to the database"""
-        # get a database cursor, but make it persistent which is faster
-        try:
-            conn.mycursor
-        except AttributeError:
-            conn.mycursor = conn.Hash._connection.getConnection().cursor()
-        c = conn.mycursor
+        for performance, this function talks very low level to the database
 
+        If a DbBatch is passed, the hashes are queued there and written
+        together with others, instead of one transaction per file."""
+        file_id, mtime, size, piecesize = self.db_lookup(conn)
 
-        c.execute("SELECT id FROM filearr WHERE path = %s LIMIT 1",
-                  [self.src_rel])
-        res_filearr = c.fetchone()
-        if res_filearr:
-            # file already present in the file array table. Is it also known in the hash table?
-            file_id = res_filearr[0]
-            c.execute("SELECT file_id, mtime, size FROM hash WHERE file_id = %s LIMIT 1",
-                      [file_id])
-            res_hash = c.fetchone()
-        else:
+        if not file_id:
             print 'File %r not in database. Not on mirrors yet? Will be inserted.' % self.src_rel
-            file_id = None
-            res_hash = None
-
-        if not res_hash:
 
+        if mtime is None:
             if dry_run: 
                 print 'Would create hashes in db for: ', self.src_rel
                 return
-
-            if self.hb.empty:
-                self.hb.fill(verbose=verbose)
-            if self.hb.empty:
-                sys.stderr.write('skipping db hash generation\n')
+        else:
+            if int(self.mtime) == mtime and self.size == size and not force:
+                if verbose:
+                    print 'Up to date in db: %r' % self.src_rel
                 return
 
+        if self.hb.empty:
+            self.hb.fill(verbose=verbose)
+        if self.hb.empty:
+            sys.stderr.write('skipping db hash generation\n')
+            return
+
+        values = self.hash_values()
+        self.hb = None
+
+        if batch:
+            batch.add(self.src_rel, file_id, mtime is not None, values)
+            if verbose:
+                print 'Hash queued for database: %r' % self.src_rel
+            return
+
+        c = get_cursor(conn)
+
+        if mtime is None:
             c.execute("BEGIN")
-            if not res_filearr: 
+            if not file_id: 
                 c.execute("INSERT INTO filearr (path, mirrors) VALUES (%s, '{}')",
                           [self.src_rel])
                 c.execute("SELECT currval('filearr_id_seq')")
@@ -153,73 +251,177 @@ class Hasheable:
                                            sha1, sha256, sha1piecesize, 
                                            sha1pieces, btih, pgp, zblocksize,
                                            zhashlens, zsums) 
-                         VALUES (%s, %s, %s, 
-                                 decode(%s, 'hex'), decode(%s, 'hex'), 
-                                 decode(%s, 'hex'), %s, decode(%s, 'hex'),
-                                 decode(%s, 'hex'),
-                                 %s, %s, %s, decode(%s, 'hex'))""",
-                      [file_id, int(self.mtime), self.size,
-                       self.hb.md5hex or '',
-                       self.hb.sha1hex or '',
-                       self.hb.sha256hex or '',
-                       self.hb.chunk_size,
-                       ''.join(self.hb.pieceshex),
-                       self.hb.btihhex or '',
-                       self.hb.pgp or '',
-                       self.hb.zblocksize,
-                       self.hb.get_zparams(),
-                       binascii.hexlify(''.join(self.hb.zsums))]
-                      )
+                         VALUES (%s, """ + HASH_VALUES + ")",
+                      [file_id] + values)
             c.execute("COMMIT")
             if verbose:
                 print 'Hash was not present yet in database - inserted'
         else:
-            mtime, size = res_hash[1], res_hash[2]
-            
-            if int(self.mtime) == mtime and self.size == size and not force:
-                if verbose:
-                    print 'Up to date in db: %r' % self.src_rel
-                return
-
-            if self.hb.empty:
-                self.hb.fill(verbose=verbose)
-            if self.hb.empty:
-                sys.stderr.write('skipping db hash generation\n')
-                return
-
             c.execute("""UPDATE hash set mtime = %s, size = %s, 
-                                         md5 = decode(%s, 'hex'), 
-                                         sha1 = decode(%s, 'hex'), 
-                                         sha256 = decode(%s, 'hex'), 
+                                         md5 = %s, 
+                                         sha1 = %s, 
+                                         sha256 = %s, 
                                          sha1piecesize = %s,
-                                         sha1pieces = decode(%s, 'hex'), 
-                                         btih = decode(%s, 'hex'),
+                                         sha1pieces = %s, 
+                                         btih = %s,
                                          pgp = %s,
                                          zblocksize = %s,
                                          zhashlens = %s,
-                                         zsums = decode(%s, 'hex')
+                                         zsums = %s
                          WHERE file_id = %s""",
-                      [int(self.mtime), self.size,
-                       self.hb.md5hex or '', self.hb.sha1hex or '', self.hb.sha256hex or '',
-                       self.hb.chunk_size, ''.join(self.hb.pieceshex),
-                       self.hb.btihhex or '',
-                       self.hb.pgp or '', 
-                       self.hb.zblocksize,
-                       self.hb.get_zparams(),
-                       binascii.hexlify(''.join(self.hb.zsums)),
-                       file_id])
+                      values + [file_id])
             if verbose:
                 print 'Hash updated in database for %r' % self.src_rel
 
         c.execute('commit')
 
-        self.hb = None
+    def needs_rechunk(self, conn):
+        """check whether the hashes in the database are up to date, but
+        have pieces of another size than the one we'd use now"""
+        file_id, mtime, size, piecesize = self.db_lookup(conn)
+        return self.hb.do_chunked_hashes and self.db_uptodate(conn) \
+               and piecesize != self.hb.chunk_size
+
+
+    def rechunk(self, conn, verbose=False, dry_run=False):
+        """recompute the piece hashes (and the info hash, which depends on
+        them) with the current piece size, and update them in the database.
+        The other hashes are taken from the database, and not computed again."""
+        file_id, mtime, size, piecesize = self.db_lookup(conn)
+
+        if dry_run:
+            print 'Would rechunk %r (piece size %s -> %s)' \
+                    % (self.src_rel, piecesize, self.hb.chunk_size)
+            return
+
+        c = get_cursor(conn)
+        c.execute("SELECT md5, sha1, sha256 FROM hash WHERE file_id = %s",
+                  [file_id])
+        md5, sha1, sha256 = c.fetchone()
+        self.hb.md5 = str(md5)
+        self.hb.md5hex = binascii.hexlify(self.hb.md5)
+        self.hb.sha1 = str(sha1)
+        self.hb.sha1hex = binascii.hexlify(self.hb.sha1)
+        if sha256:
+            self.hb.sha256 = str(sha256)
+            self.hb.sha256hex = binascii.hexlify(self.hb.sha256)
+
+        self.hb.fill_pieces(verbose=verbose)
+        if self.hb.empty:
+            sys.stderr.write('skipping rechunking\n')
+            return
+
+        c.execute("""UPDATE hash SET sha1piecesize = %s,
+                                     sha1pieces = %s,
+                                     btih = %s
+                     WHERE file_id = %s""",
+                  [self.hb.chunk_size, buffer(self.hb.pieces), 
+                   buffer(self.hb.btih), file_id])
+        c.execute('commit')
+        self.dbinfo = (file_id, mtime, size, self.hb.chunk_size)
+        if verbose:
+            print 'Pieces updated in database for %r' % self.src_rel
+
+
+    def hash_values(self):
+        """return the values for a row in the hash table (matching
+        HASH_VALUES), from the filled HashBag. The piece hashes and zsync
+        checksums are not copied."""
+        return [int(self.mtime), self.size,
+                buffer(self.hb.md5 or ''),
+                buffer(self.hb.sha1 or ''),
+                buffer(self.hb.sha256 or ''),
+                self.hb.chunk_size,
+                buffer(self.hb.pieces),
+                buffer(self.hb.btih or ''),
+                self.hb.pgp or '',
+                self.hb.zblocksize,
+                self.hb.get_zparams(),
+                buffer(self.hb.zsums)]
 
     def __str__(self):
         return self.basename
 
 
 
+class DbBatch:
+    """collect hashes of several files and write them to the database
+    together: one transaction, with multi-row INSERTs, per batch.
+
+    The batch is written when it holds max_rows files or max_bytes of hash
+    data, and when flush() is called (mb makehashes does that for each
+    directory)."""
+
+    def __init__(self, conn, max_rows=1000, max_bytes=64*1024*1024):
+        self.conn = conn
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows = []
+        self.nbytes = 0
+
+    def add(self, path, file_id, replace, values):
+        """queue the hash values for a file. file_id is None if the file
+        isn't in the filearr table yet; if replace is True, an existing row in
+        the hash table is replaced."""
+        self.rows.append((path, file_id, replace, values))
+        self.nbytes += len(values[6]) * 2 + len(values[8]) + len(values[11]) * 2
+        if len(self.rows) >= self.max_rows or self.nbytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        c = get_cursor(self.conn)
+        c.execute('BEGIN')
+        try:
+            new_paths = [ path for path, file_id, replace, values in self.rows 
+                          if not file_id ]
+            new_ids = {}
+            if new_paths:
+                # another process (mb scan, mb file add) may have added some
+                # of the paths since they were looked up
+                c.execute("INSERT INTO filearr (path, mirrors) "
+                          "SELECT n.path, '{}' FROM (VALUES "
+                          + ', '.join([ c.mogrify("(%s)", [i]) for i in new_paths ])
+                          + ") AS n (path) "
+                          "WHERE NOT EXISTS "
+                          "(SELECT 1 FROM filearr f WHERE f.path = n.path)")
+                c.execute("SELECT id, path FROM filearr WHERE path IN %s",
+                          [tuple(new_paths)])
+                for file_id, path in c.fetchall():
+                    new_ids[path] = file_id
+
+            # files that were added meanwhile may have been hashed, too
+            replace_ids = [ file_id for path, file_id, replace, values in self.rows 
+                            if replace ] + new_ids.values()
+            if replace_ids:
+                c.execute("DELETE FROM hash WHERE file_id IN (%s)" 
+                          % ', '.join([ str(i) for i in replace_ids ]))
+
+            c.execute(self.insert_statement(c, new_ids))
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+        self.rows = []
+        self.nbytes = 0
+
+    def insert_statement(self, c, new_ids={}, table='hash'):
+        """return the multi-row INSERT into the hash table for the queued
+        rows. new_ids maps the paths of files new in filearr to their ids."""
+        return """INSERT INTO %s (file_id, mtime, size, md5, 
+                                sha1, sha256, sha1piecesize, 
+                                sha1pieces, btih, pgp, zblocksize,
+                                zhashlens, zsums) 
+                  VALUES """ % table \
+               + ', '.join([ c.mogrify("(%s, " + HASH_VALUES + ")", 
+                                       [file_id or new_ids[path]] + values)
+                             for path, file_id, replace, values in self.rows ])
+
+
+
 class HashBag:
 
     def __init__(self, src, parent=None):
@@ -236,28 +438,38 @@ class HashBag:
         self.pgp = None
 
         self.npieces = 0
-        self.pieces = []
-        self.pieceshex = []
+        # the SHA1 digests of all pieces, concatenated
+        self.pieces = bytearray()
         self.btih = None
         self.btihhex = None
 
         self.do_zsync_hashes = False
-        self.zsums = []
+        self.zsums = bytearray()
+        self.zsums_len = 0
         self.zblocksize = 0
         self.zseq_matches = None
         self.zrsum_len = None
         self.zchecksum_len = None
 
+        self.chunk_size = DEFAULT_PIECESIZE
+        self.readahead = 0
+        self.dropbehind = False
+        self.throttle = None
+
         self.empty = True
 
-    def fill(self, verbose=False):
-        verbose = True # XXX
+    def fill(self, verbose=False, quiet=False):
+        verbose = not quiet # XXX
         if verbose:
             sys.stdout.write('Hashing %r... ' % self.src)
             sys.stdout.flush()
 
         if self.do_zsync_hashes:
             self.zs_guess_zsync_params()
+            # one preallocated buffer for the checksums of all blocks
+            nblocks = (self.h.size + self.zblocksize - 1) // self.zblocksize
+            self.zsums = bytearray(nblocks * (self.zrsum_len + self.zchecksum_len))
+            self.zsums_len = 0
 
         m = md5.md5()
         s1 = sha1.sha1()
@@ -265,48 +477,108 @@ class HashBag:
             s256 = sha256.sha256()
         short_read_before = False
 
+        if self.do_chunked_hashes:
+            # one preallocated buffer for the digests of all pieces
+            self.pieces = bytearray(SHA1_DIGESTSIZE 
+                                    * ((self.h.size + self.chunk_size - 1) // self.chunk_size))
+        pieces_len = 0
+
         try:
             f = open(self.src, 'rb')
         except IOError, e:
             sys.stderr.write('%s\n' % e)
             return None
 
-        while 1 + 1 == 2:
-            buf = f.read(self.chunk_size)
-            if not buf: break
-
-            if len(buf) != self.chunk_size:
+        for buf, n in read_chunks(f, self.chunk_size, 
+                                  readahead=self.readahead,
+                                  dropbehind=self.dropbehind,
+                                  throttle=self.throttle):
+            if n != self.chunk_size:
                 if not short_read_before:
                     short_read_before = True
                 else:
                     raise('InternalError')
 
-            m.update(buf)
-            s1.update(buf)
+            # a zero-copy slice for the hash functions
+            data = buffer(buf, 0, n)
+
+            m.update(data)
+            s1.update(data)
             if sha256:
-                s256.update(buf)
+                s256.update(data)
 
             self.npieces += 1
             if self.do_chunked_hashes:
-                self.pieces.append(sha1.sha1(buf).digest())
-                self.pieceshex.append(sha1.sha1(buf).hexdigest())
+                self.pieces[pieces_len:pieces_len + SHA1_DIGESTSIZE] = sha1.sha1(data).digest()
+                pieces_len += SHA1_DIGESTSIZE
 
             if self.do_zsync_hashes:
-                self.zs_get_block_sums(buf)
+                self.zs_get_block_sums(buf, n)
 
         f.close()
 
+        # the file might have shrunk while we read it
+        del self.pieces[pieces_len:]
+        if self.do_zsync_hashes:
+            del self.zsums[self.zsums_len:]
+
         self.md5 = m.digest()
-        self.md5hex = m.hexdigest()
+        self.md5hex = binascii.hexlify(self.md5)
         self.sha1 = s1.digest()
-        self.sha1hex = s1.hexdigest()
+        self.sha1hex = binascii.hexlify(self.sha1)
         if sha256:
             self.sha256 = s256.digest()
-            self.sha256hex = s256.hexdigest()
+            self.sha256hex = binascii.hexlify(self.sha256)
 
         if self.do_chunked_hashes:
             self.calc_btih()
 
+        self.read_pgp()
+
+        #print len(self.zsums)
+
+        self.empty = False
+
+        if verbose:
+            sys.stdout.write('done.\n')
+
+
+    def fill_pieces(self, verbose=False):
+        """compute only the piece hashes (with the current chunk_size) and
+        the info hash. md5, sha1 and sha256 must be known already."""
+        if verbose:
+            sys.stdout.write('Rechunking %r... ' % self.src)
+            sys.stdout.flush()
+
+        try:
+            f = open(self.src, 'rb')
+        except IOError, e:
+            sys.stderr.write('%s\n' % e)
+            return None
+
+        self.pieces = bytearray(SHA1_DIGESTSIZE 
+                                * ((self.h.size + self.chunk_size - 1) // self.chunk_size))
+        pieces_len = 0
+        self.npieces = 0
+        for buf, n in read_chunks(f, self.chunk_size, 
+                                  readahead=self.readahead,
+                                  dropbehind=self.dropbehind,
+                                  throttle=self.throttle):
+            self.pieces[pieces_len:pieces_len + SHA1_DIGESTSIZE] = \
+                    sha1.sha1(buffer(buf, 0, n)).digest()
+            pieces_len += SHA1_DIGESTSIZE
+            self.npieces += 1
+        f.close()
+        del self.pieces[pieces_len:]
+
+        self.calc_btih()
+        self.empty = False
+
+        if verbose:
+            sys.stdout.write('done.\n')
+
+
+    def read_pgp(self):
         # if present, grab PGP signature
         # but not if the signature file is larger than 
         # the actual file -- that would be a sign that the signature
@@ -316,17 +588,10 @@ class HashBag:
             and os.stat(self.src + '.asc').st_size < self.h.size:
             self.pgp = open(self.src + '.asc').read()
 
-        #print len(self.zsums)
-
-        self.empty = False
-
-        if verbose:
-            sys.stdout.write('done.\n')
-
 
     def dump_raw(self):
         r = []
-        for i in self.pieceshex:
+        for i in self.iter_pieceshex():
             r.append('piece %s' % i)
         r.append('md5 %s' % self.md5hex)
         r.append('sha1 %s' % self.sha1hex)
@@ -336,6 +601,12 @@ class HashBag:
         return '\n'.join(r)
 
 
+    def iter_pieceshex(self):
+        """generate the hex digests of the pieces"""
+        for i in xrange(0, len(self.pieces), SHA1_DIGESTSIZE):
+            yield binascii.hexlify(buffer(self.pieces, i, SHA1_DIGESTSIZE))
+
+
     def get_zparams(self):
         if self.zseq_matches and \
            self.zrsum_len and \
@@ -392,46 +663,233 @@ class HashBag:
 
 
 
-    def zs_get_block_sums(self, buf):
-
-        offset = 0
-        while 1:
-            block = buf[ offset : offset + self.zblocksize ]
-            offset += self.zblocksize
-            if not block:
-                #print 'last.'
-                break
-
-            # padding
-            if len(block) < self.zblocksize:
-                block = block + ( '\x00' * ( self.zblocksize - len(block) ) )
+    def zs_get_block_sums(self, buf, n):
+        """compute the zsync checksums for the blocks in the first n bytes of buf,
+        and append them to self.zsums"""
 
-            md4 = hashlib.new('md4')
-            md4.update(block)
-            c = md4.digest()
-
-            if self.do_zsync_hashes:
-                r = zsync.rsum06(block)
+        needed = self.zsums_len \
+                 + (n + self.zblocksize - 1) // self.zblocksize \
+                   * (self.zrsum_len + self.zchecksum_len)
+        if needed > len(self.zsums):
+            # the file has grown while we read it
+            self.zsums.extend('\x00' * (needed - len(self.zsums)))
 
-                self.zsums.append( r[-self.zrsum_len:] )      # save only some trailing bytes
-                self.zsums.append( c[0:self.zchecksum_len] )  # save only some leading bytes
+        self.zsums_len = zsync.blocksums_into(self.zsums, self.zsums_len,
+                                              buffer(buf, 0, n),
+                                              self.zblocksize,
+                                              self.zrsum_len,
+                                              self.zchecksum_len)
 
 
     def calc_btih(self):
         """ calculate a bittorrent information hash (btih) """
 
-        buf = ['d', 
+        head = ['d', 
                  '6:length', 'i', str(self.h.size), 'e',
                  '6:md5sum', str(MD5_DIGESTSIZE * 2), ':', self.md5hex,
                  '4:name', str(len(self.basename)), ':', self.basename, 
                  '12:piece length', 'i', str(self.chunk_size), 'e',
-                 '6:pieces', str(len(self.pieces) * SHA1_DIGESTSIZE), ':', ''.join(self.pieces),
-                 '4:sha1', str(SHA1_DIGESTSIZE), ':', self.sha1,
+                 '6:pieces', str(len(self.pieces)), ':']
+        tail = ['4:sha1', str(SHA1_DIGESTSIZE), ':', self.sha1,
                  '6:sha256', str(SHA256_DIGESTSIZE), ':', self.sha256 or '',
                'e']
 
+        # hash the pieces without copying them
         h = sha1.sha1()
-        h.update(''.join(buf))
+        h.update(''.join(head))
+        h.update(buffer(self.pieces))
+        h.update(''.join(tail))
         self.btih = h.digest()
         self.btihhex = h.hexdigest()
 
+
+
+# a line of rsync's --itemize-changes output (also with --log-file prefix),
+# e.g. ">f.st...... dir/file", "cd+++++++++ dir/subdir/", "*deleting   dir/file"
+_re_itemized = re.compile(r"""
+            ^(?:\d{4}/\d\d/\d\d\ \d\d:\d\d:\d\d\ \[\d+\]\ )?   # log file prefix
+            (\*deleting|[<>ch.][fdLDS][^ ]{7,9})\ +                   # change summary
+            (.+)$
+            """, re.X)
+
+# other lines that rsync prints
+_rsync_noise = ('sending incremental file list', 'receiving incremental file list',
+                'building file list', 'created directory', 'sent ', 'total size is',
+                'total: ')
+
+
+def dirs_from_changelist(lines, startdir):
+    """Return the directories below (and including) startdir which need to be
+    looked at, given a list of changed paths.
+
+    The lines can be rsync --itemize-changes output (or an rsync log file),
+    or simply one path per line (as a file system watcher would write it).
+    Relative paths are taken as relative to startdir; absolute paths outside
+    of startdir are ignored.
+
+    For each changed path, the directory containing it is returned; that
+    is where new hashes are created, and where obsolete hashes of deleted
+    files and subdirectories are cleaned up. Changed directories are
+    returned themselves, too."""
+
+    startdir = startdir.rstrip('/')
+    dirs = set()
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip():
+            continue
+        deleted = False
+        m = _re_itemized.match(line)
+        if m:
+            deleted = m.group(1) == '*deleting'
+            path = m.group(2)
+        elif line.startswith('deleting '):
+            # rsync -v --delete without --itemize-changes
+            deleted = True
+            path = line[len('deleting '):]
+        elif line.startswith(_rsync_noise):
+            continue
+        else:
+            path = line
+
+        is_dir = path.endswith('/')
+        path = path.rstrip('/')
+        if not path.startswith('/'):
+            path = os.path.join(startdir, path)
+        path = os.path.normpath(path)
+        if path != startdir and not path.startswith(startdir + '/'):
+            continue
+
+        # a deleted directory is cleaned up when its parent is visited
+        if not deleted and (is_dir or os.path.isdir(path)):
+            dirs.add(path)
+        if path != startdir:
+            dirs.add(os.path.dirname(path))
+
+    return sorted(dirs)
+
+
+
+class Throttle:
+    """limit the rate of reading to a number of bytes per second, over
+    all the files that are read with it"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.start = time.time()
+        self.nbytes = 0
+
+    def __call__(self, n):
+        """account for n bytes read, and sleep if we are ahead"""
+        self.nbytes += n
+        ahead = self.nbytes / self.rate - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def read_chunks(f, chunk_size, readahead=0, dropbehind=False, throttle=None):
+    """Read a file chunk by chunk, and generate tuples (buf, n) with a
+    bytearray holding the chunk and the number of bytes in it. The buffers
+    are reused; one is valid only until the next chunk is requested.
+
+    With readahead > 0, a thread reads ahead and keeps up to that many chunks
+    in flight, so that reading (e.g. from NFS) and hashing overlap. The kernel
+    is told to read ahead as well.
+
+    With dropbehind, the pages of a chunk are dropped from the page cache
+    after it has been consumed, so that hashing a large tree doesn't evict
+    the files that the web server needs.
+
+    A Throttle can be passed to limit the bandwidth."""
+
+    fd = f.fileno()
+    mb.util.fadvise(fd, 0, 0, mb.util.POSIX_FADV_SEQUENTIAL)
+
+    if not readahead:
+        buf = bytearray(chunk_size)
+        offset = 0
+        while 1:
+            n = f.readinto(buf)
+            if not n:
+                break
+            if throttle:
+                throttle(n)
+            yield buf, n
+            if dropbehind:
+                mb.util.fadvise(fd, offset, n, mb.util.POSIX_FADV_DONTNEED)
+            offset += n
+        return
+
+    # readahead buffers being filled or waiting in the queue, plus the one
+    # being hashed
+    free = Queue.Queue()
+    for i in range(readahead + 1):
+        free.put(bytearray(chunk_size))
+    full = Queue.Queue(readahead)
+    stop = threading.Event()
+
+    def reader():
+        offset = 0
+        try:
+            while not stop.isSet():
+                buf = free.get()
+                if buf is None:
+                    break
+                mb.util.fadvise(fd, offset + readahead * chunk_size, chunk_size, 
+                                mb.util.POSIX_FADV_WILLNEED)
+                n = f.readinto(buf)
+                if throttle and n:
+                    throttle(n)
+                full.put((buf, n))
+                if not n:
+                    break
+                offset += n
+        except Exception:
+            # the consumer raises it again, rather than waiting forever
+            full.put((sys.exc_info(), 0))
+
+    t = threading.Thread(target=reader)
+    t.setDaemon(True)
+    t.start()
+
+    offset = 0
+    try:
+        while 1:
+            buf, n = full.get()
+            if isinstance(buf, tuple):
+                raise buf[0], buf[1], buf[2]
+            if not n:
+                break
+            yield buf, n
+            if dropbehind:
+                mb.util.fadvise(fd, offset, n, mb.util.POSIX_FADV_DONTNEED)
+            offset += n
+            free.put(buf)
+    finally:
+        # also when the consumer stopped early: wake up the reader, and
+        # make room in the queue until it is gone
+        stop.set()
+        free.put(None)
+        while t.isAlive():
+            try:
+                full.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        t.join()
+
+
+def init_worker():
+    """initializer for the processes of the worker pool (mb makehashes -j).
+    A Ctrl-C is handled by the parent, which terminates the pool."""
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def fill_worker(hb):
+    """compute the hashes of a HashBag in a worker process, and send the
+    filled HashBag back. The parent process prints the progress, so that the
+    output is in order regardless of the number of workers."""
+    hb.fill(quiet=True)
+    # the parent re-attaches its own Hasheable; no need to pickle it back
+    hb.h = None
+    return hb
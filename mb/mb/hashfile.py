@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+"""
+A compact binary format for the hashes of a file, which mb makehashes can
+write into the hash files in its target directory (the ".size_N" files),
+when hash_files = 1 is set in the instance section of mirrorbrain.conf.
+
+Layout (all integers little endian):
+
+    header      see HEADER below
+    pieces      npieces SHA1 digests, 20 bytes each
+    zsums       the zsync checksums, zrsum_len + zchecksum_len bytes per block
+
+The piece table is contiguous and at a fixed offset, so a reader can mmap
+the file and access single pieces, or ranges of them, without loading
+everything:
+
+    hf = mb.hashfile.HashFile(path)
+    print hf.md5hex, len(hf)
+    piece = hf[1000]
+    some = hf.pieces(1000, 2000)
+    hf.close()
+"""
+
+import os
+import mmap
+import struct
+import binascii
+
+import mb.mberr
+
+
+MAGIC = 'MBHASH\r\n'
+VERSION = 1
+
+FLAG_PIECES = 1
+FLAG_ZSYNC = 2
+FLAG_SHA256 = 4
+
+# magic, version, header size, flags,
+# file size, file mtime,
+# chunk size, number of pieces,
+# zsync block size, zsync parameters (seq_matches, rsum_len, checksum_len),
+# md5, sha1, sha256, btih,
+# length of the zsync checksums
+HEADER = struct.Struct('<8sHHI QQ II IBBBx 16s20s32s20s Q')
+
+PIECE_SIZE = 20
+
+
+def write(path, hb):
+    """write the hashes of a filled HashBag to path.
+
+    The file is written under a temporary name and renamed, so readers never
+    see a partial file."""
+
+    flags = 0
+    pieces = ''
+    if hb.do_chunked_hashes and hb.pieces:
+        flags |= FLAG_PIECES
+        pieces = hb.pieces
+    zsums = ''
+    zparams = (0, 0, 0)
+    if hb.do_zsync_hashes and hb.zblocksize:
+        flags |= FLAG_ZSYNC
+        zsums = hb.zsums
+        zparams = (hb.zseq_matches, hb.zrsum_len, hb.zchecksum_len)
+    if hb.sha256:
+        flags |= FLAG_SHA256
+
+    header = HEADER.pack(MAGIC, VERSION, HEADER.size, flags,
+                         hb.h.size, int(hb.h.mtime),
+                         hb.chunk_size, len(pieces) // PIECE_SIZE,
+                         hb.zblocksize, zparams[0], zparams[1], zparams[2],
+                         hb.md5, hb.sha1, hb.sha256 or '', hb.btih or '',
+                         len(zsums))
+
+    tmp = '%s.new' % path
+    f = open(tmp, 'wb')
+    try:
+        f.write(header)
+        f.write(pieces)
+        f.write(zsums)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+
+class HashFile:
+    """read a hash file, with random access to the piece table"""
+
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # an empty file can't be mapped; these are the plain
+                # markers that makehashes writes without hash_files = 1
+                raise mb.mberr.HashFileError(path, 'empty or not mappable')
+        finally:
+            f.close()
+
+        if len(self.map) < HEADER.size:
+            self.close()
+            raise mb.mberr.HashFileError(path, 'file too short')
+
+        (magic, version, header_size, self.flags,
+         self.size, self.mtime,
+         self.chunk_size, self.npieces,
+         self.zblocksize, self.zseq_matches, self.zrsum_len, self.zchecksum_len,
+         self.md5, self.sha1, sha256, btih,
+         self.zsums_len) = HEADER.unpack_from(self.map)
+
+        if magic != MAGIC:
+            self.close()
+            raise mb.mberr.HashFileError(path, 'not a hash file')
+        if version != VERSION:
+            self.close()
+            raise mb.mberr.HashFileError(path, 'unsupported version %s' % version)
+
+        self.sha256 = (self.flags & FLAG_SHA256) and sha256 or None
+        self.btih = (self.flags & FLAG_PIECES) and btih or None
+
+        self.pieces_offset = header_size
+        self.zsums_offset = header_size + self.npieces * PIECE_SIZE
+        if len(self.map) < self.zsums_offset + self.zsums_len:
+            self.close()
+            raise mb.mberr.HashFileError(path, 'file truncated')
+
+    def __len__(self):
+        return self.npieces
+
+    def __getitem__(self, i):
+        return self.piece(i)
+
+    def piece(self, i):
+        """return the SHA1 digest of piece number i"""
+        if i < 0:
+            i += self.npieces
+        if not 0 <= i < self.npieces:
+            raise IndexError('piece index out of range')
+        offset = self.pieces_offset + i * PIECE_SIZE
+        return self.map[offset:offset + PIECE_SIZE]
+
+    def pieces(self, start=0, stop=None):
+        """return the concatenated SHA1 digests of pieces start to stop-1"""
+        if stop is None or stop > self.npieces:
+            stop = self.npieces
+        start = max(0, min(start, stop))
+        return self.map[self.pieces_offset + start * PIECE_SIZE:
+                        self.pieces_offset + stop * PIECE_SIZE]
+
+    def zsums(self, start=0, stop=None):
+        """return the zsync checksums of blocks start to stop-1"""
+        blen = self.zrsum_len + self.zchecksum_len
+        if not blen:
+            return ''
+        nblocks = self.zsums_len // blen
+        if stop is None or stop > nblocks:
+            stop = nblocks
+        start = max(0, min(start, stop))
+        return self.map[self.zsums_offset + start * blen:
+                        self.zsums_offset + stop * blen]
+
+    @property
+    def md5hex(self):
+        return binascii.hexlify(self.md5)
+
+    @property
+    def sha1hex(self):
+        return binascii.hexlify(self.sha1)
+
+    @property
+    def sha256hex(self):
+        return self.sha256 and binascii.hexlify(self.sha256)
+
+    @property
+    def btihhex(self):
+        return self.btih and binascii.hexlify(self.btih)
+
+    def get_zparams(self):
+        if self.flags & FLAG_ZSYNC:
+            return '%s,%s,%s' % (self.zseq_matches, self.zrsum_len, self.zchecksum_len)
+        return ''
+
+    def close(self):
+        self.map.close()
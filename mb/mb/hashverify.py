@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+"""
+Verification of the hashes in the database against the files, to detect
+bit rot, or files that were replaced without changing mtime and size.
+
+Each run reads a sample of the files: those which weren't verified for the
+longest time (or never) come first. When it is done to a fraction of 1/N
+of the files each day, every file is verified once in N days. When and with
+which result a file was verified is kept in the hashverify table.
+"""
+
+import os
+import sys
+import errno
+
+import mb.dal
+import mb.hashes
+
+
+def has_table(conn):
+    c = mb.hashes.get_cursor(conn)
+    c.execute("SELECT 1 FROM pg_tables WHERE tablename = 'hashverify'")
+    return bool(c.fetchone())
+
+
+def candidates(conn, path, fraction=None, max_bytes=None):
+    """Return tuples of (path, file_id, mtime, size) of files with hashes
+    below path (relative to the base directory), least recently verified
+    first: fraction of all files, and/or as many as fit into max_bytes (but
+    one at least)."""
+
+    c = mb.hashes.get_cursor(conn)
+
+    if path:
+        where = "WHERE filearr.path LIKE %s"
+        args = [mb.dal.like_esc(path) + '/%']
+    else:
+        where = ""
+        args = []
+
+    limit = None
+    if fraction is not None:
+        c.execute("""SELECT count(*) FROM hash
+                     JOIN filearr ON filearr.id = hash.file_id """ + where, args)
+        total = c.fetchone()[0]
+        limit = max(1, int(round(total * fraction)))
+
+    # the bytes of the files up to each one are summed up in the database,
+    # so that only those which fit into max_bytes are fetched
+    query = """SELECT path, file_id, mtime, size FROM (
+                   SELECT filearr.path, hash.file_id, hash.mtime, hash.size,
+                          sum(hash.size) OVER w AS nbytes, row_number() OVER w AS n
+                   FROM hash
+                   JOIN filearr ON filearr.id = hash.file_id
+                   LEFT JOIN hashverify ON hashverify.file_id = hash.file_id
+                   """ + where + """
+                   WINDOW w AS (ORDER BY hashverify.verified NULLS FIRST, hash.file_id)
+               ) AS candidates"""
+    if max_bytes is not None:
+        query += " WHERE n = 1 OR nbytes <= %s"
+        args.append(max_bytes)
+    query += " ORDER BY n"
+    if limit is not None:
+        query += " LIMIT %d" % limit
+    c.execute(query, args)
+    return c.fetchall()
+
+
+def record(conn, file_id, ok):
+    """remember that a file was verified now, and the result: True or
+    False, or None if it couldn't be compared with its hashes"""
+    c = mb.hashes.get_cursor(conn)
+    c.execute("UPDATE hashverify SET verified = now(), ok = %s WHERE file_id = %s",
+              [ok, file_id])
+    if not c.rowcount:
+        c.execute("INSERT INTO hashverify (file_id, verified, ok) VALUES (%s, now(), %s)",
+                  [file_id, ok])
+    c.execute('commit')
+
+
+def verify_file(conn, hasheable, file_id):
+    """hash a file and compare with the hashes in the database.
+
+    Returns a list of the names of the hashes that don't match."""
+
+    c = mb.hashes.get_cursor(conn)
+    c.execute("""SELECT md5, sha1, sha256, sha1piecesize, sha1pieces
+                 FROM hash WHERE file_id = %s""", [file_id])
+    md5, sha1, sha256, piecesize, pieces = c.fetchone()
+
+    hb = hasheable.hb
+    hb.do_zsync_hashes = False
+    hb.do_chunked_hashes = bool(pieces)
+    hb.chunk_size = piecesize or hb.chunk_size
+    hb.fill(quiet=True)
+    if hb.empty:
+        return None
+
+    mismatches = []
+    if str(md5) != hb.md5:
+        mismatches.append('md5')
+    if str(sha1) != hb.sha1:
+        mismatches.append('sha1')
+    if sha256 and hb.sha256 and str(sha256) != hb.sha256:
+        mismatches.append('sha256')
+    if pieces and str(pieces) != str(hb.pieces):
+        mismatches.append('sha1pieces')
+    return mismatches
+
+
+def verify(conn, startdir, base_dir, fraction=None, max_bytes=None,
+           bwlimit=None, dry_run=False, verbose=False):
+    """verify a sample of the files below startdir.
+
+    Returns a tuple of (number of verified files, bytes read, list of paths
+    with mismatching hashes)."""
+
+    path = startdir[len(base_dir):].strip('/')
+    rows = candidates(conn, path, fraction=fraction, max_bytes=max_bytes)
+
+    throttle = None
+    if bwlimit:
+        throttle = mb.hashes.Throttle(bwlimit)
+
+    nfiles = nbytes = 0
+    bad = []
+    for src_rel, file_id, mtime, size in rows:
+        src = os.path.join(base_dir, src_rel)
+        if dry_run:
+            print 'Would verify %r' % src
+            continue
+
+        try:
+            hasheable = mb.hashes.Hasheable(os.path.basename(src),
+                                            src_dir=os.path.dirname(src),
+                                            dst_dir='/nonexistent',
+                                            base_dir=base_dir)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                if verbose:
+                    print 'File vanished, not verified: %r' % src
+                # it goes to the end of the queue, like a verified file
+                record(conn, file_id, None)
+                continue
+            raise
+
+        if int(hasheable.mtime) != mtime or hasheable.size != size:
+            # it changed in a regular way; makehashes will take care of it
+            if verbose:
+                print 'File changed since it was hashed, not verified: %r' % src
+            record(conn, file_id, None)
+            continue
+
+        hasheable.hb.throttle = throttle
+        mismatches = verify_file(conn, hasheable, file_id)
+        if mismatches is None:
+            record(conn, file_id, None)
+            continue
+
+        nfiles += 1
+        nbytes += size
+        if mismatches:
+            print 'MISMATCH (%s): %r' % (', '.join(mismatches), src)
+            bad.append(src)
+        elif verbose:
+            print 'Verified: %r' % src
+        record(conn, file_id, not mismatches)
+
+    return nfiles, nbytes, bad
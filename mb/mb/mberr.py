@@ -57,3 +57,18 @@ class NameOrServiceNotKnown(MbBaseError):
         MbBaseError.__init__(self)
         self.msg = 'DNS lookup for hostname %r failed: Name or service not known' % hostname
 
+
+class CrawlError(MbBaseError):
+    """Raised when listing the files on a mirror failed"""
+    def __init__(self, url, msg):
+        MbBaseError.__init__(self)
+        self.url = url
+        self.msg = 'Could not list the files at %r: %s' % (url, msg)
+
+
+class HashFileError(MbBaseError):
+    """Raised when a binary hash file cannot be read"""
+    def __init__(self, path, msg):
+        MbBaseError.__init__(self)
+        self.path = path
+        self.msg = '%r: %s' % (path, msg)
@@ -15,12 +15,15 @@ def is_odd(n):
 
 
 def genlist(conn, opts, mirrors, markers, format='txt2'):
+    mirrors = list(mirrors)
+    matrix = mb.files.marker_matrix(conn, markers, mirrors)
+
     if format == 'txt':
-        gen = txt(conn, opts, mirrors, markers)
+        gen = txt(conn, opts, mirrors, markers, matrix)
     elif format == 'txt2':
-        gen =txt2(conn, opts, mirrors, markers)
+        gen =txt2(conn, opts, mirrors, markers, matrix)
     elif format == 'xhtml':
-        gen = xhtml(conn, opts, mirrors, markers)
+        gen = xhtml(conn, opts, mirrors, markers, matrix)
 
     if not opts.output:
         for i in gen:
@@ -52,27 +55,27 @@ def genlist(conn, opts, mirrors, markers, format='txt2'):
 
 
 
-def txt(conn, opts, mirrors, markers):
+def txt(conn, opts, mirrors, markers, matrix):
     for mirror in mirrors:
         yield ''
         yield mirror.identifier
         #yield mirror.identifier, mirror.baseurl, mirror.baseurlFtp, mirror.baseurlRsync, mirror.score
 
         for marker in markers:
-            if mb.files.check_for_marker_files(conn, marker.markers, mirror.id):
+            if mirror.id in matrix[marker.markers]:
                 yield '+' + marker.subtreeName
             else:
                 yield '-' + marker.subtreeName
 
 
-def txt2(conn, opts, mirrors, markers):
+def txt2(conn, opts, mirrors, markers, matrix):
     for mirror in mirrors:
         for marker in markers:
-            if mb.files.check_for_marker_files(conn, marker.markers, mirror.id):
+            if mirror.id in matrix[marker.markers]:
                 yield '%s: %s' % (mirror.identifier, marker.subtreeName)
 
 
-def xhtml(conn, opts, mirrors, markers):
+def xhtml(conn, opts, mirrors, markers, matrix):
 
     if opts.inline_images_from:
         import os
@@ -269,7 +272,7 @@ def xhtml(conn, opts, mirrors, markers):
         col_cnt = 0
         for marker in markers:
             col_cnt += 1
-            if mb.files.check_for_marker_files(conn, marker.markers, mirror.id):
+            if mirror.id in matrix[marker.markers]:
                 #checkmark = '√'
                 checkmark = '&radic;'
                 empty = False
@@ -0,0 +1,434 @@
+"""
+Scan mirrors in-process.
+
+The files on a mirror are listed with the crawlers in mb.crawlers (via
+rsync, FTP or HTTP, whichever of its base URLs works first), and streamed
+into the database with mb.files.apply_snapshot(). Several mirrors can be
+scanned at the same time; each scan runs in a thread of its own, with its
+own database connection:
+
+    f = mb.scanner.Filter(top_include=['distribution', 'update'])
+    for r in mb.scanner.scan_mirrors(conn, mirrors, f, jobs=4):
+        print r.mirror.identifier, r.files, r.bytes, r.duration
+
+With a snapshot directory, the listing of each mirror is kept there (see
+mb.snapshot), and the next scan only sends the paths that were added or
+removed since to the database.
+
+This replaces the Perl scanner (tools/scanner.pl), which "mb scan" still
+runs when it is given with --scanner.
+"""
+
+import os
+import re
+import sys
+import time
+import tempfile
+import itertools
+import threading
+import Queue
+from collections import namedtuple
+
+import mb.dal
+import mb.files
+import mb.crawlers
+import mb.mberr
+import mb.snapshot
+
+
+# the result of scanning a mirror. files and bytes are what was listed,
+# added and removed what changed in the database, duration is in seconds.
+# dirs is the number of directories listed, and pruned of those skipped as
+# unchanged (both are 0 where not known, as with rsync). error is None, or
+# tells why the mirror couldn't be scanned (then the database was left
+# alone).
+ScanResult = namedtuple('ScanResult', 'mirror url files bytes added removed dirs pruned duration error')
+
+
+class Filter:
+    """decide which files and directories of a mirror are scanned, according
+    to the scan_top_include, scan_exclude and scan_exclude_rsync settings
+
+    top_include and exclude are regular expressions, exclude_rsync are
+    rsync patterns, as the Perl scanner used them: a top-level directory is
+    scanned only if its name matches one of top_include (if any are given),
+    and paths that match one of exclude are skipped when scanning via HTTP
+    or FTP. Via rsync, the top-level directories are included with
+    --include=/PATTERN, and exclude_rsync are passed as --exclude=PATTERN.
+
+    exclude are matched against the path both as it is and with a leading
+    slash, like distribution/11.0/repo/ and /distribution/11.0/repo/, so
+    that the patterns written for the Perl scanner keep working: via HTTP,
+    it matched the path without the slash, and via FTP, with the slash at
+    the top level only."""
+
+    def __init__(self, top_include=(), exclude=(), exclude_rsync=()):
+        self.top_include_rsync = list(top_include)
+        self.top_include = [ re.compile(i) for i in top_include ]
+        # temporary directories of rsync are never scanned
+        self.exclude = [ re.compile(i) for i in ['/.~tmp~/'] + list(exclude) ]
+        self.exclude_rsync = ['*/.~tmp~/', '/.~tmp~/'] + list(exclude_rsync)
+
+    def skip(self, path):
+        """return True if path (relative to the base URL of the mirror; with
+        a trailing slash for directories) is not to be scanned"""
+
+        if self.top_include:
+            top = path.split('/', 1)[0]
+            if top == path or top + '/' == path:
+                for r in self.top_include:
+                    if r.search(top):
+                        break
+                else:
+                    return True
+
+        for r in self.exclude:
+            if r.search(path) or r.search('/' + path):
+                return True
+        return False
+
+    def rsync_args(self, directory=None):
+        """return the include and exclude arguments for rsync"""
+        args = []
+        # when scanning a subdirectory, the top level isn't listed
+        if self.top_include_rsync and not directory:
+            args += [ '--include=/%s' % i for i in self.top_include_rsync ]
+            args.append('--exclude=/*')
+        args += [ '--exclude=%s' % i for i in self.exclude_rsync ]
+        return args
+
+
+def mirror_urls(mirror):
+    """return the URLs to try for scanning a mirror, in order of
+    preference"""
+    return [ url for url in (mirror.baseurlRsync, mirror.baseurlFtp, mirror.baseurl)
+             if url ]
+
+
+def crawl(url, filter, directory=None, verbose=0, fingerprints=None):
+    """list the files on a mirror below url (or below directory, relative to
+    url) and return an iterator of the mb.crawlers.Entry tuples, with paths
+    relative to url, that filter doesn't skip
+
+    fingerprints (a mb.crawlers.Fingerprints) are passed to the FTP and HTTP
+    crawlers. rsync lists the whole tree in one go, so there is nothing to
+    skip."""
+
+    prefix = ''
+    if directory:
+        prefix = directory.strip('/') + '/'
+        url = url.rstrip('/') + '/' + prefix
+
+    def exclude(path):
+        return filter.skip(prefix + path)
+
+    if url.startswith('rsync') or '::' in url:
+        import mb.crawlers.rsync
+        entries = mb.crawlers.rsync.gen_filelist(url, args=filter.rsync_args(directory))
+    elif url.startswith('http'):
+        import mb.crawlers.http
+        entries = mb.crawlers.http.gen_filelist(url, exclude=exclude,
+                                                fingerprints=fingerprints)
+    elif url.startswith('ftp'):
+        import mb.crawlers.ftp
+        entries = mb.crawlers.ftp.gen_filelist(url, verbose=verbose > 1, exclude=exclude,
+                                               fingerprints=fingerprints)
+    else:
+        raise mb.mberr.CrawlError(url, 'unknown type of URL')
+
+    for entry in entries:
+        path = prefix + entry.path
+        if not filter.skip(path):
+            yield entry._replace(path=path)
+
+
+def _lines(f):
+    f.seek(0)
+    for line in f:
+        yield line.rstrip('\n')
+
+
+def _retry(apply, tries=3):
+    """call apply, again if the database aborted its transaction because of
+    a deadlock, which can happen when mirrors with files in common are
+    scanned at the same time. apply has to start over with the same
+    listing each time."""
+    import psycopg2.extensions
+    for attempt in range(tries):
+        try:
+            return apply()
+        except psycopg2.extensions.TransactionRollbackError:
+            if attempt == tries - 1:
+                raise
+            time.sleep(attempt + 1)
+
+
+class _Counter:
+    """pass the entries through, counting them and their bytes"""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.files = 0
+        self.bytes = 0
+
+    def __iter__(self):
+        for e in self.entries:
+            self.files += 1
+            self.bytes += e.size or 0
+            yield e
+
+
+def apply_listing(conn, mirror, entries, snapshot, directory=None, cursor=None,
+                  fingerprints=None, full=False):
+    """compare the entries listed on a mirror with its snapshot, apply the
+    difference to the database, and replace the snapshot; return a tuple
+    of (files added, files removed)
+
+    If the number of files of the mirror in the database isn't what the
+    snapshot says (or there is no snapshot yet, or full is True), all files
+    are applied with mb.files.apply_snapshot() instead. With directory,
+    entries are the files below that directory, and the rest of the
+    snapshot is kept. So are the files in the directories that the crawler
+    pruned according to fingerprints, which are stored with the snapshot."""
+
+    prefix = ''
+    if directory:
+        prefix = directory.strip('/') + '/'
+    had_snapshot = snapshot.exists()
+    old = had_snapshot and snapshot.read() or []
+    added = tempfile.TemporaryFile()
+    removed = tempfile.TemporaryFile()
+    counts = { '+': 0, '-': 0, '=': 0 }
+
+    pruned = fingerprints and fingerprints.pruned or None
+
+    def merge():
+        for op, entry in mb.snapshot.diff(old, mb.snapshot.sort_entries(entries),
+                                          prefix, pruned):
+            counts[op] += 1
+            if op == '+':
+                added.write(entry.path + '\n')
+            elif op == '-':
+                removed.write(entry.path + '\n')
+                continue
+            yield entry
+
+    try:
+        snapshot.write(merge())
+        if fingerprints:
+            snapshot.write_dirs(fingerprints.new)
+
+        def apply():
+            c = cursor or mb.dal.get_cursor(conn)
+            c.execute('SELECT mirr_get_nfiles(%s)', [mirror.id])
+            nfiles = c.fetchone()[0]
+            if had_snapshot and not full and nfiles == counts['='] + counts['-']:
+                return mb.files.apply_diff(conn, mirror, _lines(added), _lines(removed),
+                                           cursor=cursor)
+            # no snapshot yet, or the database was changed otherwise since
+            paths = ( e.path for e in snapshot.read_new() if e.path.startswith(prefix) )
+            n, nadded, nremoved = mb.files.apply_snapshot(conn, mirror, paths,
+                                                          subtree=directory,
+                                                          cursor=cursor)
+            return nadded, nremoved
+
+        nadded, nremoved = _retry(apply)
+    except:
+        snapshot.abort()
+        raise
+    finally:
+        added.close()
+        removed.close()
+    snapshot.commit()
+
+    return nadded, nremoved
+
+
+def _apply_entries(conn, mirror, entries, directory=None, cursor=None):
+    """apply the listed entries to the database with
+    mb.files.apply_snapshot(), while they are listed; return a tuple of
+    (files added, files removed)
+
+    The paths are kept in a temporary file as they go by, so that they can
+    be applied again if the transaction is aborted."""
+
+    spool = tempfile.TemporaryFile()
+    streamed = []
+
+    def paths():
+        for e in entries:
+            spool.write(e.path + '\n')
+            yield e.path
+
+    def apply():
+        if not streamed:
+            streamed.append(True)
+            p = paths()
+        else:
+            # what wasn't listed yet
+            for e in entries:
+                spool.write(e.path + '\n')
+            p = _lines(spool)
+        n, added, removed = mb.files.apply_snapshot(conn, mirror, p,
+                                                    subtree=directory,
+                                                    cursor=cursor)
+        return added, removed
+
+    try:
+        return _retry(apply)
+    finally:
+        spool.close()
+
+
+def scan_mirror(conn, mirror, filter, directory=None, cursor=None, verbose=0,
+                snapshot_dir=None, full=False):
+    """scan a mirror and make the database reflect the files found on it;
+    return a ScanResult
+
+    The URLs of the mirror are tried in turn (rsync, FTP, HTTP) until one
+    can be listed and has files. If none can, the database isn't touched.
+    With directory, only that subdirectory is scanned, and only files there
+    are removed from the mirror. Otherwise, the last_scan time and scan_fpm
+    (files per minute) of the mirror are updated.
+
+    With snapshot_dir, only the difference to the snapshot of the last scan
+    is applied (see apply_listing()), and directories that didn't change
+    since are not listed again, but taken from the snapshot. A subdirectory
+    is scanned that way only if there is a snapshot of the whole mirror
+    already. With full, all directories are listed, and all files applied."""
+
+    snapshot = None
+    prefix = ''
+    if snapshot_dir:
+        snapshot = mb.snapshot.Snapshot(snapshot_dir, mirror.identifier)
+        if directory and not snapshot.exists():
+            snapshot = None
+    if directory:
+        prefix = directory.strip('/') + '/'
+
+    start = time.time()
+    error = 'no URL to scan'
+    for url in mirror_urls(mirror):
+        if verbose:
+            print '%s %s: listing %s' % (time.ctime(), mirror.identifier, url)
+            sys.stdout.flush()
+        fingerprints = None
+        if snapshot:
+            old = {}
+            if snapshot.exists() and not full:
+                old = snapshot.read_dirs()
+            fingerprints = mb.crawlers.Fingerprints(old, prefix)
+        entries = crawl(url, filter, directory=directory, verbose=verbose,
+                        fingerprints=fingerprints)
+        try:
+            # see if the listing works, before anything is changed
+            first = [ entries.next() ]
+        except StopIteration:
+            if not fingerprints or not fingerprints.pruned:
+                error = '%s: no files found' % url
+                continue
+            # nothing changed where files are
+            first = []
+        except mb.mberr.CrawlError, e:
+            error = e.msg
+            continue
+
+        counter = _Counter(itertools.chain(first, entries))
+        try:
+            if snapshot:
+                added, removed = apply_listing(conn, mirror, counter, snapshot,
+                                               directory=directory, cursor=cursor,
+                                               fingerprints=fingerprints, full=full)
+            else:
+                added, removed = _apply_entries(conn, mirror, counter, directory, cursor)
+        except mb.mberr.CrawlError, e:
+            # nothing was applied to the database
+            return ScanResult(mirror, url, counter.files, counter.bytes, 0, 0, 0, 0,
+                              time.time() - start, e.msg)
+
+        duration = time.time() - start
+        if not directory:
+            c = cursor or mb.dal.get_cursor(conn)
+            c.execute('UPDATE server SET last_scan = NOW(), scan_fpm = %s WHERE id = %s',
+                      [int(60 * counter.files / max(duration, 1)), mirror.id])
+
+        dirs = pruned = 0
+        if fingerprints:
+            dirs = fingerprints.listed + len(fingerprints.pruned)
+            pruned = len(fingerprints.pruned)
+        return ScanResult(mirror, url, counter.files, counter.bytes,
+                          added, removed, dirs, pruned, duration, None)
+
+    return ScanResult(mirror, None, 0, 0, 0, 0, 0, 0, time.time() - start, error)
+
+
+def _scan_mirror(conn, mirror, filter, **opts):
+    """scan_mirror(), but return unexpected errors as a failed ScanResult,
+    so that they don't end the scans of the other mirrors"""
+    try:
+        return scan_mirror(conn, mirror, filter, **opts)
+    except Exception, e:
+        return ScanResult(mirror, None, 0, 0, 0, 0, 0, 0, 0,
+                          '%s: %s' % (e.__class__.__name__, e))
+
+
+class _Scanner(threading.Thread):
+    """scan mirrors from a queue over a database connection of its own, and
+    put the results into another queue. opts are passed on to
+    scan_mirror()."""
+
+    def __init__(self, conn, filter, todo, results, opts):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.conn = conn
+        self.filter = filter
+        self.todo = todo
+        self.results = results
+        self.opts = opts
+
+    def run(self):
+        pool = self.conn.Server._connection
+        dbconn = pool.getConnection()
+        cursor = dbconn.cursor()
+        try:
+            while True:
+                mirror = self.todo.get()
+                if mirror is None:
+                    break
+                self.results.put(_scan_mirror(self.conn, mirror, self.filter,
+                                              cursor=cursor, **self.opts))
+        finally:
+            cursor.close()
+            pool.releaseConnection(dbconn)
+
+
+def scan_mirrors(conn, mirrors, filter, directory=None, jobs=1, verbose=0,
+                 snapshot_dir=None, full=False):
+    """scan mirrors, up to jobs of them at the same time, and return an
+    iterator of the ScanResults, in the order in which the scans finish"""
+
+    mirrors = list(mirrors)
+    if snapshot_dir and not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    opts = dict(directory=directory, verbose=verbose, 
+                snapshot_dir=snapshot_dir, full=full)
+    if jobs <= 1 or len(mirrors) == 1:
+        for mirror in mirrors:
+            yield _scan_mirror(conn, mirror, filter, **opts)
+        return
+
+    todo = Queue.Queue()
+    results = Queue.Queue()
+    for mirror in mirrors:
+        todo.put(mirror)
+    threads = [ _Scanner(conn, filter, todo, results, opts)
+                for i in range(min(jobs, len(mirrors))) ]
+    for t in threads:
+        todo.put(None)
+        t.start()
+
+    for i in range(len(mirrors)):
+        yield results.get()
+
+    for t in threads:
+        t.join()
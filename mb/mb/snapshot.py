@@ -0,0 +1,212 @@
+"""
+Listings of the files on a mirror, kept from one scan to the next.
+
+A snapshot is a gzip-compressed text file with a line per file, sorted by
+path, with path, size and modification time separated by tabs. A new
+listing is sorted (externally, in chunks, so that memory use doesn't grow
+with the size of the mirror), and compared to the snapshot of the previous
+scan in a single pass, so that only the paths that were added or removed
+need to go to the database:
+
+    old = mb.snapshot.Snapshot('/var/lib/mirrorbrain/snapshots', 'ftp.example.org')
+    new = mb.snapshot.sort_entries(entries)
+    for op, entry in mb.snapshot.diff(old.read(), new):
+        ...
+
+Next to it, the fingerprints of the directories (see
+mb.crawlers.Fingerprints) are kept, to let the crawlers skip directories
+that didn't change.
+"""
+
+import os
+import gzip
+import heapq
+import tempfile
+
+from mb.crawlers import Entry
+
+
+def _str(i):
+    if i is None:
+        return ''
+    return str(i)
+
+
+def _int(s):
+    if not s:
+        return None
+    return int(s)
+
+
+def _line(entry):
+    return '%s\t%s\t%s\n' % (entry.path, _str(entry.size), _str(entry.mtime))
+
+
+def _entry(line):
+    # paths can contain tabs, sizes and times can't
+    path, size, mtime = line.rstrip('\n').rsplit('\t', 2)
+    return Entry(path, _int(size), _int(mtime))
+
+
+def _read(f):
+    try:
+        for line in f:
+            yield _entry(line)
+    finally:
+        f.close()
+
+
+def _spill(entries, tmpdir=None):
+    f = tempfile.TemporaryFile(dir=tmpdir)
+    for entry in entries:
+        f.write(_line(entry))
+    f.seek(0)
+    return f
+
+
+def sort_entries(entries, chunk_size=200000, tmpdir=None):
+    """return an iterator of the entries sorted by path
+
+    Up to chunk_size entries are sorted in memory at a time, and written to
+    temporary files, which are merged then. Paths containing a newline
+    can't be stored in a snapshot and are left out."""
+
+    chunks = []
+    buf = []
+    for entry in entries:
+        if '\n' in entry.path:
+            continue
+        buf.append(entry)
+        if len(buf) >= chunk_size:
+            buf.sort()
+            chunks.append(_spill(buf, tmpdir))
+            buf = []
+    buf.sort()
+    if not chunks:
+        return iter(buf)
+    chunks.append(_spill(buf, tmpdir))
+    return heapq.merge(*[ _read(f) for f in chunks ])
+
+
+def diff(old, new, prefix='', pruned=None):
+    """compare two iterators of entries sorted by path, and return an
+    iterator of tuples of (op, entry), in the order of the paths, where op
+    is '-' for paths only in old, '+' for paths only in new, and '=' for
+    paths in both (with the new entry). Duplicate paths in new are dropped.
+
+    With prefix, new contains only the paths starting with it (the listing
+    of a subdirectory); entries of old elsewhere are passed on as '='. The
+    same goes for entries of old in the directories in pruned (a set of
+    directory paths with trailing slashes), which weren't listed."""
+
+    def gone(path):
+        if not path.startswith(prefix):
+            return False
+        if pruned and path[:path.rfind('/') + 1] in pruned:
+            return False
+        return True
+
+    old = iter(old)
+    new = iter(new)
+    o = next(old, None)
+    n = next(new, None)
+    last = None
+    while n is not None:
+        if n.path == last:
+            n = next(new, None)
+            continue
+        if o is None or n.path < o.path:
+            yield '+', n
+            last = n.path
+            n = next(new, None)
+        elif n.path == o.path:
+            yield '=', n
+            last = n.path
+            n = next(new, None)
+            o = next(old, None)
+        else:
+            yield gone(o.path) and '-' or '=', o
+            o = next(old, None)
+    while o is not None:
+        yield gone(o.path) and '-' or '=', o
+        o = next(old, None)
+
+
+class Snapshot:
+    """the snapshot of a mirror, stored as IDENTIFIER.gz in a directory"""
+
+    def __init__(self, directory, identifier):
+        self.path = os.path.join(directory, identifier + '.gz')
+        self.dirs_path = os.path.join(directory, identifier + '.dirs.gz')
+        self.new = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def read(self):
+        """return an iterator of the entries in the snapshot"""
+        return _read(gzip.open(self.path, 'rb'))
+
+    def write(self, entries):
+        """write entries (sorted by path) to a new snapshot, which replaces
+        the current one only on commit(); return the number of entries"""
+        self.new = self.path + '.new'
+        f = gzip.open(self.new, 'wb', 6)
+        n = 0
+        try:
+            for entry in entries:
+                f.write(_line(entry))
+                n += 1
+        finally:
+            f.close()
+        return n
+
+    def read_new(self):
+        """return an iterator of the entries written with write()"""
+        return _read(gzip.open(self.new, 'rb'))
+
+    def read_dirs(self):
+        """return the fingerprints of the directories, or {} if there are
+        none (or they can't be read)"""
+        if not os.path.exists(self.dirs_path):
+            return {}
+        f = gzip.open(self.dirs_path, 'rb')
+        try:
+            dirs = {}
+            for line in f:
+                path, mtime, count, h, taken = line.rstrip('\n').rsplit('\t', 4)
+                dirs[path] = (_int(mtime), int(count), h, _int(taken))
+        except ValueError:
+            # in another format; all directories are listed again
+            return {}
+        finally:
+            f.close()
+        return dirs
+
+    def write_dirs(self, dirs):
+        """write the fingerprints of the directories, which replace the
+        current ones on commit()"""
+        f = gzip.open(self.dirs_path + '.new', 'wb', 6)
+        try:
+            for path in sorted(dirs):
+                mtime, count, h, taken = dirs[path]
+                f.write('%s\t%s\t%d\t%s\t%s\n' % (path, _str(mtime), count, h,
+                                                   _str(taken)))
+        finally:
+            f.close()
+
+    def commit(self):
+        if os.path.exists(self.dirs_path + '.new'):
+            os.rename(self.dirs_path + '.new', self.dirs_path)
+        elif os.path.exists(self.dirs_path):
+            # they belong to an older snapshot
+            os.unlink(self.dirs_path)
+        os.rename(self.new, self.path)
+        self.new = None
+
+    def abort(self):
+        if self.new and os.path.exists(self.new):
+            os.unlink(self.new)
+        if os.path.exists(self.dirs_path + '.new'):
+            os.unlink(self.dirs_path + '.new')
+        self.new = None
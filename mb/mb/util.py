@@ -227,3 +227,44 @@ def pgsql_regexp_esc(s):
     else:
         return s
 
+
+def parse_size(s):
+    """parse a size like 512K, 16M or 2G into bytes"""
+    s = s.strip().upper()
+    factor = 1
+    for suffix, f in (('K', 1 << 10), ('M', 1 << 20), ('G', 1 << 30)):
+        if s.endswith(suffix):
+            s = s[:-1]
+            factor = f
+            break
+    return int(float(s) * factor)
+
+
+# advice values for posix_fadvise(2), as on Linux
+POSIX_FADV_NORMAL     = 0
+POSIX_FADV_RANDOM     = 1
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED   = 3
+POSIX_FADV_DONTNEED   = 4
+POSIX_FADV_NOREUSE    = 5
+
+_posix_fadvise = None
+
+def fadvise(fd, offset, length, advice):
+    """give the kernel a hint about the access pattern to a file.
+
+    Python 2 doesn't have os.posix_fadvise, thus the libc function is called
+    via ctypes. Where it isn't available, this does nothing."""
+    global _posix_fadvise
+    if _posix_fadvise is None:
+        _posix_fadvise = False
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            f = getattr(libc, 'posix_fadvise64', None) or libc.posix_fadvise
+            f.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+            _posix_fadvise = f
+        except (ImportError, OSError, AttributeError):
+            pass
+    if _posix_fadvise:
+        _posix_fadvise(fd, offset, length, advice)
@@ -10,7 +10,7 @@ s = setup(name='mb',
       license='GPLv2',
       url='http://mirrorbrain.org/',
 
-      packages=['mb'],
+      packages=['mb', 'mb.crawlers'],
       scripts=['mb.py'],
 
       ext_modules=[Extension('zsync', sources=['zsyncmodule.c'])],
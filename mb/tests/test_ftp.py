@@ -0,0 +1,105 @@
+"""tests for mb.crawlers.ftp, against a local pyftpdlib server"""
+
+import os
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+    from pyftpdlib.ioloop import IOLoop
+except ImportError:
+    raise unittest.SkipTest('pyftpdlib is not installed')
+
+import mb.mberr
+import mb.crawlers.ftp
+
+# the server sets up logging to stderr unless there is a handler already
+logging.getLogger('pyftpdlib').addHandler(logging.NullHandler())
+logging.getLogger('pyftpdlib').propagate = False
+
+
+class FtpCrawlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.paths = set()
+        for i in range(3):
+            for j in range(3):
+                d = os.path.join(self.root, 'pub', 'd%d' % i, 's %d' % j)
+                os.makedirs(d)
+                for k in range(5):
+                    open(os.path.join(d, 'f%d.rpm' % k), 'w').write('x' * k)
+                    self.paths.add('d%d/s %d/f%d.rpm' % (i, j, k))
+        open(os.path.join(self.root, 'pub', 'top.txt'), 'w').write('hello')
+        self.paths.add('top.txt')
+        os.symlink('d0', os.path.join(self.root, 'pub', 'link'))
+
+        self.authorizer = DummyAuthorizer()
+        self.authorizer.add_anonymous(self.root)
+
+    def tearDown(self):
+        self.server.close_all()
+        shutil.rmtree(self.root)
+
+    def serve(self, mlsd=True, max_cons=512):
+        class Handler(FTPHandler):
+            pass
+        Handler.authorizer = self.authorizer
+        if not mlsd:
+            Handler.proto_cmds = dict([ (k, v) for k, v in FTPHandler.proto_cmds.items()
+                                        if k not in ('MLSD', 'MLST') ])
+        # a loop of its own, which close_all() closes
+        self.server = FTPServer(('127.0.0.1', 0), Handler, ioloop=IOLoop())
+        self.server.max_cons = max_cons
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        return 'ftp://127.0.0.1:%d/pub/' % self.server.address[1]
+
+    def test_mlsd(self):
+        url = self.serve()
+        entries = list(mb.crawlers.ftp.gen_filelist(url, connections=3))
+        self.assertEqual(set([ e.path for e in entries ]), self.paths)
+        top = [ e for e in entries if e.path == 'top.txt' ][0]
+        self.assertEqual(top.size, 5)
+
+    def test_mlsd_aliases(self):
+        # pyftpdlib reports links to directories as directories; the
+        # smallest path to a directory is taken, whichever is listed first
+        os.symlink('d1', os.path.join(self.root, 'pub', 'a-link'))
+        url = self.serve()
+        expected = set([ p.startswith('d1/') and 'a-link/' + p[3:] or p
+                         for p in self.paths ])
+        for i in range(3):
+            entries = list(mb.crawlers.ftp.gen_filelist(url, connections=3))
+            self.assertEqual(sorted([ e.path for e in entries ]), sorted(expected))
+
+    def test_list(self):
+        url = self.serve(mlsd=False)
+        entries = list(mb.crawlers.ftp.gen_filelist(url, connections=3))
+        self.assertEqual(set([ e.path for e in entries ]), self.paths)
+
+    def test_missing_root(self):
+        url = self.serve()
+        self.assertRaises(mb.mberr.CrawlError,
+                          list, mb.crawlers.ftp.gen_filelist(url + 'nope/'))
+
+    def test_failing_subdirectory(self):
+        self.authorizer.override_perm('anonymous', os.path.join(self.root, 'pub', 'd1'), '')
+        url = self.serve()
+        self.assertRaises(mb.mberr.CrawlError,
+                          list, mb.crawlers.ftp.gen_filelist(url, connections=3))
+
+    def test_too_many_connections(self):
+        url = self.serve(max_cons=2)
+        entries = list(mb.crawlers.ftp.gen_filelist(url, connections=4))
+        self.assertEqual(set([ e.path for e in entries ]), self.paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
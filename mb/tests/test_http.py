@@ -0,0 +1,119 @@
+"""tests for mb.crawlers.http, against a local HTTP server"""
+
+import urllib
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+
+import mb.mberr
+import mb.crawlers.http
+
+
+def index(parts):
+    """the index of the directory at parts, in the format of a different
+    server at each level, or None if there is no such directory"""
+    if len(parts) == 0:
+        subdirs, files = [ 'd%d' % i for i in range(3) ], [ 'top file.txt' ]
+    elif len(parts) == 1:
+        subdirs, files = [ 's%d' % i for i in range(3) ], []
+    elif len(parts) == 2:
+        subdirs, files = [], [ 'f%d.rpm' % i for i in range(5) ]
+    else:
+        return None
+
+    out = [ '<html><body><a href="?C=N;O=D">Name</a><a href="/">Parent Directory</a>' ]
+    if len(parts) == 0:
+        # nginx
+        out.append('<pre><a href="../">../</a>\n')
+        for s in subdirs:
+            out.append('<a href="%s/">%s/</a>          27-Sep-2007 17:50       -\n' % (s, s))
+        for f in files:
+            out.append('<a href="%s">%s</a>   27-Sep-2007 17:50    4405843968\n'
+                       % (urllib.quote(f), f))
+    elif len(parts) == 1:
+        # lighttpd
+        for s in subdirs:
+            out.append('<tr><td class="n"><a href="%s/">%s</a>/</td>'
+                       '<td class="m">2007-Sep-27 17:50:25</td><td class="s">- &nbsp;</td></tr>\n'
+                       % (s, s))
+    else:
+        # apache
+        out.append('<table>')
+        for f in files:
+            out.append('<tr><td><a href="%s">%s</a></td><td align="right">2007-09-27 17:50  </td>'
+                       '<td align="right">123</td></tr>\n' % (f, f))
+    return ''.join(out)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    broken = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = urllib.unquote(self.path)
+        body = None
+        if path.startswith('/pub/') and path != self.broken:
+            body = index([ p for p in path[len('/pub/'):].split('/') if p ])
+        if body is None:
+            self.send_response(path == self.broken and 500 or 404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class HttpCrawlerTest(unittest.TestCase):
+
+    def setUp(self):
+        Handler.broken = None
+        self.server = Server(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        self.url = 'http://127.0.0.1:%d/pub/' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_crawl(self):
+        entries = list(mb.crawlers.http.gen_filelist(self.url, concurrency=3))
+        paths = set([ 'top file.txt' ])
+        for i in range(3):
+            for j in range(3):
+                for k in range(5):
+                    paths.add('d%d/s%d/f%d.rpm' % (i, j, k))
+        self.assertEqual(set([ e.path for e in entries ]), paths)
+        top = [ e for e in entries if e.path == 'top file.txt' ][0]
+        self.assertEqual(top.size, 4405843968)
+        self.assertTrue(top.mtime)
+
+    def test_exclude(self):
+        entries = list(mb.crawlers.http.gen_filelist(self.url,
+                                                     exclude=lambda p: p == 'd1/'))
+        self.assertFalse([ e for e in entries if e.path.startswith('d1/') ])
+        self.assertTrue([ e for e in entries if e.path.startswith('d2/') ])
+
+    def test_missing_root(self):
+        self.assertRaises(mb.mberr.CrawlError,
+                          list, mb.crawlers.http.gen_filelist(self.url + 'd0/s0/nope/'))
+
+    def test_failing_subdirectory(self):
+        Handler.broken = '/pub/d1/s2/'
+        self.assertRaises(mb.mberr.CrawlError,
+                          list, mb.crawlers.http.gen_filelist(self.url, concurrency=3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""tests for mb.crawlers.rsync, with a shell script standing in for rsync"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+import mb.mberr
+import mb.crawlers.rsync
+
+
+# prints a listing like rsync -r does; the last argument is the URL, and
+# its host part selects the exit code
+FAKE_RSYNC = """#!/bin/sh
+for url; do :; done
+echo "drwxr-xr-x          4,096 2010/01/02 03:04:05 ."
+echo "drwxr-xr-x          4,096 2010/01/02 03:04:05 dir"
+echo "-rw-r--r--  4,405,843,968 2007/09/27 17:50:25 dir/openSUSE-10.3-GM- DVD-i386.iso"
+echo "lrwxrwxrwx             11 2010/01/02 03:04:05 dir/link"
+echo "-rw-r--r--             12 2010/01/02 03:04:05 top.txt"
+case "$url" in
+vanished*) echo 'file has vanished: "/dir/gone"' >&2; exit 24;;
+fail*) echo "@ERROR: Unknown module 'fail'" >&2; exit 5;;
+esac
+exit 0
+"""
+
+
+class RsyncCrawlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rsync = os.path.join(self.tmpdir, 'rsync')
+        f = open(self.rsync, 'w')
+        f.write(FAKE_RSYNC)
+        f.close()
+        os.chmod(self.rsync, 0755)
+        self.stderr = sys.stderr
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.tmpdir)
+
+    def test_files(self):
+        entries = list(mb.crawlers.rsync.gen_filelist('ok::mod', rsync=self.rsync))
+        self.assertEqual([ e.path for e in entries ],
+                         [ 'dir/openSUSE-10.3-GM- DVD-i386.iso', 'top.txt' ])
+        self.assertEqual(entries[0].size, 4405843968)
+
+    def test_dirs(self):
+        entries = list(mb.crawlers.rsync.gen_filelist('ok::mod', rsync=self.rsync, dirs=True))
+        self.assertEqual([ e.path for e in entries ],
+                         [ 'dir', 'dir/openSUSE-10.3-GM- DVD-i386.iso', 'top.txt' ])
+
+    def test_failure(self):
+        try:
+            list(mb.crawlers.rsync.gen_filelist('fail::mod', rsync=self.rsync))
+        except mb.mberr.CrawlError, e:
+            self.assertTrue('Unknown module' in e.msg)
+        else:
+            self.fail('no CrawlError')
+
+    def test_vanished_files(self):
+        sys.stderr = StringIO.StringIO()
+        entries = list(mb.crawlers.rsync.gen_filelist('vanished::mod', rsync=self.rsync))
+        self.assertEqual(len(entries), 2)
+        self.assertTrue('vanished' in sys.stderr.getvalue())
+
+    def test_no_rsync(self):
+        self.assertRaises(mb.mberr.CrawlError, list,
+                          mb.crawlers.rsync.gen_filelist('ok::mod',
+                                                         rsync=self.rsync + '-missing'))
+
+    def test_rsync_url(self):
+        self.assertEqual(mb.crawlers.rsync.rsync_url('rsync://host/mod'),
+                         'rsync://host:873/mod')
+
+
+if __name__ == '__main__':
+    unittest.main()
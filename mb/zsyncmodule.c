@@ -1,28 +1,112 @@
 /* "rsum" checksumming function from zsync's librcksum/rsum.c, version 0.6.1,
  * wrapped into a Python extension
  *
- * Copyright 2010,2012 Peter Poeml <poeml@mirrorbrain.org> 
+ * Copyright 2010,2012 Peter Poeml <poeml@mirrorbrain.org>
  *
  * The checksumming function itself is available under the Artistic License;
  * the boilerplate was a nice exercise.
  *
  * This is something that will be a whole lot slower when programmed in a
- * scripting language, thus I wanted this Python extension. */
+ * scripting language, thus I wanted this Python extension.
+ *
+ * blocksums_into() computes the rsum and the MD4 checksum of all blocks of a
+ * buffer in one call, and writes the (truncated) checksums into a
+ * preallocated buffer. The MD4 implementation follows RFC 1320; it is
+ * included because hashlib's md4 is not available with all OpenSSL builds. */
 
 #include <stdlib.h>
+#include <string.h>
 #include <arpa/inet.h>
 #include "Python.h"
 
-static PyObject *zsync_rsum06(PyObject *self, PyObject *args) {
-    char *data;
-    int len;
-    unsigned short a, b;
-    unsigned char digest[4];
-    memset(digest, 0, sizeof(digest));
+#define MD4_DIGEST_LENGTH 16
 
-    if (!PyArg_ParseTuple(args, "s#", &data, &len))
-        return NULL;
+typedef unsigned int md4_u32;
 
+#define MD4_F(x, y, z) (((x) & (y)) | (~(x) & (z)))
+#define MD4_G(x, y, z) (((x) & (y)) | ((x) & (z)) | ((y) & (z)))
+#define MD4_H(x, y, z) ((x) ^ (y) ^ (z))
+#define MD4_ROTL(x, s) (((x) << (s)) | ((x) >> (32 - (s))))
+
+#define MD4_R1(a, b, c, d, k, s) a = MD4_ROTL(a + MD4_F(b, c, d) + x[k], s)
+#define MD4_R2(a, b, c, d, k, s) a = MD4_ROTL(a + MD4_G(b, c, d) + x[k] + 0x5a827999, s)
+#define MD4_R3(a, b, c, d, k, s) a = MD4_ROTL(a + MD4_H(b, c, d) + x[k] + 0x6ed9eba1, s)
+
+static void md4_transform(md4_u32 state[4], const unsigned char *block) {
+    md4_u32 a = state[0], b = state[1], c = state[2], d = state[3];
+    md4_u32 x[16];
+    int i;
+
+    for (i = 0; i < 16; i++)
+        x[i] = (md4_u32)block[i * 4]
+               | ((md4_u32)block[i * 4 + 1] << 8)
+               | ((md4_u32)block[i * 4 + 2] << 16)
+               | ((md4_u32)block[i * 4 + 3] << 24);
+
+    for (i = 0; i < 16; i += 4) {
+        MD4_R1(a, b, c, d, i,      3);
+        MD4_R1(d, a, b, c, i + 1,  7);
+        MD4_R1(c, d, a, b, i + 2, 11);
+        MD4_R1(b, c, d, a, i + 3, 19);
+    }
+    for (i = 0; i < 4; i++) {
+        MD4_R2(a, b, c, d, i,       3);
+        MD4_R2(d, a, b, c, i + 4,   5);
+        MD4_R2(c, d, a, b, i + 8,   9);
+        MD4_R2(b, c, d, a, i + 12, 13);
+    }
+    {
+        static const int order[4] = { 0, 2, 1, 3 };
+        for (i = 0; i < 4; i++) {
+            MD4_R3(a, b, c, d, order[i],       3);
+            MD4_R3(d, a, b, c, order[i] + 8,   9);
+            MD4_R3(c, d, a, b, order[i] + 4,  11);
+            MD4_R3(b, c, d, a, order[i] + 12, 15);
+        }
+    }
+
+    state[0] += a;
+    state[1] += b;
+    state[2] += c;
+    state[3] += d;
+}
+
+static void md4(const unsigned char *data, Py_ssize_t len, unsigned char *digest) {
+    md4_u32 state[4] = { 0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476 };
+    unsigned char tail[128];
+    unsigned long long bits = (unsigned long long)len * 8;
+    Py_ssize_t rest, taillen;
+    int i;
+
+    while (len >= 64) {
+        md4_transform(state, data);
+        data += 64;
+        len -= 64;
+    }
+
+    /* padding: 0x80, zeros, and the length in bits (little endian) */
+    rest = len;
+    memcpy(tail, data, rest);
+    tail[rest] = 0x80;
+    taillen = (rest < 56) ? 64 : 128;
+    memset(tail + rest + 1, 0, taillen - rest - 1);
+    for (i = 0; i < 8; i++)
+        tail[taillen - 8 + i] = (unsigned char)(bits >> (8 * i));
+
+    md4_transform(state, tail);
+    if (taillen == 128)
+        md4_transform(state, tail + 64);
+
+    for (i = 0; i < 4; i++) {
+        digest[i * 4]     = (unsigned char)(state[i]);
+        digest[i * 4 + 1] = (unsigned char)(state[i] >> 8);
+        digest[i * 4 + 2] = (unsigned char)(state[i] >> 16);
+        digest[i * 4 + 3] = (unsigned char)(state[i] >> 24);
+    }
+}
+
+static void rsum06(const unsigned char *data, Py_ssize_t len, unsigned char *digest) {
+    unsigned short a, b;
     {
         register unsigned short aa = 0;
         register unsigned short bb = 0;
@@ -38,14 +122,112 @@ static PyObject *zsync_rsum06(PyObject *self, PyObject *args) {
 
     a = htons(a);
     b = htons(b);
-    memcpy((void *)&digest, &a, 2);
-    memcpy((void *)&digest + 2, &b, 2);
+    memcpy(digest, &a, 2);
+    memcpy(digest + 2, &b, 2);
+}
+
+static PyObject *zsync_rsum06(PyObject *self, PyObject *args) {
+    char *data;
+    int len;
+    unsigned char digest[4];
+    memset(digest, 0, sizeof(digest));
+
+    if (!PyArg_ParseTuple(args, "s#", &data, &len))
+        return NULL;
+
+    rsum06((const unsigned char *)data, len, digest);
 
     return PyString_FromStringAndSize((const char *)digest, sizeof(digest));
 }
 
+static PyObject *zsync_md4(PyObject *self, PyObject *args) {
+    Py_buffer data;
+    unsigned char digest[MD4_DIGEST_LENGTH];
+
+    if (!PyArg_ParseTuple(args, "s*", &data))
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    md4((const unsigned char *)data.buf, data.len, digest);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&data);
+    return PyString_FromStringAndSize((const char *)digest, sizeof(digest));
+}
+
+static PyObject *zsync_blocksums_into(PyObject *self, PyObject *args) {
+    Py_buffer out, data;
+    Py_ssize_t offset, pos, n;
+    int blocksize, rsum_len, checksum_len;
+    unsigned char *dst, *block;
+    unsigned char rsum[4], checksum[MD4_DIGEST_LENGTH];
+
+    if (!PyArg_ParseTuple(args, "w*ns*iii", &out, &offset, &data,
+                          &blocksize, &rsum_len, &checksum_len))
+        return NULL;
+
+    if (blocksize <= 0 || rsum_len < 0 || rsum_len > 4
+            || checksum_len < 0 || checksum_len > MD4_DIGEST_LENGTH) {
+        PyErr_SetString(PyExc_ValueError, "invalid block size or checksum lengths");
+        goto error;
+    }
+
+    n = (data.len + blocksize - 1) / blocksize;
+    if (offset < 0 || offset + n * (rsum_len + checksum_len) > out.len) {
+        PyErr_SetString(PyExc_ValueError, "output buffer too small");
+        goto error;
+    }
+
+    block = malloc(blocksize);
+    if (!block) {
+        PyErr_NoMemory();
+        goto error;
+    }
+
+    dst = (unsigned char *)out.buf + offset;
+
+    Py_BEGIN_ALLOW_THREADS
+    for (pos = 0; pos < data.len; pos += blocksize) {
+        const unsigned char *src = (const unsigned char *)data.buf + pos;
+        if (data.len - pos < blocksize) {
+            /* padding of the last block */
+            memcpy(block, src, data.len - pos);
+            memset(block + (data.len - pos), 0, blocksize - (data.len - pos));
+            src = block;
+        }
+
+        rsum06(src, blocksize, rsum);
+        md4(src, blocksize, checksum);
+
+        /* save only some trailing bytes of the rsum,
+         * and some leading bytes of the checksum */
+        memcpy(dst, rsum + 4 - rsum_len, rsum_len);
+        dst += rsum_len;
+        memcpy(dst, checksum, checksum_len);
+        dst += checksum_len;
+    }
+    Py_END_ALLOW_THREADS
+
+    free(block);
+    PyBuffer_Release(&out);
+    PyBuffer_Release(&data);
+    return PyInt_FromSsize_t(offset + n * (rsum_len + checksum_len));
+
+error:
+    PyBuffer_Release(&out);
+    PyBuffer_Release(&data);
+    return NULL;
+}
+
 static PyMethodDef zsyncMethods[] = {
     {"rsum06",  zsync_rsum06, METH_VARARGS, "Calculate a zsync rsum value."},
+    {"md4",  zsync_md4, METH_VARARGS, "Calculate an MD4 digest."},
+    {"blocksums_into",  zsync_blocksums_into, METH_VARARGS,
+     "blocksums_into(out, offset, data, blocksize, rsum_len, checksum_len)\n\n"
+     "Calculate rsum and MD4 checksum for each block of data (the last block\n"
+     "is padded with zeros), and write rsum_len trailing bytes of the rsum\n"
+     "and checksum_len leading bytes of the MD4 checksum per block into the\n"
+     "writable buffer out, starting at offset. Returns the new offset."},
     {NULL, NULL, 0, NULL}
 };
 
@@ -27,9 +27,70 @@ CREATE TABLE "version" (
 CREATE TABLE "filearr" (
         "id" serial NOT NULL PRIMARY KEY,
         "path" varchar(512) UNIQUE NOT NULL,
-        "mirrors" smallint[]
+        "mirrors" smallint[],
+        "mirrorbits" varbit
 );
 
+-- the directory part of a path ('' for files in the top directory). Indexed,
+-- so that the files in one directory can be listed with an index scan.
+CREATE OR REPLACE FUNCTION mb_dirname(text) RETURNS text AS $$
+    SELECT coalesce(substring($1 from '^(.*)/'), '')
+$$ LANGUAGE SQL IMMUTABLE STRICT;
+
+CREATE INDEX filearr_dirname_key ON filearr (mb_dirname(path));
+
+-- for prefix matches (path LIKE 'dir/%'), which can't use the unique index
+-- on path unless the database uses the C locale
+CREATE INDEX filearr_path_pattern_key ON filearr (path text_pattern_ops);
+
+-- stale files (see mb.dbmaint) are found via this partial index
+CREATE INDEX filearr_stale_key ON filearr (id) WHERE mirrors = '{}';
+
+-- The mirrors of a file can also be kept as a bitmap in filearr.mirrorbits,
+-- where bit n is set if mirror id n has the file. The mirrors array stays
+-- authoritative (it is what mod_mirrorbrain reads). The bitmaps are NULL
+-- until "mb db mirrorbits enable" fills them in; from then on, the functions
+-- that add or remove a mirror set or clear its bit along with the array
+-- (on NULL, the STRICT functions do nothing), and the filearr_mirrorbits
+-- trigger computes the bitmap of new rows. With mirror_bitmaps = 1, mb uses
+-- them for its lookups.
+
+-- set bit number id to val (0 or 1), growing the bitmap as needed
+CREATE OR REPLACE FUNCTION mb_mirrorbits_set(bits varbit, id integer, val integer) RETURNS varbit AS $$
+    SELECT CASE WHEN length($1) > $2 THEN set_bit($1, $2, $3)
+                WHEN $3 = 0 THEN $1
+                ELSE set_bit($1 || repeat('0', $2 + 1 - length($1))::varbit, $2, 1)
+           END
+$$ LANGUAGE SQL IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION mb_mirrorbits_has(bits varbit, id integer) RETURNS boolean AS $$
+    SELECT CASE WHEN length($1) > $2 THEN get_bit($1, $2) = 1 ELSE false END
+$$ LANGUAGE SQL IMMUTABLE STRICT;
+
+-- the bitmap for an array of mirror ids
+CREATE OR REPLACE FUNCTION mb_mirrorbits(ids smallint[]) RETURNS varbit AS $$
+DECLARE
+    bits varbit := B'';
+BEGIN
+    IF array_upper(ids, 1) IS NULL THEN
+        RETURN bits;
+    END IF;
+    FOR i IN array_lower(ids, 1) .. array_upper(ids, 1) LOOP
+        bits := mb_mirrorbits_set(bits, ids[i], 1);
+    END LOOP;
+    RETURN bits;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+-- for the filearr_mirrorbits trigger (BEFORE INSERT), which
+-- "mb db mirrorbits enable" installs
+CREATE OR REPLACE FUNCTION mb_mirrorbits_insert() RETURNS trigger AS $$
+BEGIN
+    NEW.mirrorbits := mb_mirrorbits(NEW.mirrors);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
 -- --------------------------------------------------------
 
 
@@ -79,6 +140,17 @@ CREATE VIEW hexhash AS
          encode(zsums, 'hex') AS zsumshex
   FROM hash;
 
+-- when the hashes of a file were last verified against the file
+-- (mb makehashes --verify), and whether they matched (NULL if the file had
+-- vanished or changed since it was hashed). Rows go away with their hash, so
+-- new hashes count as not verified.
+CREATE TABLE "hashverify" (
+        "file_id" INTEGER REFERENCES hash ON DELETE CASCADE PRIMARY KEY,
+        "verified" timestamp with time zone NOT NULL,
+        "ok" boolean
+);
+CREATE INDEX hashverify_verified_key ON hashverify (verified);
+
 -- --------------------------------------------------------
 
 
@@ -118,6 +190,14 @@ CREATE INDEX "server_enabled_status_baseurl_score_key" ON "server" (
         "enabled", "status_baseurl", "score"
 );
 
+-- the number of files on each mirror, maintained by the mirr_* functions
+-- below (and mb.files.apply_snapshot), so that it doesn't need to be counted
+-- in filearr. "mb db reconcile" recomputes it.
+CREATE TABLE "mirrorfilecount" (
+        "server_id" INTEGER REFERENCES server ON DELETE CASCADE PRIMARY KEY,
+        "nfiles" BIGINT NOT NULL DEFAULT 0
+);
+
 -- --------------------------------------------------------
 
 
@@ -145,6 +225,17 @@ CREATE TABLE "region" (
 
 
 
+-- change the number of files of a mirror by arg_delta
+CREATE OR REPLACE FUNCTION mirr_count_add(arg_serverid integer, arg_delta bigint) RETURNS void AS $$
+BEGIN
+    UPDATE mirrorfilecount SET nfiles = nfiles + arg_delta WHERE server_id = arg_serverid;
+    IF NOT FOUND THEN
+        INSERT INTO mirrorfilecount (server_id, nfiles) VALUES (arg_serverid, arg_delta);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
 -- add a mirror to the list of mirrors where a file was seen
 CREATE OR REPLACE FUNCTION mirr_add_byid(arg_serverid integer, arg_fileid integer) RETURNS integer AS $$
 DECLARE
@@ -157,7 +248,10 @@ BEGIN
     ELSE
         arr := array_append(arr, arg_serverid::smallint);
         RAISE DEBUG 'arr: %', arr;
-        update filearr set mirrors = arr where id = arg_fileid;
+        update filearr set mirrors = arr, 
+                           mirrorbits = mb_mirrorbits_set(mirrorbits, arg_serverid, 1)
+            where id = arg_fileid;
+        PERFORM mirr_count_add(arg_serverid, 1);
         return 1;
     END IF;
 END;
@@ -186,7 +280,10 @@ BEGIN
         -- update the array in the table
         -- if arr is empty, we could actually remove the row instead, thus deleting the file
         UPDATE filearr 
-            SET mirrors = arr WHERE id = arg_fileid;
+            SET mirrors = arr,
+                mirrorbits = mb_mirrorbits_set(mirrorbits, arg_serverid, 0)
+            WHERE id = arg_fileid;
+        PERFORM mirr_count_add(arg_serverid, -1);
         RETURN 1;
     END IF;
 END;
@@ -237,10 +334,14 @@ BEGIN
         RAISE DEBUG 'creating entry for new file.';
         INSERT INTO filearr (path, mirrors) VALUES (arg_path, ARRAY[arg_serverid]);
         fileid := currval('filearr_id_seq');
+        PERFORM mirr_count_add(arg_serverid, 1);
     ELSE
         RAISE DEBUG 'update existing file entry (id: %)', fileid;
         arr := array_append(arr, arg_serverid::smallint);
-        update filearr set mirrors = arr where id = fileid;
+        update filearr set mirrors = arr,
+                           mirrorbits = mb_mirrorbits_set(mirrorbits, arg_serverid, 1)
+            where id = fileid;
+        PERFORM mirr_count_add(arg_serverid, 1);
     END IF;
 
     RETURN fileid;
@@ -274,11 +375,11 @@ $$ LANGUAGE plpgsql;
 
 
 CREATE OR REPLACE FUNCTION mirr_get_nfiles(integer) RETURNS bigint AS '
-    SELECT count(*) FROM filearr WHERE $1 = ANY(mirrors)
+    SELECT coalesce((SELECT nfiles FROM mirrorfilecount WHERE server_id = $1), 0)
 ' LANGUAGE SQL;
 
 CREATE OR REPLACE FUNCTION mirr_get_nfiles(text) RETURNS bigint AS '
-    SELECT count(*) FROM filearr WHERE (SELECT id from server where identifier = $1) = ANY(mirrors)
+    SELECT mirr_get_nfiles((SELECT id from server where identifier = $1))
 ' LANGUAGE SQL;
 
 